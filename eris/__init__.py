@@ -12,8 +12,7 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-import pbr.version
-
-
-__version__ = pbr.version.VersionInfo(
-    'eris').version_string()
+# The version is in eris.version. Looking it up goes through
+# pkg_resources which takes a quarter of a second, and every eris
+# process (like the dynamic inventory Ansible runs over and over)
+# would pay for it if it was looked up here.
@@ -5,6 +5,8 @@ import sys
 import os
 import importlib
 
+from eris.inventory import inv_cache
+
 """
 The Eris dynamic inventory. If (and when) the Eris CLI
 is written this will be the default inventory instantiated
@@ -13,21 +15,69 @@ directly on the comamnd line use it as
 ansible <hosts/groups> -i erisinv.py -m <task>
 or
 ansible-playbook -i erisinv.py <playbook.yml>
+
+Ansible runs the script as a new process every time, so only what
+a cache hit needs is imported up front. The inventory plugin and the
+snapshot module are imported when they are used.
+
+Besides --list the script answers --host <name> with the host
+variables and --group <name> with a group. With an inventory_snapshot
+section in the eris config these are looked up in the snapshot of the
+last inventory instead of building the inventory, until the snapshot
+is older than its ttl.
+
+When ERIS_INVENTORY_SOCKET names the socket of a running inventory
+server (see inv_daemon) the script only asks the server, which keeps
+the inventory built in memory. If the server cannot be reached or
+does not serve the same config the inventory is built here as usual.
 """
 
 
 DEFAULT_INVENTORY = 'eris.inventory.fileinv'
 INVENTORY_CLASS = 'ErisAnsibleInventory'
 
+# Set to a non-empty value to ignore and refresh the inventory cache
+REFRESH_ENV = 'ERIS_INVENTORY_REFRESH'
+
+# The unix socket of the inventory server to ask first
+SOCKET_ENV = 'ERIS_INVENTORY_SOCKET'
 
-def main(argv):
+# How long to wait for the inventory server. It may be rebuilding
+# the inventory when the request comes in.
+SERVER_TIMEOUT = 60
+
+
+def _parse_argv(argv):
+    """
+    Parse the arguments - either --list, --host <name> or --group <name>
+
+    :returns: The kind of query and the host or group name (None for list)
+    :rtype: tuple
+    :raises ValueError: if the argv is incorrect
+    """
+
+    if argv is not None:
+        if len(argv) == 2 and argv[1] == '--list':
+            return ('list', None)
+        if len(argv) == 3 and argv[1] in ('--host', '--group'):
+            return (argv[1][2:], argv[2])
+
+    raise ValueError('Incorrect argv passed')
+
+
+def main(argv, out=None):
     """
     The main Eris inventory executable script. The argv
     for all practical purposes is sys.argv
 
     :param argv: An argument list
+    :param out: Write the inventory to this file instead of \
+            returning it. Large inventories are written as they \
+            are serialized.
     :type argv: list
-    :returns: The dynamic inventory json
+    :type out: file
+    :returns: The dynamic inventory json (the host variables for --host \
+            and the group for --group) or None if it was written to out
     :rtype: str
     :raises ValueError: if the argv is incorrect \
             or if the JSON cannot be parsed
@@ -42,17 +92,98 @@ def main(argv):
     # sys.argv like list.
 
     # Do we have the correct arguments?
-    # 1 argument that is named --list - according to Ansible dynamic inventory
-    # guidelines. Do not support the --host argument. The inventory plugins are
-    # supposed to populate the _meta.hostvars structure so that --host calls
-    # are not needed.
-    if argv is None or len(argv) != 2 or argv[1] != '--list':
-        raise ValueError('Incorrect argv passed')
+    # --list according to Ansible dynamic inventory guidelines. The
+    # inventory plugins populate the _meta.hostvars structure so that
+    # Ansible itself does not need --host, but --host and --group
+    # let tools look up a single host or group cheaply.
+    kind, name = _parse_argv(argv)
 
     # Get the environment variable and check if its present
     eris_config_file = os.getenv('ERIS_CONFIG_FILE')
     if eris_config_file is None:
         raise ValueError('ERIS_CONFIG_FILE is None')
+    refresh = bool(os.getenv(REFRESH_ENV))
+
+    # A running inventory server has the inventory built already
+    socket_path = os.getenv(SOCKET_ENV)
+    if socket_path:
+        inventory_json = _ask_server(socket_path, eris_config_file,
+                                     kind, name, refresh)
+        if inventory_json is not None:
+            return _output(inventory_json, out)
+
+    config_data, config, inventory_plugin = read_config(eris_config_file)
+
+    # The cache config is for the inventory script and not the plugin
+    cache = inv_cache.InventoryCache.from_config(
+        config.pop('inventory_cache', None))
+    snapshot_config = config.pop('inventory_snapshot', None)
+
+    fingerprint = None
+    if cache is not None or snapshot_config is not None:
+        fingerprint = inv_cache.InventoryCache.fingerprint(config_data,
+                                                           config,
+                                                           inventory_plugin)
+
+    if kind != 'list':
+        # Look the host or group up in the snapshot of the last inventory
+        if snapshot_config is not None and not refresh:
+            snapshot = _snapshot(snapshot_config)
+            lookup_json = snapshot.lookup(fingerprint, kind, name)
+            if lookup_json is not None:
+                return _output(lookup_json, out)
+    elif cache is not None and not refresh:
+        # Serve a cached inventory if the sources have not changed
+        inventory_json = cache.get(fingerprint)
+        if inventory_json is not None:
+            return _output(inventory_json, out)
+
+    # Create the inventory and serialize
+    inventory_obj = create_inventory(config, inventory_plugin)
+    if snapshot_config is not None:
+        _snapshot(snapshot_config).put(fingerprint, inventory_obj)
+
+    if kind != 'list':
+        return _output(lookup(inventory_obj, kind, name), out)
+
+    if out is not None and cache is None:
+        # Nothing to keep - stream it straight out
+        inventory_obj.serialize_to_stream(out)
+        out.write('\n')
+        return None
+
+    inventory_json = inventory_obj.serialize_to_json()
+
+    if cache is not None:
+        cache.put(fingerprint, inventory_json)
+
+    # Phew - finally we return this
+    return _output(inventory_json, out)
+
+
+def _snapshot(snapshot_config):
+    """
+    Create the inventory snapshot. sqlite is only loaded when the
+    snapshot is used so a cached --list does not pay for it.
+    """
+
+    from eris.inventory import inv_snapshot
+    return inv_snapshot.InventorySnapshot.from_config(snapshot_config)
+
+
+def read_config(eris_config_file):
+    """
+    Read the eris config
+
+    :param eris_config_file: The eris config file
+    :type eris_config_file: str
+    :returns: The raw config (for fingerprinting the inventory sources), \
+            the config without the inventory_plugin and the inventory \
+            plugin module name
+    :rtype: tuple
+    :raises ValueError: if the JSON cannot be parsed
+    :raises IOError: if the config file cannot be read
+    """
 
     # Check if the file is readable
     if os.access(eris_config_file, os.R_OK) is False:
@@ -62,30 +193,109 @@ def main(argv):
     if os.path.isfile(eris_config_file) is False:
         raise IOError('%s is not a file' % eris_config_file)
 
-    # Read the config into a dictionary
-    config = None
+    # Read the config into a dictionary. Keep the raw data around
+    # for fingerprinting the inventory cache
     with open(eris_config_file, 'r') as fid:
-        config = json.load(fid)
+        config_data = fid.read()
+    config = json.loads(config_data)
 
     # Default plugin is the fileinv
-    inventory_plugin = DEFAULT_INVENTORY
-    if 'inventory_plugin' in config:
-        inventory_plugin = config['inventory_plugin']
-    config.pop('inventory_plugin', None)
+    inventory_plugin = config.pop('inventory_plugin', DEFAULT_INVENTORY)
+
+    return config_data, config, inventory_plugin
+
+
+def create_inventory(config, inventory_plugin):
+    """
+    Create the inventory with the inventory plugin
+
+    :param config: The eris config for the plugin
+    :param inventory_plugin: The inventory plugin module name
+    :type config: dict
+    :type inventory_plugin: str
+    :returns: The inventory
+    :rtype: ErisInventoryBase
+    :raises TypeError: if the inventory plugin is invalid
+    """
 
     # Get the class and create the object
     inventory_mod = importlib.import_module(inventory_plugin)
     inventory_cls = getattr(inventory_mod, INVENTORY_CLASS)
     inventory_obj = inventory_cls(config)
-
-    # Create the inventory and serialize
     inventory_obj.create_inventory()
-    inventory_json = inventory_obj.serialize_to_json()
+    return inventory_obj
 
-    # Phew - finally we return this
-    return inventory_json
+
+def lookup(inventory_obj, kind, name):
+    """
+    Look a host or a group up in an inventory the way the snapshot does
+
+    :param inventory_obj: The inventory
+    :param kind: 'host' or 'group'
+    :param name: The host or group name
+    :type inventory_obj: ErisInventoryBase
+    :type kind: str
+    :type name: str
+    :returns: The host variables or the group as JSON - '{}' if there \
+            is no such host or group
+    :rtype: str
+    """
+
+    if kind == 'host':
+        if not inventory_obj.host_exists(name):
+            return '{}'
+        return json.dumps(inventory_obj.get_host_vars(name))
+
+    if not inventory_obj.group_exists(name):
+        return '{}'
+    return json.dumps(inventory_obj.get_group(name))
+
+
+def _ask_server(socket_path, eris_config_file, kind, name, refresh):
+    """
+    Ask the inventory server for the inventory, a host or a group
+
+    :returns: The JSON answer or None if the server did not answer
+    :rtype: str
+    """
+
+    # Only a client of the server needs the socket modules
+    import socket
+    from eris.utils import control
+
+    request = dict(op=kind, config=os.path.abspath(eris_config_file),
+                   refresh=refresh)
+    if name is not None:
+        request['name'] = name
+
+    try:
+        response = control.send_request(socket_path, request,
+                                        SERVER_TIMEOUT)
+    except (socket.error, ValueError):
+        return None
+
+    if not response.get('ok'):
+        return None
+    return response['inventory'].encode('utf-8')
+
+
+def _output(inventory_json, out):
+    if out is None:
+        return inventory_json
+
+    out.write(inventory_json)
+    out.write('\n')
+    return None
+
+
+def run():
+    """
+    Run the script - the console script entry point
+    """
+
+    main(sys.argv, sys.stdout)
 
 
 # Main entry point for the script execution
 if __name__ == '__main__':
-    print main(sys.argv)
+    run()
@@ -0,0 +1,299 @@
+#! /usr/bin/env python
+
+"""
+The Eris inventory server. Ansible runs the dynamic inventory script
+for every ansible or ansible-playbook invocation and every run builds
+the inventory again. The server builds the inventory once, keeps it
+in memory and answers the erisinv script over a unix socket
+    erisinv_server --socket ~/.cache/eris/inventory/erisinv.sock
+    export ERIS_INVENTORY_SOCKET=~/.cache/eris/inventory/erisinv.sock
+    ansible-playbook -i erisinv <playbook.yml>
+The directory of the socket is created with mode 0700 and the server
+refuses to start unless it belongs to the user and has mode 0700.
+
+The inventory is rebuilt when the config file or the deployment map
+change (checked on every request) and every refresh interval, for
+plugins like fuel whose nodes are not in a local file.
+"""
+
+# System imports
+import argparse
+import os
+import signal
+import sys
+import time
+
+from eris.cli import erisinv
+from eris.inventory import inv_cache
+from eris.utils import control
+from eris.utils import reactor
+from eris.utils import userdir
+
+
+DEFAULT_SOCKET = userdir.user_cache_dir('inventory', 'erisinv.sock')
+DEFAULT_REFRESH_INTERVAL = 300
+
+# The select arguments and the types they can have in a request
+_SELECT_ARGS = (('pattern', basestring),
+                ('where', dict),
+                ('count', (int, long)),
+                ('seed', (basestring, int, long, float)),
+                ('distinct_var', basestring),
+                ('distinct_groups', basestring))
+
+
+class InventoryServer(object):
+    """
+    Keep an inventory built and answer the requests for it
+
+    The requests are
+    {"op": "list"} - the whole inventory
+    {"op": "host", "name": "<host>"} - the variables of a host
+    {"op": "group", "name": "<group>"} - a group
+    {"op": "select", "pattern": "<pattern>", ...} - select hosts with
+                       the arguments of ErisInventoryBase.select_hosts
+                       (where can only have values). The host names
+                       are in "hosts".
+    {"op": "refresh"} - rebuild the inventory now
+    {"op": "status"} - when the inventory was built, how big it is
+                       and how long every source of a multiinv took
+    {"op": "stop"} - stop the server
+    list, host and group answer with the JSON in "inventory", the same
+    JSON the erisinv script prints. Any request can carry "refresh" to
+    rebuild the inventory first and "config" - the path of the eris
+    config the client uses. A request for another config is refused.
+    """
+
+    def __init__(self, config_file,
+                 refresh_interval=DEFAULT_REFRESH_INTERVAL):
+        """
+        Create an inventory server. Nothing is built until the
+        first request or refresh.
+
+        :param config_file: The eris config file
+        :param refresh_interval: Rebuild the inventory this often in \
+                seconds. None or 0 only rebuilds on changes.
+        :type config_file: str
+        :type refresh_interval: int
+        """
+
+        self.config_file = os.path.abspath(config_file)
+        self.refresh_interval = refresh_interval
+        self.reactor = reactor.Reactor()
+        self.control_server = None
+        self._stop_loop = False
+
+        # The inventory and the fingerprint of the sources it was
+        # built from. The list answer is serialized once per build.
+        self.inventory_obj = None
+        self.inventory_json = None
+        self.fingerprint = None
+        self.built_at = None
+        self.build_time = None
+        self.builds = 0
+
+    def refresh(self, force=False):
+        """
+        Rebuild the inventory if the config or the deployment map
+        changed since it was built
+
+        :param force: Rebuild even if nothing changed
+        :type force: boolean
+        :returns: True if the inventory was rebuilt
+        :rtype: boolean
+        :raises ValueError: if the config cannot be parsed
+        :raises IOError: if the config cannot be read
+        """
+
+        config_data, config, inventory_plugin = erisinv.read_config(
+            self.config_file)
+
+        # The cache and the snapshot are for the script - the server
+        # is its own cache
+        config.pop('inventory_cache', None)
+        config.pop('inventory_snapshot', None)
+
+        fingerprint = inv_cache.InventoryCache.fingerprint(config_data,
+                                                           config,
+                                                           inventory_plugin)
+        if not force and fingerprint == self.fingerprint:
+            return False
+
+        start = time.time()
+        inventory_obj = erisinv.create_inventory(config, inventory_plugin)
+        inventory_json = inventory_obj.serialize_to_json()
+
+        self.inventory_obj = inventory_obj
+        self.inventory_json = inventory_json
+        self.fingerprint = fingerprint
+        self.built_at = time.time()
+        self.build_time = self.built_at - start
+        self.builds += 1
+        return True
+
+    def handle_request(self, request):
+        """
+        Handle a control request. See the class for the requests.
+
+        :param request: The request
+        :type request: dict
+        :returns: The response. "ok" is False on errors \
+                with the reason in "error".
+        :rtype: dict
+        """
+
+        op = request.get('op')
+        if op not in ('list', 'host', 'group', 'select', 'refresh', 'status',
+                      'stop'):
+            return dict(ok=False, error='unknown op %s' % op)
+
+        config_file = request.get('config')
+        if config_file is not None and config_file != self.config_file:
+            return dict(ok=False, error='serving %s and not %s' %
+                        (self.config_file, config_file))
+
+        if op == 'stop':
+            self._stop_loop = True
+            return dict(ok=True)
+
+        if op != 'status':
+            try:
+                self.refresh(op == 'refresh' or bool(request.get('refresh')))
+            except Exception as e:
+                # Whatever the plugin raised - the client builds the
+                # inventory itself and gets to see the error
+                return dict(ok=False, error='inventory build failed: %s' % e)
+
+        if op == 'list':
+            return dict(ok=True, inventory=self.inventory_json)
+        elif op in ('host', 'group'):
+            name = request.get('name')
+            if not isinstance(name, basestring):
+                return dict(ok=False, error='no %s name' % op)
+            return dict(ok=True, inventory=erisinv.lookup(self.inventory_obj,
+                                                          op, name))
+        elif op == 'select':
+            select_args = dict(pattern='all')
+            for arg, arg_type in _SELECT_ARGS:
+                value = request.get(arg)
+                if value is None:
+                    continue
+                if (not isinstance(value, arg_type) or
+                        isinstance(value, bool)):
+                    return dict(ok=False, error='bad select %s: %r' %
+                                (arg, value))
+                select_args[arg] = value
+
+            # The indexes of the selection stay with the inventory,
+            # so only the first selection after a build builds them
+            try:
+                hosts = self.inventory_obj.select_hosts(**select_args)
+            except ValueError as e:
+                return dict(ok=False, error=str(e))
+            return dict(ok=True, hosts=sorted(hosts))
+
+        return dict(ok=True,
+                    config=self.config_file,
+                    built_at=self.built_at,
+                    build_time=self.build_time,
+                    builds=self.builds,
+                    hosts=(len(self.inventory_obj.hosts)
+                           if self.inventory_obj is not None else None),
+                    sources=getattr(self.inventory_obj, 'source_stats',
+                                    None))
+
+    def listen(self, socket_path):
+        """
+        Accept requests on a unix socket
+
+        :param socket_path: The unix socket path
+        :type socket_path: str
+        :returns: None
+        :raises socket.error: if the socket cannot be created
+        :raises OSError: if the socket directory is not private \
+                (see userdir.check_private_dir)
+        """
+
+        if self.control_server is None:
+            self.control_server = control.ControlServer(self.reactor,
+                                                        self.handle_request)
+
+        userdir.make_private_dir(os.path.dirname(
+            os.path.abspath(socket_path)))
+        self.control_server.listen_unix(socket_path)
+
+    def _scheduled_refresh(self):
+        try:
+            self.refresh(force=True)
+        except Exception as e:
+            print 'REFRESH FAILED: ', e
+        self.reactor.call_later(self.refresh_interval,
+                                self._scheduled_refresh)
+
+    def loop_forever(self):
+        """
+        Serve requests until a stop request comes in
+
+        :returns: None
+        """
+
+        if self.refresh_interval:
+            self.reactor.call_later(self.refresh_interval,
+                                    self._scheduled_refresh)
+        try:
+            while not self._stop_loop:
+                self.reactor.run_once()
+        finally:
+            if self.control_server is not None:
+                self.control_server.close()
+
+
+def main():
+    """
+    The main function to start the inventory server
+
+    :returns: None
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Keep the Eris inventory built and serve it to erisinv')
+    parser.add_argument('--config',
+                        action='store',
+                        dest='config',
+                        default=os.getenv('ERIS_CONFIG_FILE'),
+                        help='The eris config file. '
+                             'Defaults to ERIS_CONFIG_FILE')
+    parser.add_argument('--socket',
+                        action='store',
+                        dest='socket',
+                        default=DEFAULT_SOCKET,
+                        help='Serve the inventory on this unix socket')
+    parser.add_argument('--refresh-interval',
+                        action='store',
+                        dest='refresh_interval',
+                        type=int,
+                        default=DEFAULT_REFRESH_INTERVAL,
+                        help='Rebuild the inventory this often in seconds, '
+                             '0 to rebuild only on changes')
+
+    args = parser.parse_args()
+    if args.config is None:
+        parser.error('no --config and ERIS_CONFIG_FILE is not set')
+
+    server = InventoryServer(args.config, args.refresh_interval)
+    try:
+        server.refresh()
+    except Exception as e:
+        # The next request tries again
+        print 'BUILD FAILED: ', e
+
+    # Clean up the socket on a plain kill as well
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    server.listen(args.socket)
+    print 'SERVING: ', args.socket
+    sys.stdout.flush()
+    server.loop_forever()
+
+
+if __name__ == '__main__':
+    main()
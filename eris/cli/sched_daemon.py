@@ -1,14 +1,64 @@
 #! /usr/bin/env python
 
+import errno
+import fcntl
+import heapq
+import itertools
 import json
+import signal
 import subprocess
 import os
 import uuid
 import time
 import argparse
+import collections
 import string
 import random
 
+from eris.utils import control
+from eris.utils import dirwatch
+from eris.utils import journal
+from eris.utils import jsonstream
+from eris.utils import reactor
+from eris.utils import userdir
+
+
+# The HTTP control requests need the token written to this file when
+# the scheduler starts (see control.write_token_file)
+DEFAULT_HTTP_TOKEN_FILE = userdir.user_cache_dir('sched_daemon', 'http.token')
+
+# Job files are either a single job or command, a JSON array of them
+# or JSON lines. Anything else in the job directory is ignored, so
+# write job files under another name and rename them into place.
+JOB_FILE_SUFFIXES = ('.json', '.jsonl')
+CLAIMED_PREFIX = '.claimed-'
+
+
+def _check_number(name, value, optional=False, positive=False):
+    """
+    Check a number field of a job
+
+    :param name: The field name for the error
+    :param value: The field value
+    :param optional: None is allowed
+    :param positive: Only numbers above 0 are allowed
+    :type name: str
+    :type value: int
+    :type optional: boolean
+    :type positive: boolean
+    :returns: None
+    :raises ValueError: if the value is not a number as required
+    """
+
+    if value is None and optional:
+        return
+    if (not isinstance(value, (int, long, float)) or
+            isinstance(value, bool)):
+        raise ValueError('%s is not a number: %r' % (name, value))
+    if positive and value <= 0:
+        raise ValueError('%s is not above 0: %r' % (name, value))
+
+
 # TODO: This whole file needs a whole bunch of logging
 # without logging we are blind to what's happening in there
 # Add robust logging.
@@ -33,7 +83,9 @@ class Job(object):
                  run_at=None,
                  repeat=None,
                  until=None,
-                 tag=None):
+                 tag=None,
+                 priority=0,
+                 timeout=None):
         """
         Create a one-time or a repetitive job
 
@@ -44,13 +96,22 @@ class Job(object):
         :param repeat: Run every repeat seconds
         :param until: Run until now + until seconds \
                 Only valid when repeat is there.
+        :param tag: The job tag. Defaults to the command name.
+        :param priority: Jobs with a higher priority are started \
+                first when the scheduler is at its concurrency limit
+        :param timeout: Kill the job if it runs longer than \
+                timeout seconds
         :type logger: logging.Logger
         :type outdir: str
         :type cmd: list
         :type run_at: int
         :type repeat: int
         :type until: int
+        :type tag: str
+        :type priority: int
+        :type timeout: int
         :returns: None
+        :raises ValueError: if a field is missing or has the wrong type
         """
         
         current_time = time.time()
@@ -59,6 +120,21 @@ class Job(object):
                 (repeat is not None and until is None)):
             raise ValueError('both repeat and until need to be specified')
 
+        # The jobs come from job files and control requests - check
+        # everything before the job gets anywhere near the loop
+        if not isinstance(outdir, basestring) or not outdir:
+            raise ValueError('outdir is not a path: %r' % (outdir, ))
+        if (not isinstance(cmd, list) or not cmd or
+                not all(isinstance(arg, basestring) for arg in cmd)):
+            raise ValueError('cmd is not a list of strings: %r' % (cmd, ))
+        if tag is not None and (not isinstance(tag, basestring) or not tag):
+            raise ValueError('tag is not a string: %r' % (tag, ))
+        _check_number('run_at', run_at)
+        _check_number('repeat', repeat, optional=True, positive=True)
+        _check_number('until', until, optional=True)
+        _check_number('priority', priority)
+        _check_number('timeout', timeout, optional=True, positive=True)
+
         if repeat is None:
             self.jtype = Job.ONETIME
         else:
@@ -72,9 +148,16 @@ class Job(object):
             self.until = current_time + until
 
         self.tag = tag if tag is not None else self.cmd[0]
+        self.priority = priority
+        self.timeout = timeout
         self.id = self._get_random_id()
         self.outfile = os.path.join(outdir, self.id)
         self.popen = None
+        self.start_time = None
+        self.end_time = None
+        self.exit_code = None
+        self.queued_at = None
+        self.timed_out = False
 
     def _get_random_id(self):
         rand_str_space = string.ascii_letters + string.digits
@@ -98,6 +181,87 @@ class Job(object):
     def __repr__(self):
         return self.id
 
+    def status(self):
+        """
+        The job details for status requests
+
+        :returns: The job fields that can be serialized to JSON
+        :rtype: dict
+        """
+
+        return dict(id=self.id,
+                    tag=self.tag,
+                    cmd=self.cmd,
+                    recurring=self.recurring(),
+                    run_at=self.run_at,
+                    priority=self.priority,
+                    start_time=self.start_time,
+                    end_time=self.end_time,
+                    duration=self.duration(),
+                    exit_code=self.exit_code,
+                    timed_out=self.timed_out)
+
+    def record(self):
+        """
+        The job as a journal record. All times are absolute.
+        Fields that are not set are left out to keep journals small.
+
+        :returns: The job fields that can be serialized to JSON
+        :rtype: dict
+        """
+
+        record = dict(id=self.id,
+                      cmd=self.cmd,
+                      outfile=self.outfile,
+                      tag=self.tag,
+                      run_at=self.run_at)
+        if self.recurring():
+            record['repeat'] = self.repeat
+            record['until'] = self.until
+        for name in ('priority', 'timeout', 'start_time',
+                     'end_time', 'exit_code'):
+            value = getattr(self, name)
+            if value is not None:
+                record[name] = value
+
+        return record
+
+    @classmethod
+    def from_record(cls, record):
+        """
+        Recreate a job from its journal record. The job is not
+        running - a job that was running when the record was
+        written has to be started again.
+
+        :param record: The journal record
+        :type record: dict
+        :returns: The job
+        :rtype: Job
+        :raises KeyError: if the record is incomplete
+        """
+
+        job = cls.__new__(cls)
+        job.id = record['id']
+        job.cmd = record['cmd']
+        job.outfile = record['outfile']
+        job.tag = record['tag']
+        job.priority = record.get('priority', 0)
+        job.timeout = record.get('timeout')
+        job.run_at = record['run_at']
+        if record.get('repeat') is None:
+            job.jtype = Job.ONETIME
+        else:
+            job.jtype = Job.RECURRING
+            job.repeat = record['repeat']
+            job.until = record['until']
+        job.popen = None
+        job.start_time = record.get('start_time')
+        job.end_time = record.get('end_time')
+        job.exit_code = record.get('exit_code')
+        job.queued_at = None
+        job.timed_out = False
+        return job
+
     def recurring(self):
         """
         Is the job onetime or recurring.
@@ -108,11 +272,14 @@ class Job(object):
 
         return self.jtype == Job.RECURRING
 
-    def expired(self):
+    def expired(self, current_time=None):
         """
         Has the recurring job expired? 
         Or has the one time job been run?
 
+        :param current_time: The time to check against. \
+                Defaults to now.
+        :type current_time: float
         :returns: True if expired
         :rtype: boolean
         """
@@ -120,32 +287,42 @@ class Job(object):
         # A recurring job is expired when 
         # the current time is past its until time
         # A onetime job is expired after it is run
-        current_time = time.time()
+        if current_time is None:
+            current_time = time.time()
         if self.recurring():
             return current_time >= self.until
         else:
             return self.started() and self.finished()
 
-    def set_next_run(self):
+    def set_next_run(self, current_time=None):
         """
         Update the run_at value for
         recurring jobs to be now + repeat
         Can be called on onetime jobs without any effect
+
+        :param current_time: The time to count from. Defaults to now.
+        :type current_time: float
         """
 
         if self.recurring():
-            self.run_at = time.time() + self.repeat
+            if current_time is None:
+                current_time = time.time()
+            self.run_at = current_time + self.repeat
 
-    def ready(self):
+    def ready(self, current_time=None):
         """
         Is the job ready to be executed
 
+        :param current_time: The time to check against. \
+                Defaults to now.
+        :type current_time: float
         :returns: True or false on whether the job can be run
         :rtype: boolean
         """
 
         # Ready to run if the current time is >= the run_at time
-        current_time = time.time()
+        if current_time is None:
+            current_time = time.time()
         if self.jtype == Job.ONETIME:
             return current_time >= self.run_at
         elif self.jtype == Job.RECURRING:
@@ -178,7 +355,46 @@ class Job(object):
         :rtype: boolean
         """
 
-        return self.popen.poll() is not None
+        if self.end_time is None and self.popen.poll() is not None:
+            self.set_finished(self.popen.returncode)
+
+        return self.end_time is not None
+
+    def set_finished(self, exit_code, end_time=None):
+        """
+        Record the completion of the job. This is called by the
+        scheduler when it reaps the job process.
+
+        :param exit_code: The exit code of the process - negative \
+                for the signal that terminated it as in subprocess
+        :param end_time: The time the job completed. Defaults to now.
+        :type exit_code: int
+        :type end_time: float
+        :returns: None
+        """
+
+        if end_time is None:
+            end_time = time.time()
+
+        self.exit_code = exit_code
+        self.end_time = end_time
+
+        # The process has been waited for - keep Popen from waiting again
+        self.popen.returncode = exit_code
+
+    def duration(self):
+        """
+        How long the job ran for
+
+        :returns: Seconds from start to completion or None \
+                if the job has not finished
+        :rtype: float
+        """
+
+        if self.start_time is None or self.end_time is None:
+            return None
+
+        return self.end_time - self.start_time
 
     def returncode(self):
         """
@@ -189,6 +405,9 @@ class Job(object):
         :rtype: int
         """
 
+        if self.exit_code is not None:
+            return self.exit_code
+
         return self.popen.returncode
 
     def stop(self):
@@ -221,6 +440,11 @@ class Job(object):
             header_string = '\n\n' + self.id + ':' + str(current_time) + '\n'
             print 'RUNNING: ', str(self.cmd)
             fid.write(header_string)
+            fid.flush()
+            self.start_time = current_time
+            self.end_time = None
+            self.exit_code = None
+            self.timed_out = False
             self.popen = subprocess.Popen(self.cmd, stdout=fid, stderr=fid)
 
         return self.popen
@@ -237,21 +461,33 @@ class Scheduler(object):
             and can provide simple status on existing jobs
 
     The scheduler is very simple - it reads off a directory
-    specified in the constructor for jobs. There is no job 
-    control - once in the scheduler a job cannot be deleted.
+    specified in the constructor for jobs. Jobs can also be
+    submitted and queried on a unix socket or on 127.0.0.1 over
+    HTTP with a token (see handle_request and listen). There is no
+    job control - once in the scheduler a job cannot be deleted.
     """
-    # TODO: Add better mechanism to manage jobs. Options are
-    # using a named pipe, unix socket, 127.0.0.1:<port>, etc.
-    # Custom protocol or using http.
 
-    def __init__(self, job_dir, poll_interval=5):
+    # How many completed jobs are kept around for status requests
+    HISTORY_SIZE = 1000
+
+    def __init__(self, job_dir, poll_interval=5, use_inotify=True,
+                 max_jobs=10, tag_limits=None):
         """
         Create a scheduler
 
         :param job_dir: The job directory
-        :param poll_interval: How often to check the job directory
+        :param poll_interval: How often to check the job directory \
+                when inotify is not available
+        :param use_inotify: Watch the job directory with inotify
+        :param max_jobs: The most jobs that run at the same time. \
+                None or 0 for no limit.
+        :param tag_limits: The most jobs with a tag that run at \
+                the same time
         :type job_dir: str
         :type poll_interval: int
+        :type use_inotify: boolean
+        :type max_jobs: int
+        :type tag_limits: dict
         :returns: None
         :raises IOError: if the job dir does not exist and \
                 can't be created.
@@ -260,8 +496,62 @@ class Scheduler(object):
 
         self.job_dir = job_dir
         self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
         self.pending_jobs = set()
         self.running_jobs = set()
+
+        # Pending jobs ordered by run_at. Entries are (run_at, seq, job)
+        # where seq breaks ties between jobs due at the same time.
+        # Entries for jobs that have left pending_jobs are stale and
+        # are skipped when they reach the top of the heap.
+        self._pending_heap = list()
+        self._heap_seq = itertools.count()
+
+        # Running jobs by process id. The scheduler learns about
+        # completed jobs by reaping its children with waitpid rather
+        # than polling every running job. Jobs reaped since the last
+        # tick are in finished_jobs.
+        self._running_pids = dict()
+        self.finished_jobs = set()
+
+        # The (read, write) pipe SIGCHLD writes to when the loop runs
+        self._wakeup_fds = None
+
+        # Concurrency limits. Jobs that are due but can't be started
+        # because of the limits wait in a ready queue for their tag - a
+        # heap of (-priority, queued_at, seq, job) so higher priorities
+        # go first and jobs with the same priority are started in FIFO
+        # order. The tags that can start a job have the first entry of
+        # their queue in the ready heap. A tag at its limit is left out
+        # until one of its jobs finishes, so it costs nothing per tick.
+        # Entries that are no longer the first of their queue are stale
+        # and are skipped when they reach the top of the ready heap.
+        self.max_jobs = max_jobs
+        self.tag_limits = tag_limits if tag_limits is not None else dict()
+        self._running_tags = dict()
+        self._ready_queues = dict()
+        self._ready_heap = list()
+
+        # Time spent by started jobs in the ready queue
+        self.queue_wait_count = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+
+        # Job intake, child completion and job timeouts are all
+        # events on this one loop
+        self.reactor = reactor.Reactor()
+        self._timeout_timers = dict()
+        self._stop_loop = False
+
+        # All the jobs in the scheduler by id and the most recently
+        # completed ones for status requests
+        self.jobs = dict()
+        self._job_history = collections.OrderedDict()
+        self.control_server = None
+
+        # Every change to the jobs is written to the journal (if any)
+        # so the schedule survives a restart
+        self.journal = None
     
     def loop_forever(self):
         """
@@ -272,58 +562,769 @@ class Scheduler(object):
         added to the queue. 
         {"type": "JOB", <...job payload...>}
         {"type": "CMD", "value": "STOP"}
-        """
 
-        stop = False
-        while not stop:
-            file_list = os.listdir(self.job_dir)
-            for x in file_list:
-                if x.endswith('.json') is False:
-                    continue
-                file_value = None 
-                complete_path = os.path.join(self.job_dir, x)
-                if os.path.isfile(complete_path) is False:
-                    continue
-                with open(complete_path, 'r') as fid:
-                    try:
-                        file_value = json.load(fid)
-                        print 'LOADED: ', str(file_value)
-                    except:
-                        # Don't care if it fails.
-                        # Ignore
-                        pass
-               
-                # We have the JSON/dict - now get rid of the file
-                os.remove(complete_path)
-                if file_value is None:
-                    continue
+        The loop is a single threaded event loop. It sleeps until
+        a job file is written into the job directory, a job completes,
+        a job times out or the next pending job is due. Job files
+        are picked up through inotify where it is available and by
+        polling the job directory every poll_interval otherwise.
+        """
 
-                if file_value.get('type','something') == 'JOB':
-                    j = Job(file_value.get('outdir'),
-                            file_value.get('cmd'),
-                            file_value.get('run_at', None),
-                            file_value.get('repeat', None),
-                            file_value.get('until', None),
-                            file_value.get('tag', None))
-                    print 'ADDING: ', str(j)
-                    self.pending_jobs.add(j)
-                    print 'PENDING: ', str(self.pending_jobs)
-                elif file_value.get('type','something') == 'CMD':
-                    stop = self.run_cmd(file_value.get('command', 'something'))
-                    break
-                else:
-                    # Some junk - ignore
-                    pass
-            if not stop:
+        watcher = dirwatch.DirectoryWatcher(self.job_dir,
+                                            self.poll_interval,
+                                            self.use_inotify)
+        restore_signals = self._install_sigchld()
+        stop_watching = self._watch_job_dir(watcher)
+        try:
+            # Pick up the jobs that were queued before we started
+            self._stop_loop = self.load_job_files(watcher.scan())
+            while not self._stop_loop:
                 self.run_jobs()
 
-                # Wait for the poll interval
-                time.sleep(self.poll_interval)
-        
+                # Wait for new job files, a job to complete
+                # or the next job to be due
+                self.reactor.run_once(self.next_timeout())
+        finally:
+            stop_watching()
+            watcher.close()
+            restore_signals()
+            if self.control_server is not None:
+                self.control_server.close()
+            if self.journal is not None:
+                self.journal.close()
+
         # Ok - got a stop and we're out of the loop here
         # Stop all the jobs
         self.stop()
 
+    def next_timeout(self):
+        """
+        How long the loop can sleep before there is some work to do
+
+        :returns: Seconds until the next pending job is due or None \
+                if there are no pending or running jobs
+        :rtype: float
+        """
+
+        timeout = None
+
+        # Without SIGCHLD to wake us up running jobs are
+        # checked for completion every poll_interval
+        if self.running_jobs and self._wakeup_fds is None:
+            timeout = self.poll_interval
+
+        next_job = self._peek_pending()
+        if next_job is not None:
+            due_in = max(next_job.run_at - time.time(), 0)
+            if timeout is None or due_in < timeout:
+                timeout = due_in
+
+        return timeout
+
+    def load_job_files(self, file_list):
+        """
+        Load the jobs and commands from the job files.
+        The files are removed after they are loaded.
+
+        A job file holds a single job or command, a JSON array of
+        them or JSON lines. Batch files are parsed incrementally and
+        each job is scheduled as it is parsed. A file is claimed by
+        renaming it before it is read, so it is only ever read once.
+
+        :param file_list: File names in the job directory
+        :type file_list: list
+        :returns: True if a STOP command was loaded
+        :rtype: boolean
+        """
+
+        stop = False
+        for x in file_list:
+            if x.endswith(JOB_FILE_SUFFIXES) is False:
+                continue
+            complete_path = os.path.join(self.job_dir, x)
+            if os.path.isfile(complete_path) is False:
+                continue
+
+            # Claim the file - if it's gone someone else got it first
+            claimed_path = os.path.join(self.job_dir, CLAIMED_PREFIX + x)
+            try:
+                os.rename(complete_path, claimed_path)
+            except OSError:
+                continue
+
+            try:
+                for file_value in jsonstream.iter_json_file(claimed_path):
+                    try:
+                        _, stop = self.load_value(file_value)
+                    except (ValueError, TypeError) as e:
+                        print 'BAD JOB: ', str(e)
+                        continue
+
+                    # Once stopping the rest of the file is moot
+                    if stop:
+                        break
+            except (IOError, ValueError) as e:
+                # Don't care if it fails.
+                # The jobs parsed before the error stay scheduled
+                print 'BAD JOB FILE: ', x, str(e)
+            finally:
+                # We have the jobs - now get rid of the file
+                self._sync_journal()
+                os.remove(claimed_path)
+
+            if stop:
+                break
+
+        return stop
+
+    def load_value(self, value):
+        """
+        Add a job or run a command from a job file or control request
+        {"type": "JOB", <...job payload...>}
+        {"type": "CMD", "command": "STOP"}
+        Anything else is ignored.
+
+        :param value: The job or command
+        :type value: dict
+        :returns: The job that was added (or None) and True if \
+                a STOP command was run
+        :rtype: tuple
+        :raises ValueError: if the job payload is invalid
+        :raises TypeError: if the job payload is invalid
+        """
+
+        if not isinstance(value, dict):
+            raise ValueError('job is not an object')
+
+        if value.get('type', 'something') == 'JOB':
+            j = Job(value.get('outdir'),
+                    value.get('cmd'),
+                    value.get('run_at', None),
+                    value.get('repeat', None),
+                    value.get('until', None),
+                    value.get('tag', None),
+                    value.get('priority', 0),
+                    value.get('timeout', None))
+            self.add_job(j)
+            return j, False
+        elif value.get('type', 'something') == 'CMD':
+            return None, self.run_cmd(value.get('command', 'something'))
+        else:
+            # Some junk - ignore
+            return None, False
+
+    def handle_request(self, request):
+        """
+        Handle a control request. The requests are
+        {"op": "submit", "jobs": [<job or command>, ...]}
+        {"op": "list"}
+        {"op": "status", "id": "<job id>"}
+        A submit request can carry a single "job" instead of "jobs".
+        Jobs and commands are as in the job files. The list and status
+        responses have the queue_wait_stats in "queue_wait".
+
+        :param request: The request
+        :type request: dict
+        :returns: The response. "ok" is False on errors \
+                with the reason in "error".
+        :rtype: dict
+        """
+
+        op = request.get('op')
+        if op == 'submit':
+            values = request.get('jobs')
+            if values is None and 'job' in request:
+                values = [request['job'], ]
+            if not isinstance(values, list):
+                return dict(ok=False, error='no jobs to submit')
+
+            # The jobs before a bad one are in the journal - make them
+            # durable before answering either way
+            ids = list()
+            try:
+                for value in values:
+                    try:
+                        job, stop = self.load_value(value)
+                    except (ValueError, TypeError) as e:
+                        return dict(ok=False, error='bad job: %s' % e,
+                                    ids=ids)
+                    if job is not None:
+                        ids.append(job.id)
+                    if stop:
+                        self._stop_loop = True
+            finally:
+                self._sync_journal()
+            return dict(ok=True, ids=ids)
+        elif op == 'list':
+            return dict(ok=True,
+                        pending=[j.id for j in self.pending_jobs],
+                        queued=[j.id for j in self.queued_jobs()],
+                        running=[j.id for j in self.running_jobs],
+                        queue_wait=self.queue_wait_stats())
+        elif op == 'status':
+            job_status = self.job_status(request.get('id'))
+            if job_status is None:
+                return dict(ok=False, error='no job %s' % request.get('id'))
+            job_status['ok'] = True
+            job_status['queue_wait'] = self.queue_wait_stats()
+            return job_status
+        else:
+            return dict(ok=False, error='unknown op %s' % op)
+
+    @staticmethod
+    def http_route(method, path, payload):
+        """
+        Map HTTP requests to control requests
+        GET /jobs - list the jobs
+        GET /jobs/<id> - the status of a job
+        POST /jobs - submit a job or a list of jobs in the body
+
+        :returns: The control request or None if there is no route
+        :rtype: dict
+        """
+
+        parts = [part for part in path.split('?')[0].split('/') if part]
+        if not parts or parts[0] != 'jobs' or len(parts) > 2:
+            return None
+
+        if method == 'GET' and len(parts) == 1:
+            return dict(op='list')
+        elif method == 'GET':
+            return dict(op='status', id=parts[1])
+        elif method == 'POST' and len(parts) == 1:
+            if isinstance(payload, dict):
+                payload = [payload, ]
+            return dict(op='submit', jobs=payload)
+        else:
+            return None
+
+    def job_status(self, job_id):
+        """
+        The status of a job in the scheduler or one that
+        completed recently
+
+        :param job_id: The job id
+        :type job_id: str
+        :returns: The job details with its state - pending, queued, \
+                running or done. None if the job is not known.
+        :rtype: dict
+        """
+
+        job = self.jobs.get(job_id)
+        if job is None:
+            job = self._job_history.get(job_id)
+            if job is None:
+                return None
+            state = 'done'
+        elif job in self.running_jobs:
+            state = 'running'
+        elif job in self.pending_jobs:
+            state = 'pending'
+        elif job in self.finished_jobs:
+            state = 'done'
+        else:
+            state = 'queued'
+
+        job_status = job.status()
+        job_status['state'] = state
+        return job_status
+
+    def _retire_job(self, job):
+        """
+        A job is done for good - keep it around for a while for
+        status requests only
+
+        :param job: The job that will not run again
+        :type job: Job
+        """
+
+        if (self.jobs.pop(job.id, None) is not None and
+                self.journal is not None):
+            self.journal.delete(job.id)
+        self._job_history[job.id] = job
+        if len(self._job_history) > self.HISTORY_SIZE:
+            self._job_history.popitem(last=False)
+
+    def listen(self, socket_path=None, http_port=None,
+               http_token_file=DEFAULT_HTTP_TOKEN_FILE):
+        """
+        Accept control requests on a unix socket and/or over HTTP
+        on 127.0.0.1. The HTTP requests have to carry the token
+        written to the token file.
+
+        :param socket_path: The unix socket path
+        :param http_port: The HTTP port. 0 picks a free port.
+        :param http_token_file: The file the HTTP token is written to
+        :type socket_path: str
+        :type http_port: int
+        :type http_token_file: str
+        :returns: The HTTP port or None
+        :rtype: int
+        :raises socket.error: if the sockets cannot be created
+        :raises OSError: if the token file cannot be written in \
+                a private directory
+        """
+
+        if self.control_server is None:
+            self.control_server = control.ControlServer(self.reactor,
+                                                        self.handle_request,
+                                                        self.http_route)
+
+        if socket_path is not None:
+            self.control_server.listen_unix(socket_path)
+
+        if http_port is not None:
+            token = control.write_token_file(
+                os.path.expanduser(http_token_file))
+            return self.control_server.listen_http(http_port, token)
+
+        return None
+
+    def open_journal(self, path, fsync=True):
+        """
+        Keep the jobs in a journal. The jobs in the journal from a
+        previous run are scheduled again. Jobs that were running
+        when the previous run ended are started again.
+
+        :param path: The journal file
+        :param fsync: Sync the journal to disk after every change
+        :type path: str
+        :type fsync: boolean
+        :returns: The number of jobs recovered from the journal
+        :rtype: int
+        :raises IOError: if the journal cannot be read or written
+        :raises ValueError: if the journal is corrupt
+        """
+
+        self.journal = journal.Journal(path, fsync)
+        records = self.journal.load()
+
+        for job_id, record in records.items():
+            job = Job.from_record(record)
+            if job.end_time is not None and not job.recurring():
+                # Finished but not yet retired - it has run, so retire
+                # it now or it is replayed on every start
+                self.journal.delete(job_id)
+                del records[job_id]
+                continue
+
+            # Already in the journal - add_job doesn't need to write it
+            self.jobs[job.id] = job
+            self.add_job(job)
+
+        # Start the log over if replaying it is getting slow
+        if self.journal.needs_compaction(len(records)):
+            self.journal.compact(records)
+        else:
+            self.journal.sync()
+        return len(records)
+
+    def _sync_journal(self):
+        """
+        Make the journal changes durable, compacting the journal
+        when its log has grown large enough
+        """
+
+        if self.journal is None:
+            return
+
+        if self.journal.needs_compaction(len(self.jobs)):
+            self.journal.compact(dict((job_id, job.record())
+                                      for job_id, job
+                                      in self.jobs.iteritems()))
+        else:
+            self.journal.sync()
+
+    def _job_files_added(self, file_list):
+        if self.load_job_files(file_list):
+            self._stop_loop = True
+
+    def _watch_job_dir(self, watcher):
+        """
+        Load the job files as they are added to the job directory
+
+        :param watcher: The job directory watcher
+        :type watcher: dirwatch.DirectoryWatcher
+        :returns: A function that stops watching the directory
+        :rtype: function
+        """
+
+        if not watcher.using_inotify():
+            return self._poll_job_dir(watcher)
+
+        fd = watcher.fileno()
+        stop_watching = [lambda: self.reactor.remove_reader(fd)]
+
+        def job_dir_events():
+            file_list = watcher.read_events()
+            if not watcher.using_inotify():
+                # The watch went away with the directory - stop
+                # waiting on the descriptor before it is closed and
+                # poll the directory from now on
+                self.reactor.remove_reader(fd)
+                watcher.close()
+                stop_watching[0] = self._poll_job_dir(watcher)
+            self._job_files_added(file_list)
+
+        self.reactor.add_reader(fd, job_dir_events)
+        return lambda: stop_watching[0]()
+
+    def _poll_job_dir(self, watcher):
+        """
+        Scan the job directory every poll_interval
+
+        :param watcher: The job directory watcher
+        :type watcher: dirwatch.DirectoryWatcher
+        :returns: A function that stops the scans
+        :rtype: function
+        """
+
+        poll_timer = [None]
+
+        def poll_job_dir():
+            poll_timer[0] = self.reactor.call_later(self.poll_interval,
+                                                    poll_job_dir)
+            try:
+                file_list = watcher.scan()
+            except OSError as e:
+                # The job directory is gone - keep looking for it
+                print 'JOB DIR: ', str(e)
+                return
+            self._job_files_added(file_list)
+
+        poll_timer[0] = self.reactor.call_later(self.poll_interval,
+                                                poll_job_dir)
+        return lambda: poll_timer[0].cancel()
+
+    def _install_sigchld(self):
+        """
+        Wake up the loop when a child process exits. SIGCHLD writes
+        to a pipe that the loop waits on. Signals can only be set up
+        from the main thread - elsewhere the loop falls back to
+        checking running jobs every poll_interval.
+
+        :returns: A function that restores the previous signal setup
+        :rtype: function
+        """
+
+        read_fd, write_fd = os.pipe()
+        for fd in (read_fd, write_fd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        try:
+            old_wakeup_fd = signal.set_wakeup_fd(write_fd)
+            old_handler = signal.signal(signal.SIGCHLD, lambda s, f: None)
+        except ValueError:
+            os.close(read_fd)
+            os.close(write_fd)
+            return lambda: None
+
+        self._wakeup_fds = (read_fd, write_fd)
+        self.reactor.add_reader(read_fd, self._drain_wakeup)
+
+        def restore_signals():
+            self.reactor.remove_reader(read_fd)
+            signal.signal(signal.SIGCHLD, old_handler)
+            signal.set_wakeup_fd(old_wakeup_fd)
+            self._wakeup_fds = None
+            os.close(read_fd)
+            os.close(write_fd)
+
+        return restore_signals
+
+    def _drain_wakeup(self):
+        if self._wakeup_fds is None:
+            return
+
+        try:
+            while os.read(self._wakeup_fds[0], 4096):
+                pass
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                raise
+
+    def reap_jobs(self, current_time=None):
+        """
+        Collect the exit status of all the child processes that
+        have completed and move their jobs from the running jobs
+        to the finished jobs. A single waitpid call is made when
+        no job has completed, no matter how many jobs are running.
+
+        :param current_time: The completion time to record. \
+                Defaults to now.
+        :type current_time: float
+        :returns: None
+        """
+
+        if current_time is None:
+            current_time = time.time()
+
+        while self._running_pids:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+
+            if pid == 0:
+                break
+
+            job = self._running_pids.pop(pid, None)
+            if job is None:
+                # Not one of ours - or a job that was killed
+                continue
+
+            if os.WIFSIGNALED(status):
+                exit_code = -os.WTERMSIG(status)
+            else:
+                exit_code = os.WEXITSTATUS(status)
+
+            job.set_finished(exit_code, current_time)
+            if self.journal is not None:
+                self.journal.put(job.id, dict(end_time=job.end_time,
+                                              exit_code=exit_code))
+            timeout_timer = self._timeout_timers.pop(job, None)
+            if timeout_timer is not None:
+                timeout_timer.cancel()
+            self._running_tags[job.tag] -= 1
+            if job.tag in self.tag_limits:
+                # The tag may have been at its limit
+                self._offer_tag(job.tag)
+            self.running_jobs.discard(job)
+            self.finished_jobs.add(job)
+            print 'REAPED: ', str(job), exit_code, job.duration()
+
+    def _start_job(self, job):
+        job.run_job()
+        self._running_pids[job.popen.pid] = job
+        self._running_tags[job.tag] = self._running_tags.get(job.tag, 0) + 1
+        if job.timeout is not None:
+            self._timeout_timers[job] = self.reactor.call_later(
+                job.timeout, self._timeout_job, job)
+
+    def _job_started(self, job, current_time):
+        """
+        Move a started job on to its next run
+
+        :param job: The job that was started
+        :param current_time: The time of this scheduler tick
+        :type job: Job
+        :type current_time: float
+        """
+
+        job.set_next_run(current_time)
+        if self.journal is not None:
+            self.journal.put(job.id, dict(start_time=job.start_time,
+                                          run_at=job.run_at,
+                                          end_time=None,
+                                          exit_code=None))
+
+    def _timeout_job(self, job):
+        """
+        Kill a job that ran past its timeout. The job is reaped
+        like any other job and keeps its recurring schedule.
+
+        :param job: The job that timed out
+        :type job: Job
+        :returns: None
+        """
+
+        self._timeout_timers.pop(job, None)
+        if job.end_time is None:
+            print 'TIMEOUT: ', str(job)
+            job.timed_out = True
+            job.popen.kill()
+
+    def _queue_job(self, job, current_time):
+        job.queued_at = current_time
+        entry = (-job.priority, current_time, next(self._heap_seq), job)
+        queue = self._ready_queues.setdefault(job.tag, list())
+        heapq.heappush(queue, entry)
+        if queue[0] is entry:
+            self._offer_tag(job.tag)
+
+    def _offer_tag(self, tag, starting_tags=None):
+        """
+        Put the first queued job of a tag in the ready heap if the
+        tag limit allows starting it
+
+        :param tag: The tag
+        :param starting_tags: Count of the jobs being started by tag
+        :type tag: str
+        :type starting_tags: dict
+        :returns: None
+        """
+
+        queue = self._ready_queues.get(tag)
+        if queue and self._can_start(tag, starting_tags or dict()):
+            heapq.heappush(self._ready_heap, queue[0])
+
+    def _can_start(self, tag, starting_tags):
+        """
+        Check the tag concurrency limit
+
+        :param tag: The tag of the job to start
+        :param starting_tags: Count of the jobs being started by tag
+        :type tag: str
+        :type starting_tags: dict
+        :returns: True if a job with the tag can be started
+        :rtype: boolean
+        """
+
+        tag_limit = self.tag_limits.get(tag)
+        if tag_limit is None:
+            return True
+
+        tag_count = self._running_tags.get(tag, 0) + starting_tags.get(tag, 0)
+        return tag_count < tag_limit
+
+    def _admit_jobs(self, current_time):
+        """
+        Take jobs from the ready queues as long as the concurrency
+        limits allow. Only the tags that can start a job are looked
+        at - a tag at its limit does not hold back the other tags and
+        costs nothing however many of its jobs are queued.
+
+        :param current_time: The time of this scheduler tick
+        :type current_time: float
+        :returns: The jobs to start
+        :rtype: set
+        """
+
+        admitted = set()
+        starting_tags = dict()
+        running_count = len(self.running_jobs)
+        heap = self._ready_heap
+        while heap and not (self.max_jobs and running_count >= self.max_jobs):
+            entry = heapq.heappop(heap)
+            job = entry[3]
+            queue = self._ready_queues.get(job.tag)
+            if not queue or queue[0] is not entry:
+                # Stale
+                continue
+
+            # The tag may have reached its limit since it was offered
+            if not self._can_start(job.tag, starting_tags):
+                continue
+
+            heapq.heappop(queue)
+            if not queue:
+                del self._ready_queues[job.tag]
+
+            # A recurring job can expire while it waits
+            if job.recurring() and job.expired(current_time):
+                self._retire_job(job)
+                self._offer_tag(job.tag, starting_tags)
+                continue
+
+            admitted.add(job)
+            running_count += 1
+            starting_tags[job.tag] = starting_tags.get(job.tag, 0) + 1
+            self._offer_tag(job.tag, starting_tags)
+
+            wait_time = current_time - job.queued_at
+            self.queue_wait_count += 1
+            self.queue_wait_total += wait_time
+            self.queue_wait_max = max(self.queue_wait_max, wait_time)
+
+        return admitted
+
+    def queued_jobs(self):
+        """
+        The jobs that are due but wait for a free slot
+
+        :returns: The jobs in the ready queues
+        :rtype: list
+        """
+
+        return [entry[3]
+                for queue in self._ready_queues.itervalues()
+                for entry in queue]
+
+    def queue_wait_stats(self):
+        """
+        Statistics on the time started jobs spent in the ready queue
+
+        :returns: The count, mean and max of the wait times in seconds
+        :rtype: dict
+        """
+
+        mean = 0.0
+        if self.queue_wait_count:
+            mean = self.queue_wait_total / self.queue_wait_count
+
+        return dict(count=self.queue_wait_count,
+                    mean=mean,
+                    max=self.queue_wait_max)
+
+    def add_job(self, job):
+        """
+        Add a job to the pending jobs
+
+        :param job: The job to schedule
+        :type job: Job
+        :returns: None
+        """
+
+        if job.id not in self.jobs:
+            self.jobs[job.id] = job
+            if self.journal is not None:
+                self.journal.put(job.id, job.record())
+
+        self.pending_jobs.add(job)
+        heapq.heappush(self._pending_heap,
+                       (job.run_at, next(self._heap_seq), job))
+
+    def _heap_entry_valid(self, entry):
+        run_at, _, job = entry
+        return job in self.pending_jobs and job.run_at == run_at
+
+    def _peek_pending(self):
+        """
+        The pending job with the earliest run_at
+
+        :returns: The next job due or None if there are no pending jobs
+        :rtype: Job
+        """
+
+        heap = self._pending_heap
+        while heap and not self._heap_entry_valid(heap[0]):
+            heapq.heappop(heap)
+
+        return heap[0][2] if heap else None
+
+    def _pop_due_jobs(self, current_time):
+        """
+        Remove and return the pending jobs due at current_time.
+        Only the due jobs at the top of the heap are touched.
+        Recurring jobs that expired while pending are dropped.
+
+        :param current_time: The time of this scheduler tick
+        :type current_time: float
+        :returns: The jobs that are ready to run
+        :rtype: set
+        """
+
+        due_jobs = set()
+        heap = self._pending_heap
+        while heap and heap[0][0] <= current_time:
+            entry = heapq.heappop(heap)
+            if not self._heap_entry_valid(entry):
+                continue
+
+            job = entry[2]
+            self.pending_jobs.discard(job)
+            if job.ready(current_time):
+                due_jobs.add(job)
+            else:
+                self._retire_job(job)
+
+        return due_jobs
+
     def run_cmd(self, cmd):
         """
         Run a specific command.
@@ -337,8 +1338,17 @@ class Scheduler(object):
         stop_loop = False
         self.stop()
         if cmd == 'KILL':
+            map(self._retire_job, self.jobs.values())
             self.running_jobs.clear()
             self.pending_jobs.clear()
+            self.finished_jobs.clear()
+            self._running_pids.clear()
+            self._running_tags.clear()
+            map(lambda t: t.cancel(), self._timeout_timers.values())
+            self._timeout_timers.clear()
+            del self._pending_heap[:]
+            self._ready_queues.clear()
+            del self._ready_heap[:]
         elif cmd == 'STOP':
             stop_loop = True
         else:
@@ -347,7 +1357,7 @@ class Scheduler(object):
 
         return stop_loop
 
-    def run_jobs(self):
+    def run_jobs(self, current_time=None):
         """
         Main task that selects and runs jobs
 
@@ -355,46 +1365,71 @@ class Scheduler(object):
         1. Remove all the completed jobs and pick the ready jobs
         2. Check is any of the ready jobs are running - for RECURRING
            2.1 Remove those
-        3. Take the rest of the jobs, map them into a process pool of 10
+        3. Queue the rest of the jobs and start as many as the
+           concurrency limits allow (10 at a time by default)
+
+        Pending jobs are kept in a heap ordered by run_at so a tick only
+        touches the jobs that are due. All the time checks in a tick
+        use the same timestamp.
+
+        :param current_time: The time of this tick. Defaults to now.
+        :type current_time: float
         """
 
-        print 'PENDING: ', str(self.pending_jobs)
+        if current_time is None:
+            current_time = time.time()
+
+        print 'PENDING: ', len(self.pending_jobs)
         
-        # Step 1: Get all the finished jobs
-        finished_jobs = set(filter(lambda j: j.started() and j.finished(), self.running_jobs))
+        # Step 1: Reap the finished jobs - this moves them from the
+        # running jobs to the finished jobs
+        self.reap_jobs(current_time)
+        finished_jobs = self.finished_jobs
+        self.finished_jobs = set()
         print 'FINISHED: ', str(finished_jobs)
 
         # Step 2: Get all the recurring jobs that are finished
-        recurring_jobs = set(filter(lambda j: j.recurring() and not j.expired(), finished_jobs))
+        recurring_jobs = set(job for job in finished_jobs
+                             if job.recurring() and
+                             not job.expired(current_time))
         print 'RECURRING: ', str(recurring_jobs)
+        map(self._retire_job, finished_jobs.difference(recurring_jobs))
         
-        # Step 3: Remove the finished jobs from the running jobs
-        self.running_jobs.difference_update(finished_jobs)
-
-        # Step 4: Add the recurring jobs back to the pending jobs
-        self.pending_jobs.update(recurring_jobs)
-        print 'PENDING NOW: ', str(self.pending_jobs)
+        # Step 3: Add the recurring jobs back to the pending jobs
+        map(self.add_job, recurring_jobs)
+        print 'PENDING NOW: ', len(self.pending_jobs)
         
-        # Step 5: Get all the jobs that are ready to run
-        jobs_to_run = set(filter(lambda j: j.ready(), self.pending_jobs))
+        # Step 4: Take the jobs that are due off the top of the heap.
+        # Recurring jobs that expired while pending are dropped here.
+        jobs_to_run = self._pop_due_jobs(current_time)
         print 'TO_RUN: ', str(jobs_to_run)
 
-        # Step 6. Exclude jobs that are already running
-        jobs_to_run.difference_update(self.running_jobs)
-        print 'TO_RUN_1: ', str(jobs_to_run)
+        # Step 5. Exclude jobs that are already running - they
+        # stay pending until the next tick
+        running_to_run = jobs_to_run.intersection(self.running_jobs)
+        jobs_to_run.difference_update(running_to_run)
+        map(self.add_job, running_to_run)
 
-        # Step 7: Remove the jobs ready to run from the pending jobs
-        self.pending_jobs.difference_update(jobs_to_run)
+        # Step 6: Queue the due jobs and take as many as the
+        # concurrency limits allow
+        map(lambda j: self._queue_job(j, current_time), jobs_to_run)
+        jobs_to_run = self._admit_jobs(current_time)
+        print 'TO_RUN_1: ', str(jobs_to_run)
+        print 'QUEUED: ', sum(len(queue) for queue in
+                              self._ready_queues.itervalues()), \
+            self.queue_wait_stats()
 
-        # Step 8: Start all jobs ready to run
-        map(lambda j: j.run_job(), jobs_to_run)
+        # Step 7: Start all jobs ready to run
+        map(self._start_job, jobs_to_run)
 
-        # Step 9: Update the next run time. No effect for onetime jobs
-        map(lambda j: j.set_next_run(), jobs_to_run)
+        # Step 8: Update the next run time. No effect for onetime jobs
+        map(lambda j: self._job_started(j, current_time), jobs_to_run)
 
-        # Step 10: Add the running jobs to the list of running jobs
+        # Step 9: Add the running jobs to the list of running jobs
         self.running_jobs.update(jobs_to_run)
 
+        # Step 10: Make this tick's changes durable
+        self._sync_journal()
 
     def stop(self):
         """
@@ -403,6 +1438,37 @@ class Scheduler(object):
 
         map(lambda j: j.stop(), self.running_jobs)
 
+
+def write_job_file(job_dir, values, name=None):
+    """
+    Write jobs and commands into the job directory as one batch
+    file. The file is written under a temporary name and renamed
+    into place so the scheduler never sees a partial file.
+
+    :param job_dir: The scheduler job directory
+    :param values: The jobs and commands
+    :param name: The file name. Defaults to a unique name.
+    :type job_dir: str
+    :type values: list
+    :type name: str
+    :returns: The path of the job file
+    :rtype: str
+    """
+
+    if name is None:
+        name = uuid.uuid4().hex + '.jsonl'
+
+    tmp_path = os.path.join(job_dir, '.' + name + '.tmp')
+    with open(tmp_path, 'w') as fid:
+        for value in values:
+            fid.write(json.dumps(value))
+            fid.write('\n')
+
+    job_path = os.path.join(job_dir, name)
+    os.rename(tmp_path, job_path)
+    return job_path
+
+
 def main():
     """
     The main function to start the scheduler. 
@@ -424,9 +1490,74 @@ def main():
                         type=int,
                         default=5,
                         help='The poll interval for picking and scheduling jobs')
+    parser.add_argument('--no-inotify',
+                        action='store_false',
+                        dest='use_inotify',
+                        default=True,
+                        help='Poll the job directory instead of using inotify')
+    parser.add_argument('--max-jobs',
+                        action='store',
+                        dest='max_jobs',
+                        type=int,
+                        default=10,
+                        help='The most jobs to run at the same time, '
+                             '0 for no limit')
+    parser.add_argument('--tag-limit',
+                        action='append',
+                        dest='tag_limits',
+                        default=[],
+                        metavar='TAG=N',
+                        help='The most jobs with TAG to run at the same time')
+    parser.add_argument('--control-socket',
+                        action='store',
+                        dest='control_socket',
+                        default=None,
+                        help='Accept job submissions and status requests '
+                             'on this unix socket')
+    parser.add_argument('--http-port',
+                        action='store',
+                        dest='http_port',
+                        type=int,
+                        default=None,
+                        help='Accept job submissions and status requests over '
+                             'HTTP on 127.0.0.1. Off by default. The requests '
+                             'need the token in --http-token-file '
+                             '(Authorization: Bearer <token>).')
+    parser.add_argument('--http-token-file',
+                        action='store',
+                        dest='http_token_file',
+                        default=DEFAULT_HTTP_TOKEN_FILE,
+                        help='Write the HTTP token to this file - its '
+                             'directory is created with mode 0700')
+    parser.add_argument('--journal',
+                        action='store',
+                        dest='journal',
+                        default=None,
+                        help='Keep the jobs in this journal file so they '
+                             'survive a restart')
+    parser.add_argument('--no-fsync',
+                        action='store_false',
+                        dest='fsync',
+                        default=True,
+                        help='Do not sync the journal to disk - it only '
+                             'survives process crashes')
     
     args = parser.parse_args()
-    scheduler = Scheduler(args.jobdir, args.poll_interval)
+    tag_limits = dict()
+    for tag_limit in args.tag_limits:
+        tag, _, limit = tag_limit.rpartition('=')
+        if not tag or not limit.isdigit():
+            parser.error('bad --tag-limit %s' % tag_limit)
+        tag_limits[tag] = int(limit)
+
+    scheduler = Scheduler(args.jobdir, args.poll_interval, args.use_inotify,
+                          args.max_jobs, tag_limits)
+    if args.journal is not None:
+        print 'RECOVERED: ', scheduler.open_journal(args.journal, args.fsync)
+    http_port = scheduler.listen(args.control_socket, args.http_port,
+                                 args.http_token_file)
+    if http_port is not None:
+        print 'HTTP: ', http_port, args.http_token_file
     scheduler.loop_forever()
     
 
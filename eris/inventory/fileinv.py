@@ -1,6 +1,140 @@
+import gc
 import json
+import marshal
+import os
+import tempfile
+import time
 
 from eris.inventory.inventory_base import ErisInventoryBase
+from eris.utils import jsonstream
+from eris.utils import userdir
+
+
+# Bump when the saved inventory state changes shape
+STATE_VERSION = 3
+
+# The marshal format of the saved inventory state
+MARSHAL_VERSION = 2
+
+# A deployment map changed less than this many seconds ago can change
+# again without its size or modification time changing
+RACY_SECONDS = 1
+
+# The groups made from the topology in the deployment map
+# rack_<rack> - the nodes in a rack. Its children are the
+#               bare metal groups of the bare metal nodes in the rack.
+# baremetal_<bare metal> - the VMs on a bare metal node
+RACK_GROUP = 'rack_%s'
+BARE_METAL_GROUP = 'baremetal_%s'
+
+
+def _unmarshal(data):
+    """
+    Unmarshal without the garbage collector. Creating lots of objects
+    sets off collections that walk all of them for nothing.
+    """
+
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return marshal.loads(data)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def _map_stat(map_loc):
+    """
+    The size and the modification time of the deployment map
+    or None if it can't be stat'ed
+    """
+
+    try:
+        map_stat = os.stat(map_loc)
+    except OSError:
+        return None
+    return (map_stat.st_size, map_stat.st_mtime)
+
+
+def _map_lines(map_loc, old_names):
+    """
+    Read a deployment map with one node per line - JSON lines or a
+    JSON array with "[" and "]" on lines of their own and a node on
+    every line in between. A line that was in the map the last time
+    is not parsed again.
+
+    :param map_loc: The deployment map
+    :param old_names: The node names by the lines they were read from
+    :type map_loc: str
+    :type old_names: dict
+    :returns: The name, the line and the node (None if the line was \
+            not parsed) of every node, or None if the map does not \
+            have one node per line
+    :rtype: list
+    :raises IOError: Thrown for error reading file
+    """
+
+    with open(map_loc, 'rb') as fid:
+        lines = [line.strip() for line in fid]
+    lines = [line for line in lines if line]
+
+    if lines and lines[0] == '[':
+        if lines[-1] != ']':
+            return None
+        lines = lines[1:-1]
+        for idx in xrange(len(lines) - 1):
+            if not lines[idx].endswith(','):
+                return None
+            lines[idx] = lines[idx][:-1].rstrip()
+
+    map_nodes = list()
+    for line in lines:
+        name = old_names.get(line)
+        if name is not None:
+            map_nodes.append((name, line, None))
+            continue
+        if not line.startswith('{'):
+            return None
+        try:
+            node = json.loads(line)
+        except ValueError:
+            return None
+        if not isinstance(node, dict):
+            return None
+        map_nodes.append((node['name'], line, node))
+
+    return map_nodes
+
+
+def _node_topology(node):
+    """
+    The topology groups and variables of a deployment map node
+    1. A node with a rack (or a rack node) is in the rack group and
+       has the rack in eris_rack
+    2. A VM on a bare metal node is in the bare metal group and has
+       the bare metal node in eris_bare_metal
+
+    :param node: The deployment map node
+    :type node: dict
+    :returns: The topology groups and the topology variables
+    :rtype: tuple
+    """
+
+    groups = list()
+    host_vars = dict()
+
+    node_type = node.get('type')
+    rack = node['name'] if node_type == 'rack' else node.get('rack')
+    if rack:
+        groups.append(RACK_GROUP % rack)
+        host_vars['eris_rack'] = rack
+
+    bare_metal = node.get('bare-metal')
+    if node_type == 'vm' and bare_metal:
+        groups.append(BARE_METAL_GROUP % bare_metal)
+        host_vars['eris_bare_metal'] = bare_metal
+
+    return groups, host_vars
 
 
 class ErisAnsibleInventory(ErisInventoryBase):
@@ -17,8 +151,10 @@ class ErisAnsibleInventory(ErisInventoryBase):
 
     def _load_deployment_map(self):
         """
-        Load a site deployment map. The site deployment is
-        in the following configuration
+        Load a site deployment map. The map is a JSON array of nodes
+        or JSON lines with one node per line. The nodes are parsed
+        one at a time as they are needed, so the whole map is never
+        in memory. Each node is in the following configuration
         {
             "name": "host_alias",
             "groups": ["group1", "group2",...],
@@ -33,25 +169,122 @@ class ErisAnsibleInventory(ErisInventoryBase):
                 in the eris_inv_config
             }
         }
+        The type, bare-metal and rack make the topology groups
+        (see RACK_GROUP and BARE_METAL_GROUP).
 
-        :returns: List of dict objects
-        :rtype: list
+        :returns: The nodes - the file is read as they are consumed
+        :rtype: generator
         :raises ValueError: Thrown when parsing JSON
         :raises TypeError: Thrown when parsing JSON
         :raises IOError: Thrown for error reading file
         """
 
-        deployment_map = None
         map_loc = self.eris_config['openstack_deployment']['deployment_map']
-        with open(map_loc, 'r') as fid:
-            deployment_map = json.load(fid)
-
-        return deployment_map
+        return jsonstream.iter_json_file(map_loc)
 
     def create_inventory(self):
         """
         Create the entire inventory from the config
         and the deployment map.
+
+        When openstack_deployment has an inventory_state file the
+        inventory is saved there with the line of every node of the
+        deployment map. The next time
+        1. only the saved inventory is read when the size and the
+           modification time of the deployment map are the same
+        2. only the lines that changed are parsed when the map has
+           one node per line (JSON lines or a JSON array with a node
+           on every line) and only the nodes that were added, removed
+           or changed are patched into the saved inventory
+        Other maps are built from scratch whenever they change -
+        parsing the whole map costs about as much as building the
+        inventory, so patching it would not save anything. The
+        inventory is rebuilt from scratch as well when the config or
+        the set of groups changes. Like any cache the state file is
+        only read and written in a private directory (see userdir).
+        """
+
+        deployment = self.eris_config['openstack_deployment']
+        state_path = deployment.get('inventory_state')
+        if state_path is None:
+            self._build_inventory(self._load_deployment_map())
+            return
+
+        # Stat before reading - a map changed after the stat has
+        # another modification time the next time
+        map_stat = _map_stat(deployment['deployment_map'])
+        state = self._load_state(state_path)
+        if (state is not None and map_stat is not None and
+                state['map_stat'] == map_stat):
+            self._set_state(state['inventory'])
+            return
+
+        old_nodes = dict()
+        old_racks = dict()
+        if state is not None and state['nodes'] is not None:
+            old_nodes = state['nodes']
+            old_racks = state['bare_metal_racks']
+        map_nodes = _map_lines(deployment['deployment_map'],
+                               dict((line, name) for name, (line, _)
+                                    in old_nodes.iteritems()))
+        if map_nodes is None:
+            self._build_inventory(self._load_deployment_map())
+            self._save_state(state_path, map_stat, None, None, None)
+            return
+
+        # Keep the line and the groups of every node for the next time.
+        # The rack of every bare metal node is kept as well - it makes
+        # the children of the rack groups. A node that was not parsed
+        # again has the groups and the rack it had the last time.
+        nodes = dict()
+        node_lines = dict()
+        groups = set()
+        bare_metal_racks = dict()
+        duplicates = False
+        for name, line, node in map_nodes:
+            duplicates = duplicates or name in nodes
+            nodes[name] = node
+            if node is None:
+                node_groups = old_nodes[name][1]
+                if name in old_racks:
+                    bare_metal_racks[name] = old_racks[name]
+            else:
+                node_groups = tuple(node['groups']) + tuple(
+                    _node_topology(node)[0])
+                if node.get('type') == 'bare-metal':
+                    bare_metal_racks[name] = node.get('rack')
+            node_lines[name] = (line, node_groups)
+            groups.update(node_groups)
+        groups.update(BARE_METAL_GROUP % name for name in bare_metal_racks)
+
+        # A full build needs all the nodes in map order - a name listed
+        # twice is merged into one host in that order. The nodes that
+        # were not parsed are parsed from their lines.
+        all_nodes = (json.loads(line) if node is None else node
+                     for _, line, node in map_nodes)
+
+        if duplicates:
+            # Merged hosts can't be patched - always rebuild
+            self._build_inventory(all_nodes)
+            self._save_state(state_path, map_stat, None, None, None)
+            return
+
+        if not self._patch_inventory(state, nodes, node_lines, groups,
+                                     bare_metal_racks):
+            self._build_inventory(all_nodes)
+        self._save_state(state_path, map_stat, node_lines, groups,
+                         bare_metal_racks)
+
+    def _build_inventory(self, deployment_map):
+        """
+        Private method
+        DO NOT CALL EXTERNALLY
+
+        Build the entire inventory
+
+        :param deployment_map: The nodes from the deployment map
+        :type deployment_map: iterable
+        :returns: None
         """
 
         # Process other keys first
@@ -62,19 +295,14 @@ class ErisAnsibleInventory(ErisInventoryBase):
                 # Add group only if there are variables under the group
                 if val is not None:
                     self.add_group(key)
-                    for vkey, vval in val.iteritems():
-                        self.add_var_to_group(key, vkey, vval)
+                    self.add_vars_to_group(key, val)
 
         # Now process the openstack deployment
-        # Load the deployment map
-        deployment_map = self._load_deployment_map()
-
         # Add in the localhost
         self.add_group('local')
-        self.add_host('localhost')
-        self.add_var_to_host('localhost', 'ansible_host', '127.0.0.1')
-        self.add_var_to_host('localhost', 'ansible_become', 'false')
-        self.add_var_to_host('localhost', 'ansible_connection', 'local')
+        self.add_hosts({'localhost': dict(ansible_host='127.0.0.1',
+                                          ansible_become='false',
+                                          ansible_connection='local')})
         self.add_host_to_group('local', 'localhost')
 
         # Add in the root group
@@ -86,20 +314,186 @@ class ErisAnsibleInventory(ErisInventoryBase):
         # !!! Important !!!
         # The ssh parameters have to be Ansible inventory compliant
         # TODO: Test this
-        # TODO: Refactor when aggregate modifications are implemented
-        # in ErisInventoryBase
         dep_ssh = self.eris_config['openstack_deployment']['deployment_ssh']
-        for ansible_inv_ssh_var, ansible_inv_ssh_val in dep_ssh.iteritems():
-            self.add_var_to_group(dep_name,
-                                  ansible_inv_ssh_var,
-                                  ansible_inv_ssh_val)
+        self.add_vars_to_group(dep_name, dep_ssh)
 
-        groups_and_hosts = self._add_hosts_to_inventory(deployment_map)
+        groups_and_hosts, bare_metal_racks = self._add_hosts_to_inventory(
+            deployment_map)
         group_expansion = self.eris_config['openstack_deployment']['groups']
         self._create_group_hierarchy(dep_name,
                                      group_expansion,
                                      groups_and_hosts)
 
+        # rack -> bare metal -> VM
+        for bare_metal, rack in bare_metal_racks.iteritems():
+            if rack:
+                self.add_child_to_group(RACK_GROUP % rack,
+                                        BARE_METAL_GROUP % bare_metal)
+
+    def _state_config(self):
+        """
+        The config the inventory is built from - anything
+        but the deployment map contents
+        """
+
+        return json.dumps([self.__class__.__module__,
+                           self.__class__.__name__,
+                           self.eris_config], sort_keys=True)
+
+    def _load_state(self, state_path):
+        """
+        Private method
+        DO NOT CALL EXTERNALLY
+
+        Load the saved inventory state
+
+        :param state_path: The saved inventory state
+        :type state_path: str
+        :returns: The state or None if there is no state saved \
+                for this config
+        :rtype: dict
+        """
+
+        try:
+            userdir.check_private_dir(
+                os.path.dirname(os.path.abspath(state_path)))
+            with open(state_path, 'rb') as fid:
+                state = _unmarshal(fid.read())
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            # A missing, unsafe or corrupt state
+            return None
+
+        if (not isinstance(state, dict) or
+                state.get('version') != STATE_VERSION or
+                state.get('config') != self._state_config()):
+            return None
+        return state
+
+    def _patch_inventory(self, state, nodes, node_lines, groups,
+                         bare_metal_racks):
+        """
+        Private method
+        DO NOT CALL EXTERNALLY
+
+        Patch the saved inventory with the nodes that changed.
+        A node has changed when its line has. The line can change
+        without the node changing (when its keys come in another
+        order) - the node is then patched for nothing.
+
+        :param state: The saved inventory state or None
+        :param nodes: The deployment map nodes by name - None for \
+                the nodes that were not parsed again
+        :param node_lines: The line and groups of the nodes by name
+        :param groups: The groups of the nodes
+        :param bare_metal_racks: The racks of the bare metal nodes
+        :type state: dict
+        :type nodes: dict
+        :type node_lines: dict
+        :type groups: set
+        :type bare_metal_racks: dict
+        :returns: True if the inventory was patched, False if it \
+                has to be built from scratch
+        :rtype: boolean
+        """
+
+        if (state is None or state['nodes'] is None or
+                state['groups'] != groups or
+                state['bare_metal_racks'] != bare_metal_racks):
+            return False
+
+        old_lines = state['nodes']
+        changed_nodes = [nodes[name]
+                         for name, node_line in node_lines.iteritems()
+                         if old_lines.get(name) != node_line]
+        stale_names = [name for name in old_lines
+                       if name not in node_lines]
+        stale_names.extend(node['name'] for node in changed_nodes
+                           if node['name'] in old_lines)
+
+        # Past some point building from scratch is cheaper
+        if len(changed_nodes) + len(stale_names) > len(nodes) / 2:
+            return False
+
+        self._set_state(state['inventory'])
+
+        # Take out the hosts that are gone or changed and
+        # add the changed hosts back in
+        for name in stale_names:
+            for group in old_lines[name][1]:
+                self.inventory[group]['hosts'].discard(name)
+            del self.hosts[name]
+        self._inventory_changed()
+
+        groups_and_hosts, _ = self._add_hosts_to_inventory(changed_nodes)
+        for group, hlist in groups_and_hosts.iteritems():
+            self.add_hosts_to_group(group, hlist)
+
+        return True
+
+    def _save_state(self, state_path, map_stat, node_lines, groups,
+                    bare_metal_racks):
+        """
+        Private method
+        DO NOT CALL EXTERNALLY
+
+        Save the deployment map lines and the inventory for the
+        next time. Failures are not fatal - the inventory is simply
+        built from scratch the next time.
+
+        :param state_path: The inventory state file
+        :param map_stat: The size and modification time of the map
+        :param node_lines: The line and groups of the nodes by name or \
+                None if the map does not have one node per line
+        :param groups: The groups of the nodes
+        :param bare_metal_racks: The racks of the bare metal nodes
+        :type state_path: str
+        :type map_stat: tuple
+        :type node_lines: dict
+        :type groups: set
+        :type bare_metal_racks: dict
+        :returns: None
+        """
+
+        # A map changed just now could change again unnoticed
+        if map_stat is not None and time.time() - map_stat[1] < RACY_SECONDS:
+            map_stat = None
+
+        try:
+            data = marshal.dumps(dict(version=STATE_VERSION,
+                                      config=self._state_config(),
+                                      map_stat=map_stat,
+                                      groups=groups,
+                                      bare_metal_racks=bare_metal_racks,
+                                      nodes=node_lines,
+                                      inventory=self._get_state()),
+                                 MARSHAL_VERSION)
+        except ValueError:
+            # Variables marshal can't write
+            self._remove_state(state_path)
+            return
+
+        state_dir = os.path.dirname(os.path.abspath(state_path))
+        try:
+            userdir.make_private_dir(state_dir)
+            fd, tmp_path = tempfile.mkstemp(dir=state_dir,
+                                            prefix='.inventory-state')
+            try:
+                with os.fdopen(fd, 'wb') as fid:
+                    fid.write(data)
+                os.rename(tmp_path, state_path)
+            except (IOError, OSError):
+                os.remove(tmp_path)
+                raise
+        except (IOError, OSError):
+            return
+
+    @staticmethod
+    def _remove_state(state_path):
+        try:
+            os.remove(state_path)
+        except OSError:
+            pass
+
     def _create_group_hierarchy(self, dep_name,
                                 group_expansion,
                                 groups_and_hosts):
@@ -109,6 +503,13 @@ class ErisAnsibleInventory(ErisInventoryBase):
 
         Create a group hierarchy and add the hosts to the inventory.
 
+        Every host is added once - to the groups it has in the
+        deployment map. A group expansion G: [L1, L2] makes G a child
+        of L1 and L2, so they get the hosts of G through the
+        hierarchy. Expanded groups can be expanded in turn. All the
+        groups are children of the root group. The work is linear in
+        the number of hosts plus the number of expansion edges.
+
         :param dep_name: The root group
         :param group_expansion: Aggregate group expansions
         :param groups_and_hosts: Groups and hosts from deployment map
@@ -116,80 +517,108 @@ class ErisAnsibleInventory(ErisInventoryBase):
         :type group_expansion: dict
         :type groups_and_hosts: dict
         :returns: None
+        :raises ValueError: If the group expansions have a cycle
         """
 
-        # Add in all the children from the service expansion pieces
-        # These are the groups that you want to logically club
-        # together
-        # FIXME: Yuck - an O(n^3) algorithm. Look for efficiency
+        # Add the groups from the deployment map with their hosts.
+        # A group named like the deployment is the root group itself.
         for group, hlist in groups_and_hosts.iteritems():
-            if group in group_expansion:
-                # A whole bunch of processing
-
-                group_list = group_expansion[group]
-
-                # Add the parent group
-                self.add_group(group)
-                self.add_child_to_group(dep_name, group)
-
-                # Add the group_list
-                for l_group in group_list:
-                    self.add_group(l_group)
-                    self.add_child_to_group(group, l_group)
-
-                    # Add all the hosts to l_group
-                    for l_host in hlist:
-                        self.add_host_to_group(l_group, l_host)
-            else:
-                # A standalong group with a bunch of hosts
-
-                # Add in the group
-                self.add_group(group)
-                self.add_child_to_group(dep_name, group)
+            self.add_group(group)
+            self.add_hosts_to_group(group, hlist)
+        self.add_children_to_group(dep_name, [group
+                                              for group in groups_and_hosts
+                                              if group != dep_name])
+
+        # Walk the expansions from the deployment map groups. A group
+        # is done once all the groups it expands to are done, so a
+        # group met again while it is still being walked is a cycle.
+        # Expansions of groups that are never reached are ignored.
+        walking = set()
+        done = set()
+        for group in groups_and_hosts:
+            if group in done:
+                continue
 
-                # Then add the hosts
-                for host in hlist:
-                    self.add_host_to_group(group, host)
+            walking.add(group)
+            stack = [(group, iter(group_expansion.get(group, ())))]
+            while stack:
+                group, l_groups = stack[-1]
+                l_group = next(l_groups, None)
+                if l_group is None:
+                    stack.pop()
+                    walking.discard(group)
+                    done.add(group)
+                    continue
+
+                if l_group in walking:
+                    raise ValueError('Group expansion cycle through %s '
+                                     'and %s' % (group, l_group))
+
+                # l_group gets the hosts of group through the child
+                self.add_group(l_group)
+                if l_group != dep_name:
+                    self.add_child_to_group(dep_name, l_group)
+                self.add_child_to_group(l_group, group)
+
+                if l_group not in done:
+                    walking.add(l_group)
+                    stack.append((l_group,
+                                  iter(group_expansion.get(l_group, ()))))
 
     def _add_hosts_to_inventory(self, deployment_map):
         """
         Private method
         DO NOT CALL EXTERNALLY
 
-        Add hosts to the inventory from the deployment map
+        Add hosts to the inventory from the deployment map. The
+        topology groups are indexed in the same pass - every node is
+        looked at once whatever the number of racks and bare metal
+        nodes.
 
-        :param deployment_map: The deployment map from the config
-        :type deployment_map: list
-        :returns: A dictionary of hosts and group from the deployment
-        :rtype: dict
+        :param deployment_map: The nodes from the deployment map
+        :type deployment_map: iterable
+        :returns: A dictionary of hosts and group from the deployment \
+                and the racks of the bare metal nodes
+        :rtype: tuple
         """
 
-        # TODO: Add code for auto creating groups for racks and bare metal
         # Process the deployment map
         groups_and_hosts = dict()
-        for node in deployment_map:
-            # First add to the hosts
-            hostname = node['name']
-            self.add_host(hostname)
-
-            # Then keep a track of the groups and hosts
-            for group in node['groups']:
-                if group in groups_and_hosts:
-                    groups_and_hosts[group].append(hostname)
-                else:
-                    groups_and_hosts[group] = list([hostname, ])
-
-            # Then add in the ansible ssh variables
-            # ip maps to ansible_host
-            # mac doesn't map to anything - it's just a variable
-            # The rest of the variables are in ansible_ssh_variables
-            self.add_var_to_host(hostname, 'ansible_host', node['ip'])
-            self.add_var_to_host(hostname, 'mac', node['mac'])
-            if 'ansible_ssh_variables' in node:
-                ansible_ssh_vars = node['ansible_ssh_variables']
-                for ansible_ssh_var, ansible_ssh_val in ansible_ssh_vars.iteritems():
-                    self.add_var_to_host(hostname,
-                                         ansible_ssh_var,
-                                         ansible_ssh_val)
-
-        return groups_and_hosts
+        bare_metal_racks = dict()
+
+        def nodes_to_hosts():
+            for node in deployment_map:
+                # Keep a track of the groups and hosts
+                hostname = node['name']
+                topology_groups, topology_vars = _node_topology(node)
+                for group in node['groups']:
+                    if group in groups_and_hosts:
+                        groups_and_hosts[group].append(hostname)
+                    else:
+                        groups_and_hosts[group] = list([hostname, ])
+                for group in topology_groups:
+                    groups_and_hosts.setdefault(group, list()).append(
+                        hostname)
+
+                # A bare metal group even for a bare metal node
+                # without VMs, so it can always be targeted
+                if node.get('type') == 'bare-metal':
+                    bare_metal_racks[hostname] = node.get('rack')
+                    groups_and_hosts.setdefault(BARE_METAL_GROUP % hostname,
+                                                list())
+
+                # Then the ansible ssh variables
+                # ip maps to ansible_host
+                # mac doesn't map to anything - it's just a variable
+                # The rest of the variables are in ansible_ssh_variables.
+                # Those tend to be the same for many hosts so they
+                # are shared between the hosts.
+                host_vars = dict(ansible_host=node['ip'], mac=node['mac'])
+                host_vars.update(topology_vars)
+                yield (hostname, host_vars,
+                       node.get('ansible_ssh_variables'))
+
+        # The hosts are added as the nodes are read
+        self.add_hosts(nodes_to_hosts())
+
+        return groups_and_hosts, bare_metal_racks
@@ -1,9 +1,193 @@
 
+import errno
+import fcntl
 import json
 import subprocess
 import os
+import shlex
+import signal
+import sys
+import tempfile
+import threading
+import time
 
 from eris.inventory import fileinv
+from eris.utils import jsonstream
+from eris.utils import userdir
+
+
+# How the fuel node list is retrieved from the fuel master - set with
+# "transport" in the fuel section of the config
+# 1. ansible - run the fuel command with the ansible raw module
+# 2. ssh - run the fuel command over ssh. The ssh connection is kept
+#    open by an ssh master process (ControlMaster/ControlPersist) so
+#    the inventory builds that follow skip the ssh handshakes through
+#    the jump host. The master sockets are in "ssh_control_dir", a
+#    directory only the user can use - anybody else who can create a
+#    socket there could take over the connection.
+# 3. local - run the fuel command here, on the fuel master
+DEFAULT_TRANSPORT = 'ansible'
+DEFAULT_FUEL_COMMAND = 'fuel node list --json'
+DEFAULT_SSH_CONTROL_DIR = userdir.user_cache_dir('ssh')
+DEFAULT_SSH_CONTROL_PERSIST = 600
+
+_TRUE_VALUES = ('true', 'yes', '1')
+
+# The fuel command is killed if it takes longer than this (seconds).
+# Set with "hard_timeout" in the fuel section of the config.
+DEFAULT_HARD_TIMEOUT = 120
+
+# With "node_cache" in the fuel section of the config the last fuel
+# node list that was retrieved is kept in that file and
+# 1. it is used as is while it is younger than "soft_ttl" seconds
+# 2. once it is older it is still used, and a background process
+#    retrieves a new node list for the next inventory build
+# 3. once it is older than "max_stale" seconds (if set) the node list
+#    is retrieved right away. The old one is used if that fails.
+# So the inventory is built without waiting on the fuel master
+# unless there is no node list yet. The node cache is only used in a
+# private directory (see userdir.check_private_dir) - anybody who can
+# write it chooses the hosts Ansible connects to.
+DEFAULT_SOFT_TTL = 300
+
+
+def _drain(fid):
+    """
+    Read and drop the rest of a pipe so the writer can exit
+    """
+
+    while fid.read(jsonstream.CHUNK_SIZE):
+        pass
+
+
+def _kill_group(proc):
+    """
+    Kill a command started in its own process group along with
+    everything it started (like the ssh under ansible) - any of them
+    could hold on to its output
+    """
+
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def _iter_command_nodes(command, timeout=None):
+    """
+    Run a command and parse the JSON array of nodes in its output as
+    it is written. The array may be surrounded by other text, like
+    the ansible output around the output of the raw module.
+
+    :param command: The command arguments
+    :param timeout: Kill the command after this many seconds
+    :type command: list
+    :type timeout: float
+    :returns: A generator of the nodes
+    :rtype: generator
+    :raises subprocess.CalledProcessError: if the command fails
+    :raises IOError: if the command timed out
+    :raises ValueError: if there is no JSON array in the output \
+            or it cannot be parsed
+    """
+
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE,
+                            preexec_fn=os.setsid)
+
+    # Killing the command ends its output, which ends the parsing
+    timed_out = list()
+    timer = None
+    if timeout:
+        def kill():
+            timed_out.append(True)
+            _kill_group(proc)
+
+        timer = threading.Timer(timeout, kill)
+        timer.daemon = True
+        timer.start()
+
+    try:
+        parse_error = None
+        try:
+            for node in jsonstream.iter_embedded_array(proc.stdout):
+                yield node
+        except ValueError as e:
+            parse_error = e
+
+        _drain(proc.stdout)
+        returncode = proc.wait()
+
+        # A command that failed usually printed no JSON at all -
+        # report the failure rather than the missing JSON
+        if timed_out:
+            raise IOError(errno.ETIMEDOUT,
+                          'Timed out after %s seconds: %s' %
+                          (timeout, ' '.join(command)))
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command)
+        if parse_error is not None:
+            raise parse_error
+    finally:
+        if timer is not None:
+            timer.cancel()
+
+        # Stopped early - nobody reads the output anymore
+        if proc.poll() is None:
+            _kill_group(proc)
+            proc.wait()
+        proc.stdout.close()
+
+
+def _lock_node_cache(cache_path):
+    """
+    Lock the node cache for a refresh. The lock is held until the
+    file descriptor is closed.
+
+    :param cache_path: The node cache file
+    :type cache_path: str
+    :returns: The file descriptor of the lock file or None if \
+            another process holds the lock
+    :rtype: int
+    """
+
+    try:
+        lock_fd = os.open(cache_path + '.lock',
+                          os.O_WRONLY | os.O_CREAT, 0o600)
+    except OSError:
+        return None
+
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        os.close(lock_fd)
+        return None
+    return lock_fd
+
+
+def _refresh_main():
+    """
+    Refresh a node cache - the background process started by
+    _refresh_in_background. The eris config comes in on stdin and
+    the node cache is the only argument.
+
+    :returns: The exit code
+    :rtype: int
+    """
+
+    cache_path = sys.argv[1]
+    eris_config = json.load(sys.stdin)
+    lock_fd = _lock_node_cache(cache_path)
+    if lock_fd is None:
+        # Someone else got to it first
+        return 0
+
+    try:
+        ErisAnsibleInventory(eris_config)._refresh_node_cache(cache_path)
+    except Exception:
+        return 1
+    finally:
+        os.close(lock_fd)
+    return 0
 
 
 class ErisAnsibleInventory(fileinv.ErisAnsibleInventory):
@@ -20,14 +204,151 @@ class ErisAnsibleInventory(fileinv.ErisAnsibleInventory):
         fileinv.ErisAnsibleInventory.
         """
 
-        # 1. Get the fuel node list from fuel
+        # 1. Get the fuel node list from fuel (or the node cache)
         # 2. Convert that to a file list
         # Use regular file processing to handle
+        # The nodes are converted as they are read from the fuel output
+
+        fuel_config = self.eris_config['openstack_deployment']['fuel']
+        cache_path = fuel_config.get('node_cache')
+        if cache_path is None:
+            fuel_node_list = self._iter_fuel_node_list()
+        else:
+            fuel_node_list = self._cached_fuel_node_list(fuel_config,
+                                                         cache_path)
+
+        return self._convert_fuel_to_file_inv(fuel_node_list)
+
+    def _cached_fuel_node_list(self, fuel_config, cache_path):
+        """
+        Private method
+        DO NOT CALL EXTERNALLY
+
+        The fuel node list from the node cache, refreshed as described
+        for DEFAULT_SOFT_TTL
+
+        :param fuel_config: The fuel section of the config
+        :param cache_path: The node cache file
+        :type fuel_config: dict
+        :type cache_path: str
+        :returns: The fuel nodes
+        :rtype: iterable
+        :raises subprocess.CalledProcessError: if there is no node \
+                cache and the fuel command fails
+        :raises IOError: if there is no node cache and the fuel \
+                command times out
+        """
+
+        try:
+            userdir.check_private_dir(
+                os.path.dirname(os.path.abspath(cache_path)))
+            age = time.time() - os.stat(cache_path).st_mtime
+        except OSError:
+            # No node cache or one that others could have written
+            age = None
+
+        if age is not None:
+            if age < fuel_config.get('soft_ttl', DEFAULT_SOFT_TTL):
+                return jsonstream.iter_json_file(cache_path)
+
+            max_stale = fuel_config.get('max_stale')
+            if max_stale is None or age < max_stale:
+                self._refresh_in_background(cache_path)
+                return jsonstream.iter_json_file(cache_path)
+
+        try:
+            return self._refresh_node_cache(cache_path)
+        except (subprocess.CalledProcessError, IOError, OSError,
+                ValueError):
+            if age is None:
+                raise
+            # The last known good node list
+            return jsonstream.iter_json_file(cache_path)
+
+    def _refresh_node_cache(self, cache_path):
+        """
+        Private method
+        DO NOT CALL EXTERNALLY
+
+        Get the fuel node list and save it in the node cache. The file
+        is written under another name and renamed into place, so a
+        failed retrieval never replaces a good node list. It is not
+        saved in a directory that is not private.
+
+        :param cache_path: The node cache file
+        :type cache_path: str
+        :returns: The fuel nodes
+        :rtype: list
+        """
 
         fuel_node_list = self._get_fuel_node_list()
-        deployment_map = self._convert_fuel_to_file_inv(fuel_node_list)
 
-        return deployment_map
+        cache_dir = os.path.dirname(os.path.abspath(cache_path))
+        try:
+            userdir.make_private_dir(cache_dir)
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir,
+                                            prefix='.fuel-nodes')
+            try:
+                with os.fdopen(fd, 'w') as fid:
+                    json.dump(fuel_node_list, fid)
+                os.rename(tmp_path, cache_path)
+            except (IOError, OSError, ValueError):
+                os.remove(tmp_path)
+                raise
+        except (IOError, OSError, ValueError):
+            # Retrieved all the same - try to save it the next time
+            pass
+
+        return fuel_node_list
+
+    def _refresh_in_background(self, cache_path):
+        """
+        Private method
+        DO NOT CALL EXTERNALLY
+
+        Refresh the node cache in a background process. A lock file
+        next to the node cache makes sure only one process refreshes
+        it at a time - nothing is started if one is running already.
+
+        The refresh is a new python process rather than a fork - this
+        can run in a thread of multiinv and a fork would copy the locks
+        the other threads hold. It is in its own session with its
+        output on /dev/null. Ansible reads the inventory until the end
+        of the output, so a process with the output open would make
+        Ansible wait for it.
+
+        :param cache_path: The node cache file
+        :type cache_path: str
+        :returns: True if a refresh was started
+        :rtype: boolean
+        """
+
+        # The refresh takes the lock itself - this only saves starting
+        # it when a refresh is running already
+        lock_fd = _lock_node_cache(cache_path)
+        if lock_fd is None:
+            return False
+        os.close(lock_fd)
+
+        # The package may not be on the path of a new python
+        package_root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [package_root] + filter(None, [env.get('PYTHONPATH')]))
+
+        try:
+            with open(os.devnull, 'r+') as null_fid:
+                proc = subprocess.Popen(
+                    [sys.executable, '-m', __name__,
+                     os.path.abspath(cache_path)],
+                    stdin=subprocess.PIPE, stdout=null_fid, stderr=null_fid,
+                    close_fds=True, preexec_fn=os.setsid, env=env)
+            proc.stdin.write(json.dumps(self.eris_config))
+            proc.stdin.close()
+        except (IOError, OSError):
+            return False
+        return True
 
     def _get_fuel_node_list(self):
         """
@@ -37,69 +358,130 @@ class ErisAnsibleInventory(fileinv.ErisAnsibleInventory):
         :rtype: list
         :raises subprocess.CalledProcessError: if there are issues \
                 calling the subprocess ssh
-        :raises ValueError: if the JSON cannot be parsed or if a fuel \
-                node is not provided in the config
+        :raises ValueError: if the JSON cannot be parsed, if a fuel \
+                node is not provided in the config or if the \
+                transport is unknown
         :raises TypeError: if the JSON cannot be parsed
         """
 
-        # Create initial fuel inventory file as an ini file in /tmp
-        # Use ansible to retrieve the inventory via the raw module
-        # ignore the first and last lines of the ansible output
-        # the rest is the fuel json
+        return list(self._iter_fuel_node_list())
 
+    def _iter_fuel_node_list(self):
+        """
+        Private method
+        DO NOT CALL EXTERNALLY
+
+        Get the fuel nodes from the fuel server one at a time as
+        they are parsed out of the fuel output. See _get_fuel_node_list.
+        """
+
+        fuel_config = self.eris_config['openstack_deployment']['fuel']
+        transport = fuel_config.get('transport', DEFAULT_TRANSPORT)
+        ini_path = None
         try:
-            fuel_config = self.eris_config['openstack_deployment']['fuel']
-            fuel_ansible_ssh = fuel_config['ansible_ssh_variables']
-            fuel_inv_str = 'fuel_host '
-            fuel_inv_str += 'ansible_host=' + fuel_config['ip'] + ' '
-            for fuel_ansible_var, fuel_ansible_val in fuel_ansible_ssh.iteritems():
-                quoted_val = fuel_ansible_val
-                if fuel_ansible_val.rfind(' ') >= 0:
-                    quoted_val = "'" + fuel_ansible_val + "'"
-                fuel_inv_str += fuel_ansible_var + '=' + quoted_val + ' '
-
-            fid = open('/tmp/eris_fuel.ini', 'w')
-            fid.write(fuel_inv_str)
-            fid.close()
-
-            ansible_command = ['ansible',
-                               'fuel_host',
-                               '-i',
-                               '/tmp/eris_fuel.ini',
-                               '-m',
-                               'raw',
-                               '-a',
-                               'fuel node list --json']
-            command_output = subprocess.check_output(ansible_command)
-
-            # Output is in the following format
-            # <Ansible output><json list><Ansible output>\n\n
-            # Format the output lines into a valid JSON
-            output_lines = command_output.split('\n')
-
-            # Pop all text until we hit the beginning of the json list
-            while (output_lines is not None and
-                    len(output_lines) > 1 and
-                    output_lines[0].strip() != '['):
-                output_lines.pop(0)
-
-            # Pop all text from the end until we hit thie end of the json list
-            while (output_lines is not None and
-                    len(output_lines) > 1 and
-                    output_lines[len(output_lines) - 1].strip() != ']'):
-                output_lines.pop(len(output_lines) - 1)
-
-            json_str = '\n'.join(output_lines)
-
-            node_list = json.loads(json_str)
-            return node_list
+            if transport == 'ansible':
+                # One file per call - several fuel inventories can be
+                # built at the same time (see multiinv)
+                fd, ini_path = tempfile.mkstemp(prefix='eris_fuel',
+                                                suffix='.ini')
+                os.close(fd)
+                command = self._ansible_command(fuel_config, ini_path)
+            elif transport in ('ssh', 'local'):
+                command = self._fuel_command(fuel_config, transport)
+            else:
+                raise ValueError('Unknown fuel transport %s' % transport)
+
+            timeout = fuel_config.get('hard_timeout', DEFAULT_HARD_TIMEOUT)
+            for node in _iter_command_nodes(command, timeout):
+                yield node
         finally:
-            try:
-                os.remove('/tmp/eris_fuel.ini')
-            except:
-                pass
-            finally:
-                pass
+            if ini_path is not None:
+                try:
+                    os.remove(ini_path)
+                except OSError:
+                    pass
+
+    def _fuel_command(self, fuel_config, transport):
+        """
+        Private method
+        DO NOT CALL EXTERNALLY
+
+        The command that prints the fuel node list - the fuel
+        command itself or ssh to the fuel master running it
+
+        :param fuel_config: The fuel section of the config
+        :param transport: ssh or local
+        :type fuel_config: dict
+        :type transport: str
+        :returns: The command arguments
+        :rtype: list
+        :raises OSError: if the ssh control directory is not private \
+                (see userdir.check_private_dir)
+        """
+
+        fuel_command = fuel_config.get('fuel_command', DEFAULT_FUEL_COMMAND)
+        if transport == 'local':
+            return shlex.split(fuel_command)
+
+        ssh_vars = fuel_config['ansible_ssh_variables']
+        control_dir = os.path.expanduser(fuel_config.get(
+            'ssh_control_dir', DEFAULT_SSH_CONTROL_DIR))
+        userdir.make_private_dir(control_dir)
+
+        # Reuse (or start) the master connection for this user, host
+        # and port. ssh expands %C to a hash of them.
+        command = ['ssh',
+                   '-o', 'BatchMode=yes',
+                   '-o', 'ControlMaster=auto',
+                   '-o', 'ControlPersist=%d' % fuel_config.get(
+                       'ssh_control_persist', DEFAULT_SSH_CONTROL_PERSIST),
+                   '-o', 'ControlPath=%s' % os.path.join(control_dir, '%C')]
+        if 'ansible_user' in ssh_vars:
+            command.extend(['-l', ssh_vars['ansible_user']])
+        if 'ansible_port' in ssh_vars:
+            command.extend(['-p', str(ssh_vars['ansible_port'])])
+        if 'ansible_ssh_private_key_file' in ssh_vars:
+            command.extend(['-i', ssh_vars['ansible_ssh_private_key_file']])
+        command.extend(shlex.split(ssh_vars.get('ansible_ssh_common_args',
+                                                '')))
+
+        # Like ansible - become root with sudo
+        if str(ssh_vars.get('ansible_become')).lower() in _TRUE_VALUES:
+            fuel_command = 'sudo -n ' + fuel_command
+
+        command.extend([fuel_config['ip'], fuel_command])
+        return command
+
+    def _ansible_command(self, fuel_config, ini_path):
+        """
+        Private method
+        DO NOT CALL EXTERNALLY
+
+        Write the fuel master into an ini inventory file and return
+        the ansible command that runs the fuel command with the raw
+        module. The fuel JSON is in the middle of the ansible output.
+        """
+
+        fuel_ansible_ssh = fuel_config['ansible_ssh_variables']
+        fuel_inv_str = 'fuel_host '
+        fuel_inv_str += 'ansible_host=' + fuel_config['ip'] + ' '
+        for fuel_ansible_var, fuel_ansible_val in fuel_ansible_ssh.iteritems():
+            quoted_val = fuel_ansible_val
+            if fuel_ansible_val.rfind(' ') >= 0:
+                quoted_val = "'" + fuel_ansible_val + "'"
+            fuel_inv_str += fuel_ansible_var + '=' + quoted_val + ' '
+
+        with open(ini_path, 'w') as fid:
+            fid.write(fuel_inv_str)
+
+        return ['ansible',
+                'fuel_host',
+                '-i',
+                ini_path,
+                '-m',
+                'raw',
+                '-a',
+                fuel_config.get('fuel_command', DEFAULT_FUEL_COMMAND)]
 
     def _convert_fuel_to_file_inv(self, fuel_node_list):
         """
@@ -108,13 +490,12 @@ class ErisAnsibleInventory(fileinv.ErisAnsibleInventory):
         That way all the fileinv operations can be reused for
         fuelinv
 
-        :param fuel_node_list: A list of fuel managed nodes
-        :type fuel_node_list: list
-        :returns: A list of nodes in fileinv specification
-        :rtype: list
+        :param fuel_node_list: The fuel managed nodes
+        :type fuel_node_list: iterable
+        :returns: A generator of nodes in fileinv specification
+        :rtype: generator
         """
 
-        new_node_list = list()
         for node in fuel_node_list:
             # Pop values we don't need
             if node['status'] == 'discover' or node['online'] is False:
@@ -131,7 +512,7 @@ class ErisAnsibleInventory(fileinv.ErisAnsibleInventory):
             groups = group_list.split(',')
             group_list = [group.strip() for group in groups]
             node['groups'] = group_list
-            new_node_list.append(node)
+            yield node
 
         # Finally add the fuel node in
         fuel_node_config = self.eris_config['openstack_deployment']['fuel']
@@ -139,7 +520,10 @@ class ErisAnsibleInventory(fileinv.ErisAnsibleInventory):
                          groups=['grpfuel', ],
                          ip=fuel_node_config['ip'],
                          mac=fuel_node_config['mac'],
-                         ansible_ssh_variables=fuel_node_config['ansible_ssh_variables'])
-        new_node_list.append(fuel_node)
+                         ansible_ssh_variables=fuel_node_config[
+                             'ansible_ssh_variables'])
+        yield fuel_node
+
 
-        return new_node_list
+if __name__ == '__main__':
+    sys.exit(_refresh_main())
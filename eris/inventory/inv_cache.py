@@ -0,0 +1,230 @@
+
+"""
+On-disk cache for the serialized dynamic inventory.
+
+Ansible runs the dynamic inventory script for every ansible or
+ansible-playbook invocation. Building the inventory can be expensive
+(the fuel plugin, for example, has to ssh into the fuel master), so
+the serialized inventory is stored on disk and reused for as long as
+the sources it was built from have not changed and the entry has not
+outlived its time to live.
+
+The cache is configured with an optional section in the eris config
+{
+    "inventory_cache": {
+        "cache_dir": "~/.cache/eris/inventory",
+        "ttl": 300
+    }
+}
+The cache directory defaults to the cache directory of the user. It
+is created with mode 0700 and not used at all unless it belongs to
+the user and has mode 0700 - anybody who can plant an entry there
+chooses the commands Ansible runs.
+"""
+
+# System imports
+import hashlib
+import os
+import time
+
+from eris.utils import userdir
+
+
+DEFAULT_CACHE_DIR = userdir.user_cache_dir('inventory')
+DEFAULT_TTL = 300
+CACHE_PREFIX = 'inventory-'
+CACHE_SUFFIX = '.json'
+
+
+def _deployment_maps(config):
+    """
+    The deployment maps of a config and, for a multi inventory, of all
+    its inventory_sources (which can be multi inventories themselves)
+
+    :param config: The parsed eris config or the config of a source
+    :type config: dict
+    :returns: The deployment map locations
+    :rtype: generator
+    """
+
+    deployment = config.get('openstack_deployment') or dict()
+    if deployment.get('deployment_map') is not None:
+        yield deployment['deployment_map']
+    for source_config in config.get('inventory_sources') or ():
+        for map_loc in _deployment_maps(source_config):
+            yield map_loc
+
+
+class InventoryCache(object):
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, ttl=DEFAULT_TTL):
+        """
+        Create an inventory cache
+
+        :param cache_dir: The directory where cache entries are stored
+        :param ttl: Time to live of a cache entry in seconds. \
+                A ttl of 0 or less disables the cache.
+        :type cache_dir: str
+        :type ttl: int
+        """
+
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.ttl = ttl
+
+    @classmethod
+    def from_config(cls, cache_config):
+        """
+        Create the cache from the inventory_cache section
+        of the eris config.
+
+        :param cache_config: The inventory_cache section or None
+        :type cache_config: dict
+        :returns: The cache object or None if caching is not configured
+        :rtype: InventoryCache
+        """
+
+        if cache_config is None:
+            return None
+
+        return cls(cache_config.get('cache_dir', DEFAULT_CACHE_DIR),
+                   cache_config.get('ttl', DEFAULT_TTL))
+
+    def enabled(self):
+        """
+        Is the cache enabled at all
+
+        :returns: True if entries can be stored and retrieved
+        :rtype: boolean
+        """
+
+        return self.ttl > 0
+
+    @staticmethod
+    def fingerprint(config_data, config, inventory_plugin):
+        """
+        Compute the fingerprint of the inventory sources. The fingerprint
+        changes whenever the config file contents, the inventory plugin
+        or a deployment map (size and modification time) change. The
+        deployment maps of all the inventory_sources of a multi
+        inventory count too.
+
+        :param config_data: The raw contents of the eris config file
+        :param config: The parsed eris config
+        :param inventory_plugin: The inventory plugin module name
+        :type config_data: str
+        :type config: dict
+        :type inventory_plugin: str
+        :returns: A hex digest identifying the inventory sources
+        :rtype: str
+        """
+
+        digest = hashlib.sha1()
+        digest.update(config_data)
+        digest.update('\0' + inventory_plugin)
+
+        # Stat rather than hash the deployment maps - a stat is constant
+        # time no matter how large the deployment map gets
+        for map_loc in _deployment_maps(config):
+            try:
+                map_stat = os.stat(map_loc)
+                digest.update('\0%s\0%d\0%r' % (map_loc,
+                                                map_stat.st_size,
+                                                map_stat.st_mtime))
+            except OSError:
+                digest.update('\0%s\0missing' % map_loc)
+
+        return digest.hexdigest()
+
+    def _entry_path(self, fingerprint):
+        return os.path.join(self.cache_dir,
+                            CACHE_PREFIX + fingerprint + CACHE_SUFFIX)
+
+    def get(self, fingerprint):
+        """
+        Get the cached inventory for a fingerprint
+
+        :param fingerprint: The fingerprint of the inventory sources
+        :type fingerprint: str
+        :returns: The serialized inventory or None if there is no \
+                fresh entry in the cache
+        :rtype: str
+        """
+
+        if not self.enabled():
+            return None
+
+        entry_path = self._entry_path(fingerprint)
+        try:
+            userdir.check_private_dir(self.cache_dir)
+            with open(entry_path, 'r') as fid:
+                if time.time() - os.fstat(fid.fileno()).st_mtime > self.ttl:
+                    return None
+                return fid.read()
+        except (IOError, OSError):
+            return None
+
+    def put(self, fingerprint, inventory_json):
+        """
+        Store the serialized inventory for a fingerprint. The entry is
+        written to a temporary file and renamed into place so concurrent
+        readers never see a partially written inventory. Entries for
+        other fingerprints are removed. Failures to write the cache are
+        not fatal - the inventory is simply rebuilt the next time.
+
+        :param fingerprint: The fingerprint of the inventory sources
+        :param inventory_json: The serialized inventory
+        :type fingerprint: str
+        :type inventory_json: str
+        :returns: None
+        """
+
+        if not self.enabled():
+            return
+
+        # Only needed on a miss - keep it off the cache hit path
+        import tempfile
+
+        try:
+            userdir.make_private_dir(self.cache_dir)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir,
+                                            prefix='.' + CACHE_PREFIX)
+            try:
+                with os.fdopen(fd, 'w') as fid:
+                    fid.write(inventory_json)
+                os.rename(tmp_path, self._entry_path(fingerprint))
+            except (IOError, OSError):
+                os.remove(tmp_path)
+                raise
+        except (IOError, OSError):
+            return
+
+        self._prune(fingerprint)
+
+    def invalidate(self):
+        """
+        Remove all the entries from the cache
+
+        :returns: None
+        """
+
+        self._prune(None)
+
+    def _prune(self, keep_fingerprint):
+        keep_name = None
+        if keep_fingerprint is not None:
+            keep_name = CACHE_PREFIX + keep_fingerprint + CACHE_SUFFIX
+
+        try:
+            userdir.check_private_dir(self.cache_dir)
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return
+
+        for name in names:
+            if (name != keep_name and
+                    name.startswith(CACHE_PREFIX) and
+                    name.endswith(CACHE_SUFFIX)):
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
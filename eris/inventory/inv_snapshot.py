@@ -0,0 +1,221 @@
+"""
+Indexed on-disk snapshot of the last inventory.
+
+Ansible asks the dynamic inventory for one host with --host and our
+tools ask for one group with --group. Answering either from the
+serialized inventory means parsing all of it, so the hosts and
+groups of the last inventory built are also written to a sqlite
+database keyed by name. A lookup is then an index probe that takes
+the same few milliseconds no matter how large the inventory is.
+
+The snapshot remembers the fingerprint of the inventory sources
+(see inv_cache) and is only used while the fingerprint matches and
+for ttl seconds after it was built. The fingerprint never changes for
+sources like fuel whose nodes are not in a local file, so without the
+ttl the snapshot would be served forever.
+
+The snapshot is configured with an optional section in the eris config
+{
+    "inventory_snapshot": {
+        "path": "~/.cache/eris/inventory/inventory.db",
+        "ttl": 300
+    }
+}
+Like the inventory cache the snapshot defaults to the cache directory
+of the user, and its directory is created with mode 0700 and not used
+at all unless it belongs to the user and has mode 0700.
+"""
+
+# System imports
+import os
+import sqlite3
+import time
+
+from eris.utils import userdir
+
+
+DEFAULT_PATH = userdir.user_cache_dir('inventory', 'inventory.db')
+DEFAULT_TTL = 300
+SNAPSHOT_VERSION = '2'
+
+_SCHEMA = (
+    'CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)',
+    'CREATE TABLE hosts (name TEXT PRIMARY KEY, vars TEXT)',
+    'CREATE TABLE groups (name TEXT PRIMARY KEY, data TEXT)',
+)
+
+# The queries by kind of lookup
+_LOOKUPS = {
+    'host': 'SELECT vars FROM hosts WHERE name = ?',
+    'group': 'SELECT data FROM groups WHERE name = ?',
+}
+
+
+class InventorySnapshot(object):
+
+    def __init__(self, path=DEFAULT_PATH, ttl=DEFAULT_TTL):
+        """
+        Create an inventory snapshot
+
+        :param path: The sqlite database file
+        :param ttl: How long a snapshot is used in seconds. \
+                None uses it for as long as the fingerprint matches.
+        :type path: str
+        :type ttl: int
+        """
+
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+
+    @classmethod
+    def from_config(cls, snapshot_config):
+        """
+        Create the snapshot from the inventory_snapshot section
+        of the eris config.
+
+        :param snapshot_config: The inventory_snapshot section or None
+        :type snapshot_config: dict
+        :returns: The snapshot object or None if it is not configured
+        :rtype: InventorySnapshot
+        """
+
+        if snapshot_config is None:
+            return None
+
+        return cls(snapshot_config.get('path', DEFAULT_PATH),
+                   snapshot_config.get('ttl', DEFAULT_TTL))
+
+    def lookup(self, fingerprint, kind, name):
+        """
+        Look up a host or a group in the snapshot
+
+        :param fingerprint: The fingerprint of the inventory sources
+        :param kind: 'host' or 'group'
+        :param name: The host or group name
+        :type fingerprint: str
+        :type kind: str
+        :type name: str
+        :returns: The host variables or the group as JSON, '{}' if the \
+                snapshot has no such host or group, or None if there \
+                is no usable snapshot for the fingerprint or it has \
+                expired
+        :rtype: str
+        :raises ValueError: if the kind is not host or group
+        """
+
+        if kind not in _LOOKUPS:
+            raise ValueError('Unknown lookup %s' % kind)
+
+        # Connecting would create an empty database
+        try:
+            userdir.check_private_dir(os.path.dirname(
+                os.path.abspath(self.path)))
+        except OSError:
+            return None
+        if not os.path.isfile(self.path):
+            return None
+
+        try:
+            conn = sqlite3.connect(self.path)
+            try:
+                meta = dict(conn.execute('SELECT key, value FROM meta'))
+                if (meta.get('version') != SNAPSHOT_VERSION or
+                        meta.get('fingerprint') != fingerprint or
+                        self._expired(meta.get('built_at'))):
+                    return None
+
+                row = conn.execute(_LOOKUPS[kind], (name,)).fetchone()
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            return None
+
+        if row is None:
+            return '{}'
+        return row[0].encode('utf-8')
+
+    def _expired(self, built_at):
+        """
+        Private method
+        DO NOT CALL EXTERNALLY
+
+        Is a snapshot built at this time (a string) too old to use
+        """
+
+        if self.ttl is None:
+            return False
+        try:
+            return time.time() - float(built_at) > self.ttl
+        except (TypeError, ValueError):
+            return True
+
+    def put(self, fingerprint, inventory_obj):
+        """
+        Replace the snapshot with the hosts and groups of an inventory.
+        The database is built in a temporary file and renamed into
+        place so concurrent lookups never see a partial snapshot.
+        Failures to write the snapshot are not fatal - the lookups
+        simply build the inventory until the next put.
+
+        :param fingerprint: The fingerprint of the inventory sources
+        :param inventory_obj: The inventory that was built
+        :type fingerprint: str
+        :type inventory_obj: ErisInventoryBase
+        :returns: None
+        """
+
+        # Only needed to write - keep them off the lookup path
+        import tempfile
+        from eris.inventory import inventory_base
+
+        snapshot_dir = os.path.dirname(os.path.abspath(self.path))
+        try:
+            userdir.make_private_dir(snapshot_dir)
+
+            fd, tmp_path = tempfile.mkstemp(dir=snapshot_dir,
+                                            prefix='.inventory-snapshot')
+            os.close(fd)
+            try:
+                self._write(tmp_path, fingerprint, inventory_obj,
+                            inventory_base._dumps)
+                os.rename(tmp_path, self.path)
+            except (IOError, OSError, sqlite3.Error):
+                os.remove(tmp_path)
+                raise
+        except (IOError, OSError, sqlite3.Error):
+            return
+
+    @staticmethod
+    def _write(path, fingerprint, inventory_obj, dumps):
+        """
+        Private method
+        DO NOT CALL EXTERNALLY
+
+        Write the snapshot database
+        """
+
+        conn = sqlite3.connect(path)
+        try:
+            # The file is renamed into place only once it is complete
+            conn.execute('PRAGMA journal_mode = OFF')
+            conn.execute('PRAGMA synchronous = OFF')
+            for statement in _SCHEMA:
+                conn.execute(statement)
+
+            conn.executemany('INSERT INTO meta VALUES (?, ?)',
+                             [('version', SNAPSHOT_VERSION),
+                              ('fingerprint', fingerprint),
+                              ('built_at', repr(time.time()))])
+
+            hosts = ((host_name, dumps(host.get_vars()))
+                     for host_name, host in inventory_obj.hosts.iteritems())
+            conn.executemany('INSERT INTO hosts VALUES (?, ?)', hosts)
+
+            groups = ((group_name,
+                       dumps(inventory_obj.get_group(group_name)))
+                      for group_name in inventory_obj.inventory)
+            conn.executemany('INSERT INTO groups VALUES (?, ?)', groups)
+
+            conn.commit()
+        finally:
+            conn.close()
@@ -9,8 +9,68 @@ not very well documented.
 """
 
 # System imports
+import fnmatch
 import json
 
+from eris.inventory import selector
+
+# Optional faster JSON encoder for the compact output
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+_NO_NAMES = ()
+
+# How many hosts are encoded at a time when streaming
+_STREAM_BATCH = 1000
+
+
+def _dumps(obj):
+    """
+    Encode compact JSON with the fastest encoder available
+    """
+
+    if ujson is not None:
+        return ujson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':'))
+
+
+class _Host(object):
+    """
+    Private class
+    DO NOT USE EXTERNALLY
+
+    A host in the inventory. Large inventories have a lot of hosts
+    with a few variables each, so a host is kept compactly
+    1. names - a tuple of the host variable names. It is shared by
+       all the hosts with the same variable names.
+    2. values - a tuple of the variable values in the same order
+    3. shared - a dict of variables shared with other hosts that
+       have the same values (like the ssh variables) or None.
+       The host variables override the shared variables.
+    """
+
+    __slots__ = ('names', 'values', 'shared')
+
+    def __init__(self):
+        self.names = _NO_NAMES
+        self.values = _NO_NAMES
+        self.shared = None
+
+    def get_vars(self):
+        """
+        The host variables as a dict
+
+        :returns: A new dict with all the variables
+        :rtype: dict
+        """
+
+        host_vars = dict(self.shared) if self.shared else dict()
+        host_vars.update(zip(self.names, self.values))
+        return host_vars
+
 
 class ErisInventoryBase(object):
 
@@ -21,12 +81,317 @@ class ErisInventoryBase(object):
         for more details. But at a minimum the _meta
         and hostvars are initialized
 
+        The groups are kept in the Ansible shape. The hosts are kept
+        compactly (see _Host) and are expanded into _meta.hostvars
+        only when the inventory is serialized. Host, group and
+        variable names are interned so that every name is stored once.
+
         :param eris_config: The eris config data
         :type eris_config: dict
         """
 
-        self.inventory = dict(_meta=dict(hostvars=dict()))
+        self.inventory = dict()
+        self.hosts = dict()
         self.eris_config = eris_config
+        self._interned = dict()
+        self._shared_vars = dict()
+
+        # The indexes select_hosts builds as it needs them. Any change
+        # to the hosts or the groups drops them.
+        self._indexes = None
+
+        # The transitive closure of the groups - all the descendant
+        # groups and all the hosts of a group. They are worked out for
+        # a group when they are first asked for and kept until the
+        # group or one of its descendants changes. A group is only
+        # kept if all its descendants are, so dropping a group and
+        # its kept ancestors drops everything that depends on it.
+        self._group_descendants = dict()
+        self._group_hosts = dict()
+        self._parents = None
+
+    def _inventory_changed(self):
+        """
+        Drop the select_hosts indexes and the group closure - call
+        after changing the hosts or the groups other than through
+        the add methods
+        """
+
+        self._indexes = None
+        self._group_descendants = dict()
+        self._group_hosts = dict()
+        self._parents = None
+
+    def _group_parents(self):
+        """
+        Private method
+        DO NOT CALL EXTERNALLY
+
+        The parent groups of every group - worked out from the
+        children when first needed and kept up by the add methods
+        """
+
+        if self._parents is None:
+            parents = dict()
+            for group_name, group in self.inventory.iteritems():
+                for child in group['children']:
+                    parents.setdefault(child, set()).add(group_name)
+            self._parents = parents
+        return self._parents
+
+    def _group_changed(self, group_name, children=False):
+        """
+        Private method
+        DO NOT CALL EXTERNALLY
+
+        Drop what depends on the hosts (or the children) of a group -
+        the select_hosts indexes and the closure of the group and of
+        its ancestors. Only the ancestors that are kept are walked.
+
+        :param group_name: The group that changed
+        :param children: True if its children changed
+        :type group_name: str
+        :type children: boolean
+        :returns: None
+        """
+
+        self._indexes = None
+        if not self._group_hosts and not (children and
+                                          self._group_descendants):
+            return
+
+        parents = self._group_parents()
+        seen = set()
+        stack = [group_name]
+        while stack:
+            group = stack.pop()
+            if group in seen:
+                continue
+            seen.add(group)
+            kept = self._group_hosts.pop(group, None) is not None
+            if children:
+                kept = (self._group_descendants.pop(group, None)
+                        is not None) or kept
+            if kept:
+                stack.extend(parents.get(group, ()))
+
+    def _closure(self, group_name, closure, own):
+        """
+        Private method
+        DO NOT CALL EXTERNALLY
+
+        Work out the closure of a group and of the descendants that
+        are not kept yet - what the group has itself and what all
+        its children have
+
+        :param group_name: The group name
+        :param closure: The kept closure
+        :param own: What a group has itself - 'hosts' or 'children'
+        :type group_name: str
+        :type closure: dict
+        :type own: str
+        :returns: The closure of the group
+        :rtype: frozenset
+        :raises ValueError: If the group children have a cycle
+        """
+
+        members = closure.get(group_name)
+        if members is not None:
+            return members
+
+        # A group is done once all its children are done, so a group
+        # met again while it is still being walked is a cycle. The
+        # add methods refuse cycles - this only catches groups that
+        # were changed some other way.
+        inventory = self.inventory
+        walking = set([group_name])
+        stack = [(group_name, iter(inventory[group_name]['children']))]
+        while stack:
+            group, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                walking.discard(group)
+                group_children = inventory[group]['children']
+                closure[group] = frozenset().union(
+                    inventory[group][own],
+                    *[closure[group_child]
+                      for group_child in group_children])
+                continue
+
+            if child in closure:
+                continue
+            if child in walking:
+                raise ValueError('Group cycle through %s and %s' %
+                                 (group, child))
+            walking.add(child)
+            stack.append((child, iter(inventory[child]['children'])))
+
+        return closure[group_name]
+
+    def get_group_descendants(self, group_name):
+        """
+        Get all the descendant groups of a group - its children,
+        their children and so on. Worked out on first use and kept
+        until the children of the group or of a descendant change.
+        :param group_name: The group name
+        :type group_name: str
+        :returns: The descendant group names
+        :rtype: frozenset
+        :raises ValueError: If the group_name does not exist
+        """
+
+        if self.group_exists(group_name) is False:
+            raise ValueError('%s is not present' % group_name)
+        return self._closure(group_name, self._group_descendants,
+                             'children')
+
+    def get_group_hosts(self, group_name):
+        """
+        Get all the hosts of a group - its own hosts and the hosts of
+        all its descendants, like Ansible sees them. Worked out on
+        first use and kept until the group or a descendant changes.
+        :param group_name: The group name
+        :type group_name: str
+        :returns: The host names
+        :rtype: frozenset
+        :raises ValueError: If the group_name does not exist
+        """
+
+        if self.group_exists(group_name) is False:
+            raise ValueError('%s is not present' % group_name)
+        return self._closure(group_name, self._group_hosts, 'hosts')
+
+    def group_has_host(self, group_name, host_name):
+        """
+        Check if a host is in a group or in any of its descendants
+        :param group_name: The group name
+        :param host_name: The host name
+        :type group_name: str
+        :type host_name: str
+        :returns: True if the host is in the group
+        :rtype: boolean
+        :raises ValueError: If the group_name does not exist
+        """
+
+        return host_name in self.get_group_hosts(group_name)
+
+    def _check_child(self, group_name, child_name):
+        """
+        Private method
+        DO NOT CALL EXTERNALLY
+
+        Refuse a child that would make a cycle - the group itself or
+        a group the group is a descendant of
+
+        :raises ValueError: If the child makes a cycle
+        """
+
+        if (child_name == group_name or
+                group_name in self.get_group_descendants(child_name)):
+            raise ValueError('Group %s is a descendant of %s - it cannot '
+                             'be its child' % (group_name, child_name))
+
+    def _intern(self, value):
+        """
+        The one copy of an equal string or tuple of names
+        """
+
+        return self._interned.setdefault(value, value)
+
+    def _share_vars(self, shared_vars):
+        """
+        The one copy of a dict of shared variables. Dicts with
+        values that can't be hashed are not shared. The key holds
+        the value types too - 1, 1.0 and True are equal but must
+        not share a dict.
+        """
+
+        try:
+            key = frozenset((var, type(val), val)
+                            for var, val in shared_vars.iteritems())
+        except TypeError:
+            return dict(shared_vars)
+
+        shared = self._shared_vars.get(key)
+        if shared is None:
+            shared = dict((self._intern(var), val)
+                          for var, val in shared_vars.iteritems())
+            self._shared_vars[key] = shared
+        return shared
+
+    def _get_state(self):
+        """
+        The inventory contents in a form marshal can write. The hosts
+        are plain tuples rather than _Host objects and refer to their
+        shared variables by index - marshal would write a copy of a
+        shared dict for every host.
+
+        :returns: The inventory state for _set_state
+        :rtype: dict
+        """
+
+        shared = list()
+        shared_index = dict()
+        hosts = dict()
+        for host_name, host in self.hosts.iteritems():
+            index = None
+            if host.shared is not None:
+                index = shared_index.get(id(host.shared))
+                if index is None:
+                    index = shared_index[id(host.shared)] = len(shared)
+                    shared.append(host.shared)
+            hosts[host_name] = (host.names, host.values, index)
+
+        return dict(inventory=self.inventory, hosts=hosts, shared=shared)
+
+    def _set_state(self, state):
+        """
+        Replace the inventory contents with a state from _get_state.
+        The names and the shared variables are shared again.
+
+        :param state: The inventory state
+        :type state: dict
+        :returns: None
+        """
+
+        self._inventory_changed()
+        self.inventory = state['inventory']
+        self._interned = dict()
+        self._shared_vars = dict()
+        shared = [self._share_vars(shared_vars)
+                  for shared_vars in state['shared']]
+        self.hosts = dict()
+        for host_name, (names, values, index) in state['hosts'].iteritems():
+            host = _Host()
+            host.names = self._intern(names)
+            host.values = values
+            if index is not None:
+                host.shared = shared[index]
+            self.hosts[host_name] = host
+
+    def _update_host(self, host, host_vars, shared_vars=None):
+        """
+        Merge the variables into a host record
+        """
+
+        self._indexes = None
+
+        if shared_vars:
+            if host.shared:
+                merged_vars = dict(host.shared)
+                merged_vars.update(shared_vars)
+                shared_vars = merged_vars
+            host.shared = self._share_vars(shared_vars)
+
+        if host_vars:
+            if host.names:
+                merged_vars = dict(zip(host.names, host.values))
+                merged_vars.update(host_vars)
+                host_vars = merged_vars
+            names = self._intern(tuple(sorted(host_vars)))
+            host.names = names
+            host.values = tuple([host_vars[var] for var in names])
 
     def group_exists(self, group_name):
         """
@@ -50,7 +415,7 @@ class ErisInventoryBase(object):
         :rtype: boolean
         """
 
-        return host_name in self.inventory['_meta']['hostvars']
+        return host_name in self.hosts
 
     def add_group(self, group_name):
         """
@@ -66,6 +431,8 @@ class ErisInventoryBase(object):
         # This will provide efficiency O(1) for the hash set
         # vs O(n) for list when managing large inventories
         if self.group_exists(group_name) is False:
+            self._indexes = None
+            group_name = self._intern(group_name)
             self.inventory[group_name] = dict(hosts=set(),
                                               vars=dict(),
                                               children=set())
@@ -82,7 +449,8 @@ class ErisInventoryBase(object):
         """
 
         if self.host_exists(host_name) is False:
-            self.inventory['_meta']['hostvars'][host_name] = dict()
+            self._indexes = None
+            self.hosts[self._intern(host_name)] = _Host()
 
     def add_host_to_group(self, group_name, host_name):
         """
@@ -99,7 +467,8 @@ class ErisInventoryBase(object):
 
         if (self.group_exists(group_name) is True and
                 self.host_exists(host_name) is True):
-            self.inventory[group_name]['hosts'].add(host_name)
+            self._group_changed(group_name)
+            self.inventory[group_name]['hosts'].add(self._intern(host_name))
         else:
             raise ValueError('Group %s and Host %s should be present' %
                              (group_name, host_name))
@@ -122,7 +491,7 @@ class ErisInventoryBase(object):
         if self.host_exists(host_name) is False:
             raise ValueError('%s is not in the _meta structure' % host_name)
         else:
-            self.inventory['_meta']['hostvars'][host_name][var] = val
+            self._update_host(self.hosts[host_name], {var: val})
 
     def add_var_to_group(self, group_name, var, val=''):
         """
@@ -155,40 +524,438 @@ class ErisInventoryBase(object):
         :type child_name: str
         :returns: None
         :raises ValueError: If either group_name or child_name \
-                are not groups already
+                are not groups already or the child would make a cycle
         """
 
         if (self.group_exists(group_name) is True and
                 self.group_exists(child_name) is True):
+            self._check_child(group_name, child_name)
+            self._group_changed(group_name, children=True)
+            child_name = self._intern(child_name)
             self.inventory[group_name]['children'].add(child_name)
+            if self._parents is not None:
+                self._parents.setdefault(child_name, set()).add(group_name)
         else:
             raise ValueError('Groups %s and child %s should be present' %
                              (group_name, child_name))
 
-    def serialize_to_json(self):
+    def add_hosts(self, hosts):
+        """
+        Add hosts with their variables in one pass. Hosts that
+        already exist get the variables merged into theirs.
+        Variables that many hosts have with the same values (like
+        the ssh variables) can be passed separately as the shared
+        variables. They are stored once for all those hosts.
+        :param hosts: The host names and their variables. Either a \
+                dict or an iterable of (host_name, vars) pairs or \
+                (host_name, vars, shared_vars) triples.
+        :type hosts: dict
+        :returns: None
+        """
+
+        if isinstance(hosts, dict):
+            hosts = hosts.iteritems()
+
+        self._indexes = None
+        all_hosts = self.hosts
+        for entry in hosts:
+            host_name = entry[0]
+            host = all_hosts.get(host_name)
+            if host is None:
+                host = _Host()
+                all_hosts[self._intern(host_name)] = host
+            self._update_host(host, entry[1],
+                              entry[2] if len(entry) > 2 else None)
+
+    def add_vars_to_host(self, host_name, host_vars):
+        """
+        Merge a dict of variables into the host variables
+        :param host_name: The host name to add the variables to
+        :param host_vars: The variables
+        :type host_name: str
+        :type host_vars: dict
+        :returns: None
+        :raises ValueError: If the host_name is not in the inventory
+        """
+
+        if self.host_exists(host_name) is False:
+            raise ValueError('%s is not in the _meta structure' % host_name)
+        else:
+            self._update_host(self.hosts[host_name], host_vars)
+
+    def get_host_vars(self, host_name):
+        """
+        Get the variables of a host
+        :param host_name: The host name
+        :type host_name: str
+        :returns: A new dict with the host variables
+        :rtype: dict
+        :raises ValueError: If the host_name is not in the inventory
+        """
+
+        if self.host_exists(host_name) is False:
+            raise ValueError('%s is not in the _meta structure' % host_name)
+        else:
+            return self.hosts[host_name].get_vars()
+
+    def add_hosts_to_group(self, group_name, host_names):
+        """
+        Add many hosts to a group. Nothing is added if any of the
+        hosts is missing.
+        :param group_name: Group name where the hosts are to be added
+        :param host_names: The host names to be added into the group
+        :type group_name: str
+        :type host_names: list
+        :returns: None
+        :raises ValueError: If the group_name or any of the \
+                host_names do not exist
+        """
+
+        if self.group_exists(group_name) is False:
+            raise ValueError('%s is not present' % group_name)
+
+        all_hosts = self.hosts
+        missing = [host for host in host_names if host not in all_hosts]
+        if missing:
+            raise ValueError('Hosts %s should be present' %
+                             ', '.join(missing))
+
+        self._group_changed(group_name)
+        self.inventory[group_name]['hosts'].update(
+            [self._intern(host) for host in host_names])
+
+    def add_vars_to_group(self, group_name, group_vars):
+        """
+        Merge a dict of variables into the group variables
+        :param group_name: The group name to add the variables to
+        :param group_vars: The variables
+        :type group_name: str
+        :type group_vars: dict
+        :returns: None
+        :raises ValueError: If the group_name does not exist
+        """
+
+        if self.group_exists(group_name) is False:
+            raise ValueError('%s is not present' % group_name)
+        else:
+            self.inventory[group_name]['vars'].update(group_vars)
+
+    def add_children_to_group(self, group_name, child_names):
+        """
+        Add many children to a group
+        :param group_name: The group name to add the children to
+        :param child_names: The child groups to add to group_name
+        :type group_name: str
+        :type child_names: list
+        :returns: None
+        :raises ValueError: If group_name or any of the \
+                child_names are not groups already or any of the \
+                child_names would make a cycle
+        """
+
+        missing = [child for child in child_names
+                   if self.group_exists(child) is False]
+        if self.group_exists(group_name) is False or missing:
+            raise ValueError('Groups %s and children %s should be present' %
+                             (group_name, ', '.join(missing)))
+
+        child_names = [self._intern(child) for child in child_names]
+        for child in child_names:
+            self._check_child(group_name, child)
+
+        self._group_changed(group_name, children=True)
+        self.inventory[group_name]['children'].update(child_names)
+        if self._parents is not None:
+            for child in child_names:
+                self._parents.setdefault(child, set()).add(group_name)
+
+    def _index(self, name):
+        """
+        Private method
+        DO NOT CALL EXTERNALLY
+
+        A select_hosts index - empty until it is filled in and
+        dropped when the inventory changes
+        """
+
+        if self._indexes is None:
+            self._indexes = dict()
+        return self._indexes.setdefault(name, dict())
+
+    def _var_hosts(self, var):
+        """
+        Private method
+        DO NOT CALL EXTERNALLY
+
+        The hosts by the value of a host variable. The hosts are
+        scanned once per variable until the inventory changes.
+        Values that can't be hashed are left out.
+
+        :param var: The variable name
+        :type var: str
+        :returns: The hosts for every value. Do not change it.
+        :rtype: dict
+        """
+
+        var_hosts = self._index('var_hosts')
+        hosts_by_value = var_hosts.get(var)
+        if hosts_by_value is not None:
+            return hosts_by_value
+
+        hosts_by_value = dict()
+        for host_name, host in self.hosts.iteritems():
+            if var in host.names:
+                val = host.values[host.names.index(var)]
+            elif host.shared and var in host.shared:
+                val = host.shared[var]
+            else:
+                continue
+
+            try:
+                hosts = hosts_by_value.get(val)
+            except TypeError:
+                continue
+            if hosts is None:
+                hosts_by_value[val] = hosts = set()
+            hosts.add(host_name)
+
+        var_hosts[var] = hosts_by_value
+        return hosts_by_value
+
+    def _host_var(self, host_name, var):
+        """
+        Private method
+        DO NOT CALL EXTERNALLY
+
+        A host variable or None if the host doesn't have it
+        """
+
+        host = self.hosts[host_name]
+        if var in host.names:
+            return host.values[host.names.index(var)]
+        if host.shared:
+            return host.shared.get(var)
+        return None
+
+    def _term_hosts(self, term):
+        """
+        Private method
+        DO NOT CALL EXTERNALLY
+
+        The hosts of a host pattern term - see the selector module
+        """
+
+        if term in ('all', '*'):
+            return self.hosts
+        if selector.is_glob(term):
+            glob_hosts = self._index('glob_hosts')
+            hosts = glob_hosts.get(term)
+            if hosts is None:
+                hosts = set(fnmatch.filter(self.hosts, term))
+                for group_name in fnmatch.filter(self.inventory, term):
+                    hosts.update(self.get_group_hosts(group_name))
+                glob_hosts[term] = hosts
+            return hosts
+        if term in self.inventory:
+            return self.get_group_hosts(term)
+        if term in self.hosts:
+            return set([term])
+        raise ValueError('No group or host %s' % term)
+
+    def select_hosts(self, pattern='all', where=None, count=None, seed=None,
+                     distinct_var=None, distinct_groups=None):
+        """
+        Select hosts - for example 3 random rabbitmq hosts in
+        different racks
+            select_hosts('rabbitmq', count=3, distinct_groups='rack_*')
+        The hosts of the groups and the hosts by variable value are
+        indexed on first use, so the following selections only touch
+        the hosts they select. The indexes are dropped when the
+        inventory changes.
+        :param pattern: An Ansible host pattern (see the selector \
+                module), like mysql:&controller
+        :param where: Host variables the hosts must have. A value \
+                is compared, a function is called with the value \
+                of the host and has to return True.
+        :param count: Pick this many of the hosts at random
+        :param seed: The random seed for picking the hosts
+        :param distinct_var: No two hosts picked have the same value \
+                of this host variable. The hosts without it are \
+                never picked.
+        :param distinct_groups: A group glob like rack_* - no two \
+                hosts picked have a group matching it in common. \
+                The hosts in none of them are never picked.
+        :type pattern: str
+        :type where: dict
+        :type count: int
+        :type seed: hashable
+        :type distinct_var: str
+        :type distinct_groups: str
+        :returns: The host names
+        :rtype: set
+        :raises ValueError: If the pattern has an unknown group or \
+                host, or there are not enough hosts to pick from
         """
-        Serialize the inventory to a JSON string
+
+        unions, intersections, exclusions = selector.parse_pattern(pattern)
+
+        # Start from the smallest set of hosts
+        term_hosts = [self._term_hosts(term) for term in intersections]
+        if unions:
+            hosts = set()
+            for term in unions:
+                hosts.update(self._term_hosts(term))
+            term_hosts.append(hosts)
+        if not term_hosts:
+            term_hosts.append(self.hosts)
+        term_hosts.sort(key=len)
+        hosts = set(term_hosts[0])
+        for other_hosts in term_hosts[1:]:
+            hosts.intersection_update(other_hosts)
+        for term in exclusions:
+            hosts.difference_update(self._term_hosts(term))
+
+        for var, val in (where or dict()).iteritems():
+            if callable(val):
+                hosts = set(host for host in hosts
+                            if self._host_var(host, var) is not None and
+                            val(self._host_var(host, var)))
+                continue
+            try:
+                hosts.intersection_update(
+                    self._var_hosts(var).get(val, ()))
+            except TypeError:
+                # A value that can't be hashed isn't indexed
+                hosts = set(host for host in hosts
+                            if self._host_var(host, var) == val)
+
+        if count is None:
+            return hosts
+
+        if distinct_var is not None:
+            def var_key(host):
+                return self._host_var(host, distinct_var)
+            return set(selector.sample_hosts(hosts, count, seed,
+                                             key=var_key))
+        elif distinct_groups is not None:
+            return set(selector.sample_hosts(
+                hosts, count, seed,
+                groups=self._glob_groups(distinct_groups).get))
+
+        return set(selector.sample_hosts(hosts, count, seed))
+
+    def _glob_groups(self, glob):
+        """
+        Private method
+        DO NOT CALL EXTERNALLY
+
+        The groups matching a glob that every host is in (directly or
+        through the children), kept until the inventory changes
+
+        :param glob: The group glob
+        :type glob: str
+        :returns: A sorted tuple of group names for every host in \
+                any of the groups. Do not change it.
+        :rtype: dict
+        """
+
+        glob_groups = self._index('glob_groups')
+        host_groups = glob_groups.get(glob)
+        if host_groups is not None:
+            return host_groups
+
+        host_groups = dict()
+        for group_name in sorted(fnmatch.filter(self.inventory, glob)):
+            for host in self.get_group_hosts(group_name):
+                host_groups[host] = host_groups.get(host, ()) + (group_name,)
+        glob_groups[glob] = host_groups
+        return host_groups
+
+    def get_group(self, group_name, pretty=False):
+        """
+        Get a group in the Ansible shape, with lists of the hosts
+        and the children - it can be serialized to JSON as is
+        :param group_name: The group name
+        :param pretty: Sort the hosts and the children
+        :type group_name: str
+        :type pretty: boolean
+        :returns: The hosts, vars and children of the group. The \
+                vars are the group's own - do not change them.
+        :rtype: dict
+        :raises ValueError: If the group_name is not present
+        """
+
+        if self.group_exists(group_name) is False:
+            raise ValueError('%s is not present' % group_name)
+
+        group = self.inventory[group_name]
+        hosts = list(group['hosts'])
+        children = list(group['children'])
+        if pretty:
+            hosts.sort()
+            children.sort()
+        return dict(hosts=hosts, vars=group['vars'], children=children)
+
+    def serialize_to_json(self, pretty=False):
+        """
+        Serialize the inventory to a JSON string. The output is
+        compact unless pretty printing is asked for - Ansible
+        parses it either way.
+        :param pretty: Indent and sort the output for people to read
+        :type pretty: boolean
         :returns: The JSON string which represents a dynamic ansible inventory
         :rtype: str
         :raises TypeError: If the object or parts of the \
                 inventory object are not serializable to JSON
         """
 
-        # The only non json serializable element is the set
-        # for which the default is provided by overriding
-        # the encoder class.
-        class InventoryEncoder(json.JSONEncoder):
-            def default(self, obj):
-                if isinstance(obj, set):
-                    return list(obj)
-                else:
-                    return super(InventoryEncoder, self).default(obj)
-
-        return json.dumps(self.inventory,
-                          cls=InventoryEncoder,
-                          indent=4,
-                          sort_keys=True,
-                          separators=(',', ': '))
+        # The sets are turned into lists up front so the encoder
+        # never has to call back into Python
+        inventory = dict((group_name, self.get_group(group_name, pretty))
+                         for group_name in self.inventory)
+        inventory['_meta'] = dict(hostvars=dict(
+            (host_name, host.get_vars())
+            for host_name, host in self.hosts.iteritems()))
+
+        if pretty:
+            return json.dumps(inventory,
+                              indent=4,
+                              sort_keys=True,
+                              separators=(',', ': '))
+
+        return _dumps(inventory)
+
+    def serialize_to_stream(self, fid):
+        """
+        Write the inventory as compact JSON to a file. The hosts are
+        encoded a batch at a time so the whole JSON document is never
+        in memory.
+        :param fid: A file like object opened for writing
+        :type fid: file
+        :returns: None
+        :raises TypeError: If the object or parts of the \
+                inventory object are not serializable to JSON
+        """
+
+        fid.write('{')
+        for group_name in self.inventory:
+            fid.write('%s:%s,' % (_dumps(group_name),
+                                  _dumps(self.get_group(group_name))))
+
+        fid.write('"_meta":{"hostvars":{')
+        batch = list()
+        separator = ''
+        for host_name, host in self.hosts.iteritems():
+            batch.append('%s:%s' % (_dumps(host_name),
+                                    _dumps(host.get_vars())))
+            if len(batch) == _STREAM_BATCH:
+                fid.write(separator + ','.join(batch))
+                separator = ','
+                batch = list()
+
+        if batch:
+            fid.write(separator + ','.join(batch))
+        fid.write('}}}')
 
     def create_inventory(self):
         """
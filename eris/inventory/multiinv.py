@@ -0,0 +1,249 @@
+"""
+An inventory made of several inventories - a site that spans several
+fuel environments and deployment maps. Every source is a complete
+eris config for its own inventory plugin
+{
+    "inventory_plugin": "eris.inventory.multiinv",
+    "inventory_workers": 4,
+    "inventory_sources": [
+        {
+            "name": "fuel-east",
+            "inventory_plugin": "eris.inventory.fuelinv",
+            "host_prefix": "east-",
+            "openstack_deployment": {...}
+        },
+        {
+            "name": "lab",
+            "openstack_deployment": {"deployment_map": ..., ...}
+        }
+    ]
+}
+The sources are built at the same time on a pool of threads, so
+fetching the fuel node lists (mostly waiting on ssh) overlaps and a
+refresh takes as long as the slowest source rather than all of them.
+
+The built inventories are merged in the order of the sources, no
+matter which finished first, so the result is always the same
+1. Hosts and groups are the union of all the sources. Groups with
+   the same name are merged - their hosts and children are combined.
+2. When a group is in several sources the variables of the later
+   source win, like with several Ansible inventories.
+3. A host in several sources has to be the same machine - its
+   variables are combined, and a variable with another value in
+   another source is an error. Sources that reuse host names for
+   other machines (every fuel environment has a fuel host and
+   node-1, node-2, ...) need a "host_prefix" - it is put in front of
+   the names of all their hosts but localhost.
+If a source fails the inventory fails with the error of the first
+failed source.
+"""
+
+# System imports
+import importlib
+import sys
+import time
+
+from eris.inventory.inventory_base import ErisInventoryBase
+
+
+DEFAULT_PLUGIN = 'eris.inventory.fileinv'
+INVENTORY_CLASS = 'ErisAnsibleInventory'
+
+# The source keys that are not part of the config of the source plugin
+_SOURCE_KEYS = ('name', 'inventory_plugin', 'host_prefix')
+
+# The same in every source - never prefixed
+_LOCAL_HOST = 'localhost'
+
+
+def _build_source(source):
+    """
+    Build the inventory of a source - runs on a pool thread
+
+    :param source: The name, the plugin class and the config
+    :type source: tuple
+    :returns: The inventory, the seconds it took and the exception \
+            info if it failed
+    :rtype: tuple
+    """
+
+    name, inventory_cls, config = source
+    start = time.time()
+    try:
+        inventory_obj = inventory_cls(config)
+        inventory_obj.create_inventory()
+    except Exception:
+        return None, time.time() - start, sys.exc_info()
+
+    return inventory_obj, time.time() - start, None
+
+
+class ErisAnsibleInventory(ErisInventoryBase):
+
+    def __init__(self, eris_config):
+        """
+        Create the multi source inventory
+
+        :param eris_config: The config with the inventory_sources
+        :type eris_config: dict
+        """
+
+        super(ErisAnsibleInventory, self).__init__(eris_config)
+
+        # Filled in by create_inventory - for every source in order
+        # dict(name=, plugin=, seconds=, hosts=, groups=)
+        self.source_stats = list()
+        self.build_seconds = None
+
+    def _sources(self):
+        """
+        Private method
+        DO NOT CALL EXTERNALLY
+
+        The sources with their plugin classes. The plugins are
+        imported here rather than on the pool threads.
+
+        :returns: (name, plugin module, class, config, host prefix) \
+                for every source
+        :rtype: list
+        :raises ValueError: if there are no sources
+        """
+
+        source_configs = self.eris_config.get('inventory_sources')
+        if not source_configs:
+            raise ValueError('No inventory_sources in the config')
+
+        sources = list()
+        for idx, source_config in enumerate(source_configs):
+            config = dict((key, value)
+                          for key, value in source_config.iteritems()
+                          if key not in _SOURCE_KEYS)
+            deployment = config.get('openstack_deployment') or dict()
+            name = source_config.get('name',
+                                     deployment.get('name',
+                                                    'source-%d' % idx))
+            plugin = source_config.get('inventory_plugin', DEFAULT_PLUGIN)
+            inventory_cls = getattr(importlib.import_module(plugin),
+                                    INVENTORY_CLASS)
+            sources.append((name, plugin, inventory_cls, config,
+                            source_config.get('host_prefix', '')))
+
+        return sources
+
+    def create_inventory(self):
+        """
+        Build all the sources in parallel and merge them
+
+        :returns: None
+        :raises ValueError: if there are no sources or a host has \
+                other variable values in another source
+        :raises: whatever the first failed source raised
+        """
+
+        # Only a multi source inventory needs the threads
+        from multiprocessing.pool import ThreadPool
+
+        sources = self._sources()
+        workers = self.eris_config.get('inventory_workers') or len(sources)
+
+        start = time.time()
+        pool = ThreadPool(min(workers, len(sources)))
+        try:
+            results = pool.map(_build_source,
+                               [(name, inventory_cls, config)
+                                for name, _, inventory_cls, config, _
+                                in sources],
+                               chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        self.source_stats = list()
+        for (name, plugin, _, _, _), (inventory_obj, seconds,
+                                      exc_info) in zip(sources, results):
+            self.source_stats.append(dict(
+                name=name, plugin=plugin, seconds=seconds,
+                hosts=len(inventory_obj.hosts) if inventory_obj else None,
+                groups=(len(inventory_obj.inventory)
+                        if inventory_obj else None)))
+
+        for _, _, exc_info in results:
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+        # The source every host came from first
+        host_sources = dict()
+        for (name, _, _, _, host_prefix), (inventory_obj, _, _) in zip(
+                sources, results):
+            self._merge(inventory_obj, name, host_prefix, host_sources)
+        self.build_seconds = time.time() - start
+
+    def _merge(self, source_obj, source_name, host_prefix, host_sources):
+        """
+        Private method
+        DO NOT CALL EXTERNALLY
+
+        Merge an inventory into this one. The group variables of
+        the merged inventory win. The variables of a host already
+        in the inventory are combined and must not differ.
+
+        :param source_obj: The inventory to merge
+        :param source_name: The name of its source
+        :param host_prefix: Put in front of its host names
+        :param host_sources: The source of every host merged so far. \
+                The new hosts are added.
+        :type source_obj: ErisInventoryBase
+        :type source_name: str
+        :type host_prefix: str
+        :type host_sources: dict
+        :returns: None
+        :raises ValueError: if a host has another value for a \
+                variable in an earlier source
+        """
+
+        def merged_name(host_name):
+            if host_name == _LOCAL_HOST:
+                return host_name
+            return host_prefix + host_name
+
+        new_hosts = list()
+        for host_name, source_host in source_obj.hosts.iteritems():
+            host_name = merged_name(host_name)
+            host_vars = dict(zip(source_host.names, source_host.values))
+            if host_name not in self.hosts:
+                # The shared variables stay shared
+                new_hosts.append((host_name, host_vars, source_host.shared))
+                host_sources[host_name] = source_name
+                continue
+
+            # In an earlier source too - it has to be the same machine
+            merged_vars = self.get_host_vars(host_name)
+            source_vars = source_host.get_vars()
+            conflicts = sorted(var for var, val in source_vars.iteritems()
+                               if merged_vars.get(var, val) != val)
+            if conflicts:
+                raise ValueError('Host %s of %s is another host in %s - it '
+                                 'has other values for %s. Set a '
+                                 'host_prefix for one of the sources.' %
+                                 (host_name, source_name,
+                                  host_sources[host_name],
+                                  ', '.join(conflicts)))
+
+            # Start over with the merged variables so a shared
+            # variable of the earlier source can't hide one of this one
+            merged_vars.update(source_vars)
+            del self.hosts[host_name]
+            new_hosts.append((host_name, merged_vars))
+        self.add_hosts(new_hosts)
+
+        # All the groups first - the children refer to them
+        for group_name in source_obj.inventory:
+            if not self.group_exists(group_name):
+                self.add_group(group_name)
+
+        for group_name, group in source_obj.inventory.iteritems():
+            self.add_hosts_to_group(group_name, [merged_name(group_host)
+                                                 for group_host
+                                                 in group['hosts']])
+            self.add_vars_to_group(group_name, group['vars'])
+            self.add_children_to_group(group_name, group['children'])
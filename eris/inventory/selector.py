@@ -0,0 +1,153 @@
+"""
+Host selection for ErisInventoryBase.select_hosts - the parsing of
+host patterns and the random sampling of hosts.
+
+The patterns are Ansible host patterns
+    all or *            - all the hosts
+    mysql               - the hosts of a group and of its children
+                          or a host
+    rack_*              - the groups and hosts matching a glob
+    mysql:controller    - the hosts in either (a comma works too)
+    mysql:&controller   - the hosts in both
+    mysql:!controller   - the hosts in mysql but not in controller
+Like with Ansible the order of the terms does not matter - the union
+of the plain terms is intersected with the & terms and the ! terms
+are taken out of that.
+"""
+
+# System imports
+import random
+import re
+
+
+_SEPARATORS = re.compile(r'[:,]')
+_GLOB_CHARS = ('*', '?', '[')
+
+# The random orders tried to pick hosts with no group in common
+_APART_TRIES = 10
+
+
+def parse_pattern(pattern):
+    """
+    Split a host pattern into its terms
+
+    :param pattern: The host pattern
+    :type pattern: str
+    :returns: The plain, the & and the ! terms
+    :rtype: tuple
+    :raises ValueError: if a term is empty
+    """
+
+    unions = list()
+    intersections = list()
+    exclusions = list()
+    for term in _SEPARATORS.split(pattern):
+        term = term.strip()
+        terms = unions
+        if term[:1] == '&':
+            term, terms = term[1:].strip(), intersections
+        elif term[:1] == '!':
+            term, terms = term[1:].strip(), exclusions
+        if not term:
+            raise ValueError('Empty term in the host pattern %s' % pattern)
+        terms.append(term)
+
+    return unions, intersections, exclusions
+
+
+def is_glob(term):
+    """
+    Check if a pattern term is a glob rather than a name
+
+    :param term: The term
+    :type term: str
+    :returns: True if the term has glob characters
+    :rtype: boolean
+    """
+
+    return any(char in term for char in _GLOB_CHARS)
+
+
+def _sample_apart(rng, hosts, count, groups):
+    """
+    Private method
+    DO NOT CALL EXTERNALLY
+
+    Pick hosts with no group in common. The hosts are tried in a
+    random order and a host is picked when none of its groups is
+    taken - _APART_TRIES orders are tried before giving up. This is
+    greedy, so it can give up on hosts that could be picked apart
+    in an order it did not try.
+    """
+
+    if count == 0:
+        return list()
+
+    hosts = [(host, frozenset(groups(host) or ())) for host in hosts]
+    hosts = [(host, host_groups) for host, host_groups in hosts
+             if host_groups]
+    for _ in range(_APART_TRIES):
+        rng.shuffle(hosts)
+        picked = list()
+        taken = set()
+        for host, host_groups in hosts:
+            if taken.isdisjoint(host_groups):
+                picked.append(host)
+                taken.update(host_groups)
+                if len(picked) == count:
+                    return picked
+
+    raise ValueError('Cannot pick %d of %d hosts with no group in common '
+                     'in %d tries' % (count, len(hosts), _APART_TRIES))
+
+
+def sample_hosts(hosts, count, seed=None, key=None, groups=None):
+    """
+    Pick hosts at random. The same hosts and seed always pick the
+    same hosts.
+
+    :param hosts: The hosts to pick from
+    :param count: The number of hosts to pick
+    :param seed: The random seed. None seeds from the system.
+    :param key: A function of the host - no two hosts picked \
+            have the same key. The hosts with a None key are \
+            never picked.
+    :param groups: A function of the host - no two hosts picked \
+            have a group in common. The hosts with no groups are \
+            never picked.
+    :type hosts: set
+    :type count: int
+    :type seed: hashable
+    :type key: function
+    :type groups: function
+    :returns: The hosts picked - none for a count of 0
+    :rtype: list
+    :raises ValueError: if there are not enough hosts to pick from. \
+            With groups the hosts are picked greedily in a few random \
+            orders, so this can also be raised when the hosts could \
+            have been picked apart in another order.
+    """
+
+    rng = random.Random(seed)
+    hosts = sorted(hosts)
+    if groups is not None:
+        return _sample_apart(rng, hosts, count, groups)
+
+    if key is None:
+        if count > len(hosts):
+            raise ValueError('Cannot pick %d of %d hosts' %
+                             (count, len(hosts)))
+        return rng.sample(hosts, count)
+
+    hosts_by_key = dict()
+    for host in hosts:
+        host_key = key(host)
+        if host_key is not None:
+            hosts_by_key.setdefault(host_key, list()).append(host)
+
+    if count > len(hosts_by_key):
+        raise ValueError('Cannot pick %d hosts - only %d of %d hosts are '
+                         'apart' % (count, len(hosts_by_key), len(hosts)))
+
+    return [rng.choice(hosts_by_key[picked_key])
+            for picked_key in rng.sample(sorted(hosts_by_key), count)]
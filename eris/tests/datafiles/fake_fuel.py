@@ -0,0 +1,51 @@
+#! /usr/bin/env python
+
+"""
+A stand-in for the fuel client on the fuel master. It answers
+    fake_fuel.py node list --json
+with a made up node list in the format of the real fuel client.
+FAKE_FUEL_NODES sets the number of ready nodes (4 by default).
+One node being discovered and one offline node are always added -
+the inventory skips both.
+"""
+
+import json
+import os
+import sys
+
+
+ROLES = ['controller', 'compute', 'compute, cinder', 'mongo']
+
+
+def fuel_node(node_id, status='ready', online=True):
+    return dict(id=node_id,
+                name='node-%d' % node_id,
+                status=status,
+                online=online,
+                cluster=1,
+                group_id=1,
+                ip='10.20.0.%d' % (node_id % 250 + 2),
+                mac='52:54:00:%02x:%02x:%02x' % (node_id >> 16,
+                                                 (node_id >> 8) & 255,
+                                                 node_id & 255),
+                roles=ROLES[node_id % len(ROLES)],
+                pending_roles='')
+
+
+def main(argv):
+    if argv[1:] != ['node', 'list', '--json']:
+        sys.stderr.write('usage: fake_fuel.py node list --json\n')
+        return 2
+
+    node_count = int(os.environ.get('FAKE_FUEL_NODES', '4'))
+    nodes = [fuel_node(node_id) for node_id in range(1, node_count + 1)]
+    nodes.append(fuel_node(node_count + 1, status='discover'))
+    nodes.append(fuel_node(node_count + 2, online=False))
+
+    json.dump(nodes, sys.stdout, indent=4)
+    sys.stdout.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,8 +1,12 @@
 
 import os
+import random
 import stat
 import json
 import subprocess
+import time
+
+import fixtures
 
 from eris.inventory import fileinv
 
@@ -57,3 +61,387 @@ class ErisFileinvTest(base.TestCase):
         idx = actual_output.rindex(expected_output)
         self.assertEqual(idx, 0)
 
+    def _create_inventory(self, map_path, groups=None):
+        with open('eris/tests/datafiles/test_config.json', 'r') as fid:
+            eris_config = json.load(fid)
+        eris_config['openstack_deployment']['deployment_map'] = map_path
+        if groups is not None:
+            eris_config['openstack_deployment']['groups'] = groups
+
+        inv_obj = fileinv.ErisAnsibleInventory(eris_config)
+        inv_obj.create_inventory()
+        return json.loads(inv_obj.serialize_to_json())
+
+    def test_json_lines_deployment_map(self):
+        with open('eris/tests/datafiles/test_deployment.json', 'r') as fid:
+            nodes = json.load(fid)
+
+        tmp_dir = self.useFixture(fixtures.TempDir()).path
+        map_path = os.path.join(tmp_dir, 'deployment.jsonl')
+        with open(map_path, 'w') as fid:
+            for node in nodes:
+                fid.write(json.dumps(node) + '\n')
+
+        expected = self._create_inventory(
+            'eris/tests/datafiles/test_deployment.json')
+        self.assertEqual(self._create_inventory(map_path), expected)
+        self.assertEqual(len(expected['_meta']['hostvars']), len(nodes) + 1)
+
+    def _group_hosts(self, inventory, group):
+        # All the hosts in a group and its children
+        hosts = set(inventory[group]['hosts'])
+        for child in inventory[group]['children']:
+            hosts.update(self._group_hosts(inventory, child))
+        return hosts
+
+    def test_group_expansion(self):
+        groups = {'compute': ['nova', 'hypervisors'],
+                  'hypervisors': ['monitored'],
+                  'mysql': ['monitored']}
+        inventory = self._create_inventory(
+            'eris/tests/datafiles/test_deployment.json', groups)
+
+        compute = set(inventory['compute']['hosts'])
+        mysql = set(inventory['mysql']['hosts'])
+        self.assertTrue(compute)
+        self.assertEqual(self._group_hosts(inventory, 'nova'), compute)
+        self.assertEqual(self._group_hosts(inventory, 'hypervisors'),
+                         compute)
+        self.assertEqual(self._group_hosts(inventory, 'monitored'),
+                         compute | mysql)
+
+        # The hosts are only in their own groups
+        self.assertEqual(inventory['monitored']['hosts'], [])
+        self.assertItemsEqual(inventory['monitored']['children'],
+                              ['hypervisors', 'mysql'])
+        self.assertIn('monitored', inventory['test']['children'])
+
+    def test_group_expansion_cycle(self):
+        groups = {'compute': ['hypervisors'],
+                  'hypervisors': ['compute']}
+        self.assertRaises(ValueError, self._create_inventory,
+                          'eris/tests/datafiles/test_deployment.json',
+                          groups)
+
+    def _write_map(self, map_path, nodes, one_per_line=True):
+        # A JSON array with a node on every line
+        with open(map_path, 'w') as fid:
+            if one_per_line:
+                lines = [json.dumps(node) for node in nodes]
+                fid.write('[\n' + ',\n'.join(lines) + '\n]\n')
+            else:
+                json.dump(nodes, fid)
+
+    def test_incremental_rebuild(self):
+        tmp_dir = self.useFixture(fixtures.TempDir()).path
+        map_path = os.path.join(tmp_dir, 'deployment.json')
+        with open('eris/tests/datafiles/test_deployment.json', 'r') as fid:
+            nodes = json.load(fid)
+
+        with open('eris/tests/datafiles/test_config.json', 'r') as fid:
+            eris_config = json.load(fid)
+        eris_config['openstack_deployment']['deployment_map'] = map_path
+        eris_config['openstack_deployment']['groups'] = {
+            'compute': ['hypervisors']}
+        state_config = json.loads(json.dumps(eris_config))
+        state_config['openstack_deployment']['inventory_state'] = \
+            os.path.join(tmp_dir, 'inventory.state')
+
+        class CountingInventory(fileinv.ErisAnsibleInventory):
+            builds = 0
+
+            def _build_inventory(self, deployment_map):
+                CountingInventory.builds += 1
+                super(CountingInventory, self)._build_inventory(
+                    deployment_map)
+
+        def create_inventory(config):
+            self._write_map(map_path, nodes)
+            inv_obj = CountingInventory(config)
+            inv_obj.create_inventory()
+            return json.loads(inv_obj.serialize_to_json(pretty=True))
+
+        self.assertEqual(create_inventory(state_config),
+                         create_inventory(eris_config))
+        self.assertEqual(CountingInventory.builds, 2)
+
+        # Change, remove and add nodes within the existing groups
+        removed = nodes.pop(1)
+        nodes[1]['ip'] = '10.0.0.1'
+        nodes[2]['ansible_ssh_variables'] = dict(ansible_user='admin')
+        nodes.append(dict(name='new-node', groups=nodes[3]['groups'],
+                          ip='10.0.0.2', mac='52:54:00:00:00:02'))
+
+        inventory = create_inventory(state_config)
+        self.assertEqual(CountingInventory.builds, 2)
+        self.assertEqual(inventory, create_inventory(eris_config))
+        self.assertNotIn(removed['name'], inventory['_meta']['hostvars'])
+        self.assertIn('new-node', inventory[nodes[3]['groups'][0]]['hosts'])
+
+        # A new group needs a rebuild
+        nodes[0]['groups'] = nodes[0]['groups'] + ['brand-new-group']
+        inventory = create_inventory(state_config)
+        self.assertEqual(CountingInventory.builds, 4)
+        self.assertEqual(inventory, create_inventory(eris_config))
+        self.assertIn(nodes[0]['name'], inventory['brand-new-group']['hosts'])
+
+    def _topology_map(self):
+        # Two racks, three bare metal nodes, VMs on two of them,
+        # a switch in a rack and a VM on a bare metal node not in the map
+        nodes = list()
+
+        def node(name, node_type, **topology):
+            nodes.append(dict(name=name, groups=['compute'], type=node_type,
+                              ip='10.0.0.%d' % (len(nodes) + 1),
+                              mac='52:54:00:00:00:%02x' % (len(nodes) + 1),
+                              **topology))
+
+        node('bm-1', 'bare-metal', rack='r1')
+        node('bm-2', 'bare-metal', rack='r1')
+        node('bm-3', 'bare-metal', rack='r2')
+        node('vm-1', 'vm', **{'bare-metal': 'bm-1'})
+        node('vm-2', 'vm', **{'bare-metal': 'bm-1'})
+        node('vm-3', 'vm', **{'bare-metal': 'bm-3'})
+        node('vm-4', 'vm', **{'bare-metal': 'bm-9'})
+        node('tor-1', 'switch', rack='r1')
+        return nodes
+
+    def test_topology_groups(self):
+        tmp_dir = self.useFixture(fixtures.TempDir()).path
+        map_path = os.path.join(tmp_dir, 'deployment.json')
+        with open(map_path, 'w') as fid:
+            json.dump(self._topology_map(), fid)
+
+        inventory = self._create_inventory(map_path)
+
+        self.assertItemsEqual(inventory['baremetal_bm-1']['hosts'],
+                              ['vm-1', 'vm-2'])
+        self.assertEqual(inventory['baremetal_bm-2']['hosts'], [])
+        self.assertEqual(inventory['baremetal_bm-9']['hosts'], ['vm-4'])
+        self.assertItemsEqual(inventory['rack_r1']['hosts'],
+                              ['bm-1', 'bm-2', 'tor-1'])
+        self.assertItemsEqual(inventory['rack_r1']['children'],
+                              ['baremetal_bm-1', 'baremetal_bm-2'])
+        self.assertEqual(self._group_hosts(inventory, 'rack_r1'),
+                         set(['bm-1', 'bm-2', 'tor-1', 'vm-1', 'vm-2']))
+        self.assertEqual(self._group_hosts(inventory, 'rack_r2'),
+                         set(['bm-3', 'vm-3']))
+        self.assertIn('rack_r1', inventory['test']['children'])
+
+        hostvars = inventory['_meta']['hostvars']
+        self.assertEqual(hostvars['bm-3']['eris_rack'], 'r2')
+        self.assertEqual(hostvars['vm-1']['eris_bare_metal'], 'bm-1')
+        self.assertNotIn('eris_rack', hostvars['vm-1'])
+
+    def test_topology_incremental_rebuild(self):
+        tmp_dir = self.useFixture(fixtures.TempDir()).path
+        map_path = os.path.join(tmp_dir, 'deployment.json')
+        nodes = self._topology_map()
+
+        with open('eris/tests/datafiles/test_config.json', 'r') as fid:
+            eris_config = json.load(fid)
+        eris_config['openstack_deployment']['deployment_map'] = map_path
+        state_config = json.loads(json.dumps(eris_config))
+        state_config['openstack_deployment']['inventory_state'] = \
+            os.path.join(tmp_dir, 'inventory.state')
+
+        def create_inventory(config):
+            self._write_map(map_path, nodes)
+            inv_obj = fileinv.ErisAnsibleInventory(config)
+            inv_obj.create_inventory()
+            return json.loads(inv_obj.serialize_to_json(pretty=True))
+
+        create_inventory(state_config)
+
+        # A VM moves to another bare metal node and
+        # a bare metal node to another rack
+        nodes[4]['bare-metal'] = 'bm-2'
+        inventory = create_inventory(state_config)
+        self.assertEqual(inventory, create_inventory(eris_config))
+        self.assertEqual(inventory['baremetal_bm-2']['hosts'], ['vm-2'])
+
+        nodes[1]['rack'] = 'r2'
+        inventory = create_inventory(state_config)
+        self.assertEqual(inventory, create_inventory(eris_config))
+        self.assertIn('baremetal_bm-2', inventory['rack_r2']['children'])
+        self.assertNotIn('baremetal_bm-2', inventory['rack_r1']['children'])
+
+    def test_incremental_rebuild_matches_build(self):
+        tmp_dir = self.useFixture(fixtures.TempDir()).path
+        map_path = os.path.join(tmp_dir, 'deployment.json')
+        nodes = self._topology_map()
+
+        with open('eris/tests/datafiles/test_config.json', 'r') as fid:
+            eris_config = json.load(fid)
+        eris_config['openstack_deployment']['deployment_map'] = map_path
+        state_config = json.loads(json.dumps(eris_config))
+        state_config['openstack_deployment']['inventory_state'] = \
+            os.path.join(tmp_dir, 'inventory.state')
+
+        def create_inventory(config):
+            self._write_map(map_path, nodes)
+            inv_obj = fileinv.ErisAnsibleInventory(config)
+            inv_obj.create_inventory()
+            return json.loads(inv_obj.serialize_to_json(pretty=True))
+
+        # A name listed twice is one host in the groups of both entries
+        nodes.append(dict(nodes[3], groups=['a'], ip='10.0.1.1'))
+        inventory = create_inventory(state_config)
+        self.assertEqual(inventory, create_inventory(eris_config))
+        self.assertEqual(inventory['a']['hosts'], ['vm-1'])
+        self.assertIn('vm-1', inventory['compute']['hosts'])
+        self.assertEqual(inventory['_meta']['hostvars']['vm-1']
+                         ['ansible_host'], '10.0.1.1')
+
+        # Random changes, with names coming and going twice
+        rng = random.Random(7)
+        names = ['node-%d' % i for i in range(6)] + ['bm-1', 'vm-2']
+        for _ in range(40):
+            change = rng.randrange(4)
+            if change == 0 or len(nodes) < 4:
+                nodes.append(dict(name=rng.choice(names),
+                                  groups=rng.sample(['a', 'b', 'c'], 2),
+                                  type=rng.choice(['vm', 'bare-metal']),
+                                  rack=rng.choice(['r0', 'r1']),
+                                  ip='10.0.2.%d' % rng.randrange(256),
+                                  mac='52:54:00:00:02:%02x' % len(nodes)))
+            elif change == 1:
+                nodes.pop(rng.randrange(len(nodes)))
+            elif change == 2:
+                node = rng.choice(nodes)
+                node['ansible_ssh_variables'] = dict(
+                    ansible_user=rng.choice(['root', 'admin']))
+            else:
+                rng.choice(nodes)['rack'] = rng.choice(['r0', 'r1'])
+
+            self.assertEqual(create_inventory(state_config),
+                             create_inventory(eris_config))
+
+    def _state_config(self, map_path, state_dir):
+        with open('eris/tests/datafiles/test_config.json', 'r') as fid:
+            eris_config = json.load(fid)
+        eris_config['openstack_deployment']['deployment_map'] = map_path
+        state_config = json.loads(json.dumps(eris_config))
+        state_config['openstack_deployment']['inventory_state'] = \
+            os.path.join(state_dir, 'inventory.state')
+        return eris_config, state_config
+
+    def _parsed_lines(self):
+        # Count the lines parsed with json.loads
+        parsed = list()
+        loads = json.loads
+
+        def counting_loads(data, *args, **kwargs):
+            parsed.append(data)
+            return loads(data, *args, **kwargs)
+
+        self.useFixture(fixtures.MonkeyPatch(
+            'eris.inventory.fileinv.json.loads', counting_loads))
+        return parsed
+
+    def test_incremental_parses_changed_lines(self):
+        tmp_dir = self.useFixture(fixtures.TempDir()).path
+        map_path = os.path.join(tmp_dir, 'deployment.json')
+        nodes = self._topology_map()
+        self._write_map(map_path, nodes)
+        eris_config, state_config = self._state_config(map_path, tmp_dir)
+
+        fileinv.ErisAnsibleInventory(state_config).create_inventory()
+        parsed = self._parsed_lines()
+        nodes[2]['ip'] = '10.0.1.1'
+        self._write_map(map_path, nodes)
+        inv_obj = fileinv.ErisAnsibleInventory(state_config)
+        inv_obj.create_inventory()
+        self.assertEqual(len(parsed), 1)
+        self.assertEqual(inv_obj.get_host_vars('bm-3')['ansible_host'],
+                         '10.0.1.1')
+
+        # Unchanged and old enough to trust the modification time -
+        # the map is not read at all
+        stale = time.time() - 10
+        os.utime(map_path, (stale, stale))
+        fileinv.ErisAnsibleInventory(state_config).create_inventory()
+
+        def no_read(*args):
+            raise AssertionError('deployment map read')
+
+        self.useFixture(fixtures.MonkeyPatch(
+            'eris.inventory.fileinv._map_lines', no_read))
+        inv_obj = fileinv.ErisAnsibleInventory(state_config)
+        inv_obj.create_inventory()
+        expected = fileinv.ErisAnsibleInventory(eris_config)
+        expected.create_inventory()
+        self.assertEqual(inv_obj.serialize_to_json(pretty=True),
+                         expected.serialize_to_json(pretty=True))
+
+    def test_incremental_map_on_a_line(self):
+        # A map that is not one node per line is built from scratch
+        tmp_dir = self.useFixture(fixtures.TempDir()).path
+        map_path = os.path.join(tmp_dir, 'deployment.json')
+        nodes = self._topology_map()
+        eris_config, state_config = self._state_config(map_path, tmp_dir)
+
+        builds = list()
+
+        class CountingInventory(fileinv.ErisAnsibleInventory):
+
+            def _build_inventory(self, deployment_map):
+                builds.append(self)
+                super(CountingInventory, self)._build_inventory(
+                    deployment_map)
+
+        for ip in ('10.0.1.1', '10.0.1.2'):
+            nodes[2]['ip'] = ip
+            self._write_map(map_path, nodes, one_per_line=False)
+            inv_obj = CountingInventory(state_config)
+            inv_obj.create_inventory()
+            expected = fileinv.ErisAnsibleInventory(eris_config)
+            expected.create_inventory()
+            self.assertEqual(inv_obj.serialize_to_json(pretty=True),
+                             expected.serialize_to_json(pretty=True))
+        self.assertEqual(len(builds), 2)
+
+    def test_incremental_state_must_be_private(self):
+        tmp_dir = self.useFixture(fixtures.TempDir()).path
+        map_path = os.path.join(tmp_dir, 'deployment.json')
+        self._write_map(map_path, self._topology_map())
+        state_dir = os.path.join(tmp_dir, 'state')
+        _, state_config = self._state_config(map_path, state_dir)
+
+        # The state directory is made private
+        fileinv.ErisAnsibleInventory(state_config).create_inventory()
+        self.assertEqual(stat.S_IMODE(os.stat(state_dir).st_mode), 0o700)
+        self.assertTrue(os.path.exists(os.path.join(state_dir,
+                                                    'inventory.state')))
+
+        # A state others could have written is not read
+        os.chmod(state_dir, 0o777)
+        parsed = self._parsed_lines()
+        fileinv.ErisAnsibleInventory(state_config).create_inventory()
+        self.assertEqual(len(parsed), len(self._topology_map()))
+
+    def test_incremental_faster_than_build(self):
+        tmp_dir = self.useFixture(fixtures.TempDir()).path
+        map_path = os.path.join(tmp_dir, 'deployment.json')
+        nodes = [dict(name='node-%d' % i, groups=['compute'],
+                      ip='10.0.%d.%d' % (i / 256, i % 256),
+                      mac='52:54:00:00:%02x:%02x' % (i / 256, i % 256),
+                      ansible_ssh_variables=dict(ansible_user='root'))
+                 for i in range(5000)]
+        self._write_map(map_path, nodes)
+        eris_config, state_config = self._state_config(map_path, tmp_dir)
+        fileinv.ErisAnsibleInventory(state_config).create_inventory()
+
+        def best_time(config, change):
+            elapsed = list()
+            for i in range(3):
+                if change:
+                    nodes[i]['ip'] = '10.1.0.%d' % len(elapsed)
+                    self._write_map(map_path, nodes)
+                start = time.time()
+                fileinv.ErisAnsibleInventory(config).create_inventory()
+                elapsed.append(time.time() - start)
+            return min(elapsed)
+
+        self.assertLess(best_time(state_config, True),
+                        best_time(eris_config, False))
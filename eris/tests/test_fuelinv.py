@@ -1,8 +1,12 @@
 
 import os
 import stat
+import time
 import json
 import subprocess
+import sys
+
+import fixtures
 
 from eris.inventory import fuelinv
 
@@ -61,3 +65,229 @@ class ErisFuelInvTest(base.TestCase):
         idx = actual_output.rindex(expected_output)
         self.assertEqual(idx, 0)
 
+
+class ErisFuelTransportTest(base.TestCase):
+
+    def setUp(self):
+        super(ErisFuelTransportTest, self).setUp()
+        with open('eris/tests/datafiles/test_fuel_config.json', 'r') as fid:
+            self.eris_config = json.load(fid)
+        self.eris_config.pop('inventory_plugin')
+        self.fuel_config = self.eris_config['openstack_deployment']['fuel']
+        self.tmp_dir = self.useFixture(fixtures.TempDir()).path
+
+    def test_local_transport(self):
+        self.fuel_config['transport'] = 'local'
+        self.fuel_config['fuel_command'] = '%s %s node list --json' % (
+            sys.executable, 'eris/tests/datafiles/fake_fuel.py')
+        self.useFixture(fixtures.EnvironmentVariable('FAKE_FUEL_NODES', '6'))
+
+        inv_obj = fuelinv.ErisAnsibleInventory(self.eris_config)
+        inv_obj.create_inventory()
+
+        # The ready nodes, the fuel master and localhost
+        self.assertEqual(sorted(inv_obj.hosts),
+                         ['fuel', 'localhost'] + sorted('node-%d' % i
+                                                        for i in range(1, 7)))
+        self.assertEqual(inv_obj.get_host_vars('node-2')['ansible_host'],
+                         '10.20.0.4')
+        self.assertIn('node-2', inv_obj.inventory['cinder']['hosts'])
+
+    def test_nodes_in_command_output(self):
+        # Like ansible - the fuel JSON is in the middle of other output
+        self.fuel_config['transport'] = 'local'
+        self.fuel_config['fuel_command'] = (
+            "sh -c 'echo [WARNING]: no hosts; "
+            "echo \"fuel_host | SUCCESS | rc=0 >>\"; "
+            "%s eris/tests/datafiles/fake_fuel.py node list --json; "
+            "echo Shared connection closed.'" % sys.executable)
+        self.useFixture(fixtures.EnvironmentVariable('FAKE_FUEL_NODES',
+                                                     '5000'))
+
+        inv_obj = fuelinv.ErisAnsibleInventory(self.eris_config)
+        nodes = inv_obj._get_fuel_node_list()
+        self.assertEqual(len(nodes), 5002)
+        self.assertEqual(nodes[-1]['name'], 'node-5002')
+
+        inv_obj.create_inventory()
+        self.assertEqual(len(inv_obj.hosts), 5002)
+
+    def test_command_failure(self):
+        self.fuel_config['transport'] = 'local'
+        for fuel_command in ('false', 'sh -c "echo [{; exit 3"'):
+            self.fuel_config['fuel_command'] = fuel_command
+            inv_obj = fuelinv.ErisAnsibleInventory(self.eris_config)
+            self.assertRaises(subprocess.CalledProcessError,
+                              inv_obj.create_inventory)
+
+        self.fuel_config['fuel_command'] = 'echo no nodes'
+        inv_obj = fuelinv.ErisAnsibleInventory(self.eris_config)
+        self.assertRaises(ValueError, inv_obj.create_inventory)
+
+    def test_ssh_command(self):
+        self.fuel_config['transport'] = 'ssh'
+        self.fuel_config['ssh_control_dir'] = os.path.join(self.tmp_dir,
+                                                           'ssh')
+        ssh_vars = self.fuel_config['ansible_ssh_variables']
+        ssh_vars['ansible_ssh_common_args'] = (
+            '-o ProxyCommand="ssh -q -W %h:%p root@jump.host.local"')
+        ssh_vars['ansible_become'] = 'true'
+
+        inv_obj = fuelinv.ErisAnsibleInventory(self.eris_config)
+        command = inv_obj._fuel_command(self.fuel_config, 'ssh')
+
+        self.assertEqual(command[0], 'ssh')
+        self.assertIn('ControlMaster=auto', command)
+        self.assertIn('ControlPath=%s' % os.path.join(self.tmp_dir, 'ssh',
+                                                      '%C'), command)
+        self.assertEqual(os.stat(os.path.join(self.tmp_dir, 'ssh')).st_mode &
+                         0o777, 0o700)
+        self.assertIn('ProxyCommand=ssh -q -W %h:%p root@jump.host.local',
+                      command)
+        self.assertEqual(command[command.index('-l') + 1], 'root')
+        self.assertEqual(command[-2:], ['130.3.195.21',
+                                        'sudo -n fuel node list --json'])
+
+    def test_ssh_control_dir_must_be_private(self):
+        self.fuel_config['transport'] = 'ssh'
+        control_dir = os.path.join(self.tmp_dir, 'ssh')
+        self.fuel_config['ssh_control_dir'] = control_dir
+        os.mkdir(control_dir)
+        os.chmod(control_dir, 0o777)
+
+        inv_obj = fuelinv.ErisAnsibleInventory(self.eris_config)
+        self.assertRaises(OSError, inv_obj._fuel_command, self.fuel_config,
+                          'ssh')
+
+        os.chmod(control_dir, 0o700)
+        inv_obj._fuel_command(self.fuel_config, 'ssh')
+
+    def test_unknown_transport(self):
+        self.fuel_config['transport'] = 'carrier-pigeon'
+        inv_obj = fuelinv.ErisAnsibleInventory(self.eris_config)
+        self.assertRaises(ValueError, inv_obj.create_inventory)
+
+    def test_hard_timeout(self):
+        self.fuel_config['transport'] = 'local'
+        self.fuel_config['fuel_command'] = 'sleep 10'
+        self.fuel_config['hard_timeout'] = 0.5
+
+        inv_obj = fuelinv.ErisAnsibleInventory(self.eris_config)
+        start = time.time()
+        self.assertRaises(IOError, inv_obj.create_inventory)
+        self.assertLess(time.time() - start, 5)
+
+        # The commands it started are killed too - cat holds the output
+        self.fuel_config['fuel_command'] = "sh -c 'sleep 10 | cat'"
+        start = time.time()
+        self.assertRaises(IOError, inv_obj.create_inventory)
+        self.assertLess(time.time() - start, 5)
+
+
+class ErisFuelNodeCacheTest(base.TestCase):
+
+    def setUp(self):
+        super(ErisFuelNodeCacheTest, self).setUp()
+        with open('eris/tests/datafiles/test_fuel_config.json', 'r') as fid:
+            self.eris_config = json.load(fid)
+        self.eris_config.pop('inventory_plugin')
+        self.tmp_dir = self.useFixture(fixtures.TempDir()).path
+        self.cache_path = os.path.join(self.tmp_dir, 'fuel_nodes.json')
+
+        self.fuel_config = self.eris_config['openstack_deployment']['fuel']
+        self.fuel_config['transport'] = 'local'
+        self.fuel_config['fuel_command'] = '%s %s node list --json' % (
+            sys.executable, 'eris/tests/datafiles/fake_fuel.py')
+        self.fuel_config['node_cache'] = self.cache_path
+
+    def _create_inventory(self, node_count):
+        self.useFixture(fixtures.EnvironmentVariable('FAKE_FUEL_NODES',
+                                                     str(node_count)))
+        inv_obj = fuelinv.ErisAnsibleInventory(self.eris_config)
+        inv_obj.create_inventory()
+        return inv_obj
+
+    def _age_cache(self, seconds):
+        stale = time.time() - seconds
+        os.utime(self.cache_path, (stale, stale))
+
+    def _cached_nodes(self):
+        with open(self.cache_path, 'r') as fid:
+            return len(json.load(fid))
+
+    def test_fresh_cache(self):
+        inv_obj = self._create_inventory(4)
+        self.assertEqual(self._cached_nodes(), 6)
+
+        # Fresh - fuel is not asked again
+        inv_obj = self._create_inventory(8)
+        self.assertNotIn('node-8', inv_obj.hosts)
+        self.assertEqual(self._cached_nodes(), 6)
+
+    def test_stale_cache(self):
+        self._create_inventory(4)
+        self._age_cache(600)
+
+        # Stale - served as is and refreshed in the background
+        inv_obj = self._create_inventory(8)
+        self.assertNotIn('node-8', inv_obj.hosts)
+
+        deadline = time.time() + 10
+        while self._cached_nodes() != 10 and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self._cached_nodes(), 10)
+
+        inv_obj = self._create_inventory(8)
+        self.assertIn('node-8', inv_obj.hosts)
+
+    def test_too_stale_cache(self):
+        self._create_inventory(4)
+        self._age_cache(600)
+        self.fuel_config['max_stale'] = 60
+
+        # Too stale - fuel is asked right away
+        inv_obj = self._create_inventory(8)
+        self.assertIn('node-8', inv_obj.hosts)
+        self.assertEqual(self._cached_nodes(), 10)
+
+    def test_fallback_to_cache(self):
+        self._create_inventory(4)
+        self._age_cache(600)
+        self.fuel_config['max_stale'] = 60
+
+        for fuel_command, hard_timeout in (('false', None),
+                                           ('sleep 10', 0.5)):
+            self.fuel_config['fuel_command'] = fuel_command
+            self.fuel_config['hard_timeout'] = hard_timeout
+            inv_obj = self._create_inventory(8)
+            self.assertIn('node-4', inv_obj.hosts)
+            self.assertNotIn('node-8', inv_obj.hosts)
+            self.assertEqual(self._cached_nodes(), 6)
+
+    def test_cache_dir_must_be_private(self):
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.cache_path = os.path.join(cache_dir, 'fuel_nodes.json')
+        self.fuel_config['node_cache'] = self.cache_path
+
+        # The cache directory is made private
+        self._create_inventory(4)
+        self.assertEqual(stat.S_IMODE(os.stat(cache_dir).st_mode), 0o700)
+        self.assertEqual(self._cached_nodes(), 6)
+
+        # A node cache others could have written is neither used
+        # nor replaced
+        os.chmod(cache_dir, 0o777)
+        inv_obj = self._create_inventory(8)
+        self.assertIn('node-8', inv_obj.hosts)
+        self.assertEqual(self._cached_nodes(), 6)
+
+        # Nor is it the fallback when fuel fails
+        self.fuel_config['fuel_command'] = 'false'
+        self.assertRaises(subprocess.CalledProcessError,
+                          self._create_inventory, 4)
+
+    def test_no_cache(self):
+        self.fuel_config['fuel_command'] = 'false'
+        self.assertRaises(subprocess.CalledProcessError,
+                          self._create_inventory, 4)
+        self.assertFalse(os.path.exists(self.cache_path))
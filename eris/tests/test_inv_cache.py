@@ -0,0 +1,173 @@
+
+import json
+import StringIO
+import os
+import time
+
+import fixtures
+
+from eris.cli import erisinv
+from eris.inventory import inv_cache
+
+from eris.tests import base
+
+
+class InventoryCacheTestCase(base.TestCase):
+
+    def setUp(self):
+        super(InventoryCacheTestCase, self).setUp()
+        self.tmp_dir = self.useFixture(fixtures.TempDir()).path
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+
+        with open('eris/tests/datafiles/test_config.json', 'r') as fid:
+            eris_config = json.load(fid)
+        eris_config['inventory_cache'] = dict(cache_dir=self.cache_dir,
+                                              ttl=300)
+        self.config_file = os.path.join(self.tmp_dir, 'config.json')
+        with open(self.config_file, 'w') as fid:
+            json.dump(eris_config, fid)
+
+        self.useFixture(fixtures.EnvironmentVariable('ERIS_CONFIG_FILE',
+                                                     self.config_file))
+        self.useFixture(fixtures.EnvironmentVariable(erisinv.REFRESH_ENV))
+
+    def _cache_entries(self):
+        return [name for name in os.listdir(self.cache_dir)
+                if name.startswith(inv_cache.CACHE_PREFIX)]
+
+    def test_cache_hit(self):
+        inv_json = erisinv.main(['erisinv', '--list'])
+        self.assertEqual(len(self._cache_entries()), 1)
+
+        # Plant a marker in the cache entry - the next call must return it
+        entry = os.path.join(self.cache_dir, self._cache_entries()[0])
+        with open(entry, 'w') as fid:
+            fid.write('cached')
+        self.assertEqual(erisinv.main(['erisinv', '--list']), 'cached')
+
+        # The cache section never makes it into the inventory
+        self.assertNotIn('inventory_cache', json.loads(inv_json))
+
+    def test_cache_hit_skips_plugin_import(self):
+        inv_json = erisinv.main(['erisinv', '--list'])
+
+        def no_import(name):
+            raise AssertionError('%s imported on a cache hit' % name)
+
+        self.useFixture(fixtures.MonkeyPatch('importlib.import_module',
+                                             no_import))
+        self.assertEqual(erisinv.main(['erisinv', '--list']), inv_json)
+
+    def test_cache_forced_refresh(self):
+        erisinv.main(['erisinv', '--list'])
+        entry = os.path.join(self.cache_dir, self._cache_entries()[0])
+        with open(entry, 'w') as fid:
+            fid.write('cached')
+
+        self.useFixture(fixtures.EnvironmentVariable(erisinv.REFRESH_ENV,
+                                                     '1'))
+        inv_json = erisinv.main(['erisinv', '--list'])
+        self.assertIn('localhost', json.loads(inv_json)['_meta']['hostvars'])
+
+    def test_cache_ttl_expiry(self):
+        cache = inv_cache.InventoryCache(self.cache_dir, ttl=10)
+        cache.put('abc', '{}')
+        self.assertEqual(cache.get('abc'), '{}')
+
+        stale = time.time() - 20
+        os.utime(os.path.join(self.cache_dir, 'inventory-abc.json'),
+                 (stale, stale))
+        self.assertIsNone(cache.get('abc'))
+
+    def test_cache_disabled(self):
+        cache = inv_cache.InventoryCache(self.cache_dir, ttl=0)
+        cache.put('abc', '{}')
+        self.assertIsNone(cache.get('abc'))
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test_cache_dir_must_be_private(self):
+        cache = inv_cache.InventoryCache(self.cache_dir, ttl=10)
+        cache.put('abc', '{}')
+        self.assertEqual(os.stat(self.cache_dir).st_mode & 0o777, 0o700)
+        self.assertEqual(cache.get('abc'), '{}')
+
+        # Open to other users - an entry someone else planted is not
+        # used and nothing is written
+        os.chmod(self.cache_dir, 0o777)
+        self.assertIsNone(cache.get('abc'))
+        cache.put('def', '{}')
+        self.assertEqual(self._cache_entries(), ['inventory-abc.json'])
+
+    def test_fingerprint_changes(self):
+        map_file = os.path.join(self.tmp_dir, 'map.json')
+        with open(map_file, 'w') as fid:
+            fid.write('[]')
+        config = dict(openstack_deployment=dict(deployment_map=map_file))
+
+        fp1 = inv_cache.InventoryCache.fingerprint('data', config, 'plugin')
+        self.assertEqual(
+            fp1, inv_cache.InventoryCache.fingerprint('data', config,
+                                                      'plugin'))
+        self.assertNotEqual(
+            fp1, inv_cache.InventoryCache.fingerprint('other', config,
+                                                      'plugin'))
+        self.assertNotEqual(
+            fp1, inv_cache.InventoryCache.fingerprint('data', config,
+                                                      'other'))
+
+        with open(map_file, 'w') as fid:
+            fid.write('[{}]')
+        self.assertNotEqual(
+            fp1, inv_cache.InventoryCache.fingerprint('data', config,
+                                                      'plugin'))
+
+    def test_fingerprint_source_maps(self):
+        map_files = [os.path.join(self.tmp_dir, name)
+                     for name in ('east.json', 'west.json')]
+        for map_file in map_files:
+            with open(map_file, 'w') as fid:
+                fid.write('[]')
+        # A multi inventory with a nested multi inventory source
+        config = dict(inventory_sources=[
+            dict(openstack_deployment=dict(deployment_map=map_files[0])),
+            dict(inventory_sources=[
+                dict(openstack_deployment=dict(
+                    deployment_map=map_files[1]))])])
+
+        fp1 = inv_cache.InventoryCache.fingerprint('data', config, 'plugin')
+        with open(map_files[1], 'w') as fid:
+            fid.write('[{}]')
+        fp2 = inv_cache.InventoryCache.fingerprint('data', config, 'plugin')
+        self.assertNotEqual(fp1, fp2)
+
+        with open(map_files[0], 'w') as fid:
+            fid.write('[{}]')
+        self.assertNotEqual(
+            fp2, inv_cache.InventoryCache.fingerprint('data', config,
+                                                      'plugin'))
+
+    def test_put_replaces_old_entries(self):
+        cache = inv_cache.InventoryCache(self.cache_dir, ttl=10)
+        cache.put('abc', '{}')
+        cache.put('def', '{}')
+        self.assertEqual(self._cache_entries(), ['inventory-def.json'])
+        cache.invalidate()
+        self.assertEqual(self._cache_entries(), [])
+
+    def test_write_to_file(self):
+        # Written straight out without and with the cache
+        expected = json.loads(erisinv.main(['erisinv', '--list']))
+        for refresh in ('1', ''):
+            self.useFixture(fixtures.EnvironmentVariable(erisinv.REFRESH_ENV,
+                                                         refresh))
+            out = StringIO.StringIO()
+            self.assertIsNone(erisinv.main(['erisinv', '--list'], out))
+            self.assertEqual(json.loads(out.getvalue()), expected)
+
+        out = StringIO.StringIO()
+        self.useFixture(fixtures.EnvironmentVariable('ERIS_CONFIG_FILE',
+                                                     'eris/tests/datafiles/'
+                                                     'test_config.json'))
+        erisinv.main(['erisinv', '--list'], out)
+        self.assertEqual(json.loads(out.getvalue())['_meta'],
+                         expected['_meta'])
@@ -0,0 +1,140 @@
+
+import json
+import os
+import shutil
+import threading
+
+import fixtures
+
+from eris.cli import erisinv
+from eris.cli import inv_daemon
+from eris.utils import control
+
+from eris.tests import base
+
+
+class InventoryServerTestCase(base.TestCase):
+
+    def setUp(self):
+        super(InventoryServerTestCase, self).setUp()
+        self.tmp_dir = self.useFixture(fixtures.TempDir()).path
+        self.socket_path = os.path.join(self.tmp_dir, 'erisinv.sock')
+
+        self.map_file = os.path.join(self.tmp_dir, 'deployment.json')
+        shutil.copyfile('eris/tests/datafiles/test_deployment.json',
+                        self.map_file)
+        with open('eris/tests/datafiles/test_config.json', 'r') as fid:
+            eris_config = json.load(fid)
+        eris_config['openstack_deployment']['deployment_map'] = self.map_file
+        self.config_file = os.path.join(self.tmp_dir, 'config.json')
+        with open(self.config_file, 'w') as fid:
+            json.dump(eris_config, fid)
+
+        self.useFixture(fixtures.EnvironmentVariable('ERIS_CONFIG_FILE',
+                                                     self.config_file))
+        self.useFixture(fixtures.EnvironmentVariable(erisinv.REFRESH_ENV))
+        self.useFixture(fixtures.EnvironmentVariable(erisinv.SOCKET_ENV))
+
+    def _start_server(self):
+        server = inv_daemon.InventoryServer(self.config_file,
+                                            refresh_interval=0)
+        server.listen(self.socket_path)
+        loop = threading.Thread(target=server.loop_forever)
+        loop.start()
+
+        def stop_loop():
+            if loop.is_alive():
+                control.send_request(self.socket_path, dict(op='stop'))
+                loop.join(10)
+
+        self.addCleanup(stop_loop)
+        return server, loop
+
+    def test_requests(self):
+        server = inv_daemon.InventoryServer(self.config_file,
+                                            refresh_interval=0)
+        inventory = json.loads(server.handle_request(dict(op='list'))[
+            'inventory'])
+        self.assertEqual(inventory, json.loads(erisinv.main(['erisinv',
+                                                             '--list'])))
+
+        response = server.handle_request(dict(op='host', name='fuel'))
+        self.assertEqual(json.loads(response['inventory']),
+                         inventory['_meta']['hostvars']['fuel'])
+        response = server.handle_request(dict(op='group', name='nogrp'))
+        self.assertEqual(response['inventory'], '{}')
+
+        # Built once - nothing changed since
+        self.assertEqual(server.handle_request(dict(op='status'))['builds'],
+                         1)
+        server.handle_request(dict(op='list', refresh=True))
+        self.assertEqual(server.builds, 2)
+
+        response = server.handle_request(dict(op='select',
+                                              pattern='compute',
+                                              count=2, seed=1))
+        self.assertEqual(len(response['hosts']), 2)
+        self.assertTrue(set(response['hosts']) <=
+                        set(inventory['compute']['hosts']))
+
+        for request in (dict(op='bogus'), dict(op='host'),
+                        dict(op='host', name=['fuel']),
+                        dict(op='select', pattern='nogrp'),
+                        dict(op='select', where=['ansible_host']),
+                        dict(op='select', pattern=1),
+                        dict(op='select', count='2'),
+                        dict(op='select', count=True),
+                        dict(op='select', seed=[1]),
+                        dict(op='select', distinct_groups=dict()),
+                        dict(op='list', config='/some/other/config.json')):
+            self.assertFalse(server.handle_request(request)['ok'])
+
+    def test_socket_dir_must_be_private(self):
+        socket_dir = os.path.join(self.tmp_dir, 'sockets')
+        os.mkdir(socket_dir, 0o755)
+        os.chmod(socket_dir, 0o755)
+        server = inv_daemon.InventoryServer(self.config_file,
+                                            refresh_interval=0)
+        self.assertRaises(OSError, server.listen,
+                          os.path.join(socket_dir, 'erisinv.sock'))
+        self.assertEqual(os.listdir(socket_dir), [])
+
+    def test_rebuilt_on_map_change(self):
+        server = inv_daemon.InventoryServer(self.config_file,
+                                            refresh_interval=0)
+        server.handle_request(dict(op='list'))
+
+        with open(self.map_file, 'r') as fid:
+            nodes = json.load(fid)
+        nodes.append(dict(name='newnode', groups=['compute'],
+                          ip='10.0.0.99', mac='52:54:00:00:00:99',
+                          type='vm'))
+        with open(self.map_file, 'w') as fid:
+            json.dump(nodes, fid)
+
+        response = server.handle_request(dict(op='host', name='newnode'))
+        self.assertEqual(json.loads(response['inventory'])['ansible_host'],
+                         '10.0.0.99')
+        self.assertEqual(server.builds, 2)
+
+    def test_client_uses_server(self):
+        server, loop = self._start_server()
+        expected = erisinv.main(['erisinv', '--list'])
+
+        self.useFixture(fixtures.EnvironmentVariable(erisinv.SOCKET_ENV,
+                                                     self.socket_path))
+        self.assertEqual(json.loads(erisinv.main(['erisinv', '--list'])),
+                         json.loads(expected))
+        self.assertEqual(json.loads(erisinv.main(['erisinv', '--host',
+                                                  'fuel'])),
+                         server.inventory_obj.get_host_vars('fuel'))
+        self.assertEqual(server.builds, 1)
+
+        control.send_request(self.socket_path, dict(op='stop'))
+        loop.join(10)
+        self.assertFalse(loop.is_alive())
+        self.assertFalse(os.path.exists(self.socket_path))
+
+        # No server - the client builds the inventory itself
+        self.assertEqual(json.loads(erisinv.main(['erisinv', '--list'])),
+                         json.loads(expected))
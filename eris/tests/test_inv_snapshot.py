@@ -0,0 +1,142 @@
+
+import json
+import os
+import sqlite3
+import time
+
+import fixtures
+
+from eris.cli import erisinv
+from eris.inventory import inv_snapshot
+
+from eris.tests import base
+
+
+class InventorySnapshotTestCase(base.TestCase):
+
+    def setUp(self):
+        super(InventorySnapshotTestCase, self).setUp()
+        self.tmp_dir = self.useFixture(fixtures.TempDir()).path
+        self.snapshot_path = os.path.join(self.tmp_dir, 'snap',
+                                          'inventory.db')
+
+        with open('eris/tests/datafiles/test_config.json', 'r') as fid:
+            eris_config = json.load(fid)
+        eris_config['inventory_snapshot'] = dict(path=self.snapshot_path)
+        self.config_file = os.path.join(self.tmp_dir, 'config.json')
+        with open(self.config_file, 'w') as fid:
+            json.dump(eris_config, fid)
+
+        self.useFixture(fixtures.EnvironmentVariable('ERIS_CONFIG_FILE',
+                                                     self.config_file))
+        self.useFixture(fixtures.EnvironmentVariable(erisinv.REFRESH_ENV))
+
+    def _plant(self, table, name, value):
+        conn = sqlite3.connect(self.snapshot_path)
+        conn.execute('UPDATE %s SET %s = ? WHERE name = ?' %
+                     (table, 'vars' if table == 'hosts' else 'data'),
+                     (value, name))
+        conn.commit()
+        conn.close()
+
+    def test_host_and_group(self):
+        inventory = json.loads(erisinv.main(['erisinv', '--list']))
+        self.assertTrue(os.path.isfile(self.snapshot_path))
+        self.assertNotIn('inventory_snapshot', inventory)
+
+        host_vars = json.loads(erisinv.main(['erisinv', '--host',
+                                             'computesre103']))
+        self.assertEqual(host_vars,
+                         inventory['_meta']['hostvars']['computesre103'])
+
+        group = json.loads(erisinv.main(['erisinv', '--group', 'mysql']))
+        self.assertEqual(sorted(group['hosts']),
+                         sorted(inventory['mysql']['hosts']))
+        self.assertEqual(group['vars'], inventory['mysql']['vars'])
+
+        self.assertEqual(erisinv.main(['erisinv', '--host', 'nohost']), '{}')
+        self.assertEqual(erisinv.main(['erisinv', '--group', 'nogrp']), '{}')
+
+    def test_lookup_served_from_snapshot(self):
+        erisinv.main(['erisinv', '--list'])
+
+        # Plant a marker in the snapshot - the lookup must return it
+        self._plant('hosts', 'computesre103', '{"marker": 1}')
+        self.assertEqual(erisinv.main(['erisinv', '--host', 'computesre103']),
+                         '{"marker": 1}')
+
+        # Unless a refresh is forced
+        self.useFixture(fixtures.EnvironmentVariable(erisinv.REFRESH_ENV,
+                                                     '1'))
+        host_vars = json.loads(erisinv.main(['erisinv', '--host',
+                                             'computesre103']))
+        self.assertNotIn('marker', host_vars)
+
+    def test_stale_snapshot_rebuilt(self):
+        erisinv.main(['erisinv', '--list'])
+        self._plant('groups', 'mysql', '{"marker": 1}')
+
+        # The sources changed - the snapshot is no longer used
+        with open(self.config_file, 'a') as fid:
+            fid.write('\n')
+        group = json.loads(erisinv.main(['erisinv', '--group', 'mysql']))
+        self.assertNotIn('marker', group)
+
+        # The lookup wrote a new snapshot
+        self._plant('groups', 'mysql', '{"marker": 2}')
+        self.assertEqual(erisinv.main(['erisinv', '--group', 'mysql']),
+                         '{"marker": 2}')
+
+    def test_expired_snapshot_rebuilt(self):
+        erisinv.main(['erisinv', '--list'])
+        self._plant('hosts', 'computesre103', '{"marker": 1}')
+        self.assertEqual(erisinv.main(['erisinv', '--host', 'computesre103']),
+                         '{"marker": 1}')
+
+        # Built longer than the ttl ago - the sources could have changed
+        # without the fingerprint changing (like fuel nodes)
+        conn = sqlite3.connect(self.snapshot_path)
+        conn.execute("UPDATE meta SET value = ? WHERE key = 'built_at'",
+                     (repr(time.time() - inv_snapshot.DEFAULT_TTL - 1),))
+        conn.commit()
+        conn.close()
+        host_vars = json.loads(erisinv.main(['erisinv', '--host',
+                                             'computesre103']))
+        self.assertNotIn('marker', host_vars)
+
+        # The lookup wrote a new snapshot
+        self._plant('hosts', 'computesre103', '{"marker": 2}')
+        self.assertEqual(erisinv.main(['erisinv', '--host', 'computesre103']),
+                         '{"marker": 2}')
+
+    def test_missing_snapshot(self):
+        snapshot = inv_snapshot.InventorySnapshot(self.snapshot_path)
+        self.assertIsNone(snapshot.lookup('abc', 'host', 'fuel'))
+        self.assertFalse(os.path.exists(self.snapshot_path))
+        self.assertRaises(ValueError, snapshot.lookup, 'abc', 'node', 'fuel')
+
+    def test_snapshot_dir_must_be_private(self):
+        erisinv.main(['erisinv', '--list'])
+        snapshot_dir = os.path.dirname(self.snapshot_path)
+        self.assertEqual(os.stat(snapshot_dir).st_mode & 0o777, 0o700)
+        self._plant('hosts', 'computesre103', '{"marker": 1}')
+        snapshot = inv_snapshot.InventorySnapshot(self.snapshot_path)
+        conn = sqlite3.connect(self.snapshot_path)
+        meta = dict(conn.execute('SELECT key, value FROM meta'))
+        conn.close()
+        self.assertEqual(snapshot.lookup(meta['fingerprint'], 'host',
+                                         'computesre103'), '{"marker": 1}')
+
+        # Open to other users - a snapshot someone else planted is
+        # not used and nothing is written
+        os.chmod(snapshot_dir, 0o777)
+        self.assertIsNone(snapshot.lookup(meta['fingerprint'], 'host',
+                                          'computesre103'))
+        snapshot.put('abc', None)
+        self.assertEqual(os.listdir(snapshot_dir), ['inventory.db'])
+
+    def test_incorrect_argv(self):
+        for argv in (['erisinv'], ['erisinv', '--host'],
+                     ['erisinv', '--list', 'fuel'],
+                     ['erisinv', '--node', 'fuel']):
+            self.assertRaises(ValueError, erisinv.main, argv)
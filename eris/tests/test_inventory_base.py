@@ -1,4 +1,5 @@
 import json
+import StringIO
 
 from eris.inventory import inventory_base
 
@@ -103,3 +104,258 @@ class InventoryBaseTestCase(base.TestCase):
             self.assertEqual(json_dict[key]['vars'], dummy_dict[key]['vars'])
             self.assertEqual(set(json_dict[key]['children']),
                              set(dummy_dict[key]['children']))
+
+    def test_bulk_inventory_creation(self):
+        # TEST: The bulk calls build the same inventory
+        ib = inventory_base.ErisInventoryBase(dict())
+
+        ib.add_hosts({"some_vm1": {"var1": "val1"}})
+        ib.add_hosts([("some_vm1", {"var2": "val2"}),
+                      ("some_vm2", {"var1": "val1"})])
+        ib.add_vars_to_host("some_vm2", {"var2": "val2"})
+
+        ib.add_group("group1")
+        ib.add_group("group2")
+        ib.add_group("group3")
+
+        ib.add_hosts_to_group("group1", ["some_vm1", "some_vm2"])
+        ib.add_vars_to_group("group1", {"gvar1": "val1", "gvar2": "val2"})
+        ib.add_children_to_group("group2", ["group1"])
+        ib.add_hosts_to_group("group3", ["some_vm1"])
+        ib.add_vars_to_group("group3", {"gvar1": "val1"})
+        ib.add_children_to_group("group3", ["group1", "group2"])
+
+        json_dict = json.loads(ib.serialize_to_json())
+        dummy_dict = json.loads(json.dumps(DUMMY_INVENTORY))
+        self.assertEqual(json_dict['_meta'], dummy_dict['_meta'])
+        self.assertEqual(set(json_dict.keys()), set(dummy_dict.keys()))
+        for key in json_dict:
+            if key == '_meta':
+                continue
+            self.assertEqual(set(json_dict[key]['hosts']),
+                             set(dummy_dict[key]['hosts']))
+            self.assertEqual(json_dict[key]['vars'], dummy_dict[key]['vars'])
+            self.assertEqual(set(json_dict[key]['children']),
+                             set(dummy_dict[key]['children']))
+
+    def test_bulk_validation(self):
+        # TEST: Nothing is added when a host or group is missing
+        ib = inventory_base.ErisInventoryBase(dict())
+        ib.add_hosts({"some_vm1": {}})
+        ib.add_group("group1")
+
+        self.assertRaises(ValueError, ib.add_hosts_to_group,
+                          "group1", ["some_vm1", "some_vm2"])
+        self.assertEqual(ib.inventory["group1"]["hosts"], set())
+        self.assertEqual(ib.get_host_vars("some_vm1"), dict())
+        self.assertRaises(ValueError, ib.add_hosts_to_group,
+                          "group2", ["some_vm1"])
+        self.assertRaises(ValueError, ib.add_children_to_group,
+                          "group1", ["group2"])
+        self.assertRaises(ValueError, ib.add_vars_to_group,
+                          "group2", {"var1": "val1"})
+        self.assertRaises(ValueError, ib.add_vars_to_host,
+                          "some_vm2", {"var1": "val1"})
+
+    def test_shared_host_vars(self):
+        # TEST: Hosts with the same shared variables share them and
+        # the host variables override the shared ones
+        ib = inventory_base.ErisInventoryBase(dict())
+        ssh_vars = {"ansible_user": "root", "ansible_become": "true"}
+        ib.add_hosts([("some_vm1", {"ansible_host": "10.0.0.1"},
+                       dict(ssh_vars)),
+                      ("some_vm2", {"ansible_host": "10.0.0.2"},
+                       dict(ssh_vars))])
+        self.assertIs(ib.hosts["some_vm1"].names, ib.hosts["some_vm2"].names)
+        ib.add_var_to_host("some_vm2", "ansible_user", "admin")
+
+        self.assertIs(ib.hosts["some_vm1"].shared, ib.hosts["some_vm2"].shared)
+        self.assertEqual(ib.get_host_vars("some_vm1"),
+                         {"ansible_host": "10.0.0.1", "ansible_user": "root",
+                          "ansible_become": "true"})
+        self.assertEqual(ib.get_host_vars("some_vm2"),
+                         {"ansible_host": "10.0.0.2", "ansible_user": "admin",
+                          "ansible_become": "true"})
+
+        hostvars = json.loads(ib.serialize_to_json())['_meta']['hostvars']
+        self.assertEqual(hostvars["some_vm2"], ib.get_host_vars("some_vm2"))
+
+    def test_shared_host_vars_types(self):
+        # TEST: Equal values of different types are not shared
+        ib = inventory_base.ErisInventoryBase(dict())
+        ib.add_hosts([("some_vm1", dict(), {"port": 1}),
+                      ("some_vm2", dict(), {"port": True}),
+                      ("some_vm3", dict(), {"port": 1.0})])
+
+        ports = [ib.get_host_vars(host_name)["port"]
+                 for host_name in ("some_vm1", "some_vm2", "some_vm3")]
+        self.assertEqual([type(port) for port in ports], [int, bool, float])
+
+    def test_serializers(self):
+        # TEST: The compact, pretty and streamed outputs are the same
+        # inventory
+        ib = inventory_base.ErisInventoryBase(dict())
+        ib.add_hosts(dict(("vm%d" % i, {"var1": i}) for i in range(2500)))
+        ib.add_group("group1")
+        ib.add_group("group2")
+        ib.add_hosts_to_group("group1", ["vm2", "vm1", "vm3"])
+        ib.add_vars_to_group("group1", {"gvar1": "val1"})
+        ib.add_child_to_group("group2", "group1")
+
+        compact = ib.serialize_to_json()
+        pretty = ib.serialize_to_json(pretty=True)
+        stream = StringIO.StringIO()
+        ib.serialize_to_stream(stream)
+
+        self.assertNotIn('\n', compact)
+        self.assertIn('\n', pretty)
+        inventory = json.loads(pretty)
+        self.assertEqual(inventory["group1"]["hosts"], ["vm1", "vm2", "vm3"])
+        self.assertEqual(len(inventory["_meta"]["hostvars"]), 2500)
+        for output in (compact, stream.getvalue()):
+            output = json.loads(output)
+            output["group1"]["hosts"].sort()
+            self.assertEqual(output, inventory)
+
+        self.assertEqual(ib.get_group("group1", pretty=True),
+                         inventory["group1"])
+        self.assertEqual(ib.get_group("group2"), inventory["group2"])
+        self.assertRaises(ValueError, ib.get_group, "nogroup")
+
+    def _rack_inventory(self):
+        # 4 racks of 5 hosts. Every host is in rabbitmq or mysql and
+        # the even hosts are in controller.
+        ib = inventory_base.ErisInventoryBase(dict())
+        ib.add_hosts(("vm%d" % i, {"rack": i / 5, "index": i},
+                      {"ansible_user": "root"}) for i in range(20))
+        for group in ("rabbitmq", "mysql", "controller", "root"):
+            ib.add_group(group)
+        for rack in range(4):
+            ib.add_group("rack_%d" % rack)
+            ib.add_hosts_to_group("rack_%d" % rack,
+                                  ["vm%d" % i for i in range(rack * 5,
+                                                             rack * 5 + 5)])
+        ib.add_hosts_to_group("rabbitmq", ["vm%d" % i for i in range(10)])
+        ib.add_hosts_to_group("mysql", ["vm%d" % i for i in range(10, 20)])
+        ib.add_hosts_to_group("controller",
+                              ["vm%d" % i for i in range(0, 20, 2)])
+        ib.add_children_to_group("root", ["rabbitmq", "mysql"])
+        return ib
+
+    def test_select_hosts(self):
+        ib = self._rack_inventory()
+        rabbitmq = set("vm%d" % i for i in range(10))
+
+        self.assertEqual(ib.select_hosts(), set(ib.hosts))
+        self.assertEqual(ib.select_hosts("root"), set(ib.hosts))
+        self.assertEqual(ib.select_hosts("rabbitmq:&controller"),
+                         set("vm%d" % i for i in range(0, 10, 2)))
+        self.assertEqual(ib.select_hosts("&controller,rabbitmq"),
+                         ib.select_hosts("rabbitmq:&controller"))
+        self.assertEqual(ib.select_hosts("root:!mysql:!vm1"),
+                         rabbitmq - set(["vm1"]))
+        self.assertEqual(ib.select_hosts("rack_[02]:&mysql"),
+                         set(["vm10", "vm11", "vm12", "vm13", "vm14"]))
+        self.assertEqual(ib.select_hosts("vm1*"),
+                         set("vm%d" % i for i in [1] + range(10, 20)))
+        self.assertRaises(ValueError, ib.select_hosts, "rabbitmq:&nogroup")
+
+        # Host variables - the values are indexed, functions are called
+        self.assertEqual(ib.select_hosts("rabbitmq", where={"rack": 1}),
+                         set("vm%d" % i for i in range(5, 10)))
+        self.assertEqual(ib.select_hosts(where={"ansible_user": "root",
+                                                "index": lambda i: i > 17}),
+                         set(["vm18", "vm19"]))
+        self.assertEqual(ib.select_hosts(where={"rack": [1]}), set())
+
+        # The indexes are dropped when the inventory changes
+        ib.add_host("vm20")
+        ib.add_var_to_host("vm20", "rack", 1)
+        ib.add_host_to_group("rabbitmq", "vm20")
+        self.assertIn("vm20", ib.select_hosts("root", where={"rack": 1}))
+
+    def test_select_sample(self):
+        ib = self._rack_inventory()
+
+        picked = ib.select_hosts("root", count=3, seed=42)
+        self.assertEqual(len(picked), 3)
+        self.assertEqual(ib.select_hosts("root", count=3, seed=42), picked)
+        self.assertTrue(picked <= set(ib.hosts))
+
+        # Never two hosts from the same rack
+        for seed in range(20):
+            for distinct in (dict(distinct_var="rack"),
+                             dict(distinct_groups="rack_*")):
+                picked = ib.select_hosts("controller", count=4, seed=seed,
+                                         **distinct)
+                self.assertEqual(len(set(ib.get_host_vars(host)["rack"]
+                                         for host in picked)), 4)
+
+        # Halves of a rack match the glob too - hosts in different
+        # halves of the same rack still have the rack in common
+        for half, hosts in (("a", range(0, 3)), ("b", range(3, 5))):
+            ib.add_group("rack_0_%s" % half)
+            ib.add_hosts_to_group("rack_0_%s" % half,
+                                  ["vm%d" % i for i in hosts])
+        for seed in range(20):
+            picked = ib.select_hosts("root", count=4, seed=seed,
+                                     distinct_groups="rack_*")
+            self.assertEqual(len(set(ib.get_host_vars(host)["rack"]
+                                     for host in picked)), 4)
+        self.assertRaises(ValueError, ib.select_hosts, "root", count=5,
+                          distinct_groups="rack_*")
+
+        self.assertRaises(ValueError, ib.select_hosts, "rabbitmq", count=3,
+                          distinct_var="rack")
+        self.assertRaises(ValueError, ib.select_hosts, "rabbitmq", count=11)
+
+    def test_group_closure(self):
+        ib = self._rack_inventory()
+        ib.add_group("site")
+        ib.add_children_to_group("site", ["root", "rack_0"])
+
+        self.assertEqual(ib.get_group_descendants("site"),
+                         frozenset(["root", "rabbitmq", "mysql", "rack_0"]))
+        self.assertEqual(ib.get_group_hosts("site"), frozenset(ib.hosts))
+        self.assertEqual(ib.get_group_hosts("rabbitmq"),
+                         frozenset("vm%d" % i for i in range(10)))
+        self.assertTrue(ib.group_has_host("root", "vm19"))
+        self.assertFalse(ib.group_has_host("rack_0", "vm19"))
+        self.assertRaises(ValueError, ib.get_group_hosts, "nogroup")
+
+        # Kept until the group or a descendant changes
+        self.assertIs(ib.get_group_hosts("root"), ib.get_group_hosts("root"))
+        rack_1 = ib.get_group_hosts("rack_1")
+        ib.add_host("vm20")
+        ib.add_host_to_group("rabbitmq", "vm20")
+        self.assertIs(ib.get_group_hosts("rack_1"), rack_1)
+        self.assertTrue(ib.group_has_host("site", "vm20"))
+        self.assertTrue(ib.group_has_host("root", "vm20"))
+
+        ib.add_group("rack_4")
+        ib.add_child_to_group("rack_0", "rack_4")
+        self.assertIn("rack_4", ib.get_group_descendants("site"))
+        ib.add_host("vm21")
+        ib.add_hosts_to_group("rack_4", ["vm21"])
+        self.assertTrue(ib.group_has_host("site", "vm21"))
+        self.assertFalse(ib.group_has_host("root", "vm21"))
+
+    def test_group_cycles(self):
+        ib = self._rack_inventory()
+        ib.add_group("site")
+        ib.add_child_to_group("site", "root")
+
+        # Refused when the child is added - nothing changes
+        self.assertRaises(ValueError, ib.add_child_to_group, "rabbitmq",
+                          "site")
+        self.assertRaises(ValueError, ib.add_child_to_group, "root", "root")
+        self.assertRaises(ValueError, ib.add_children_to_group, "mysql",
+                          ["rack_0", "root"])
+        self.assertEqual(ib.inventory["rabbitmq"]["children"], set())
+        self.assertEqual(ib.inventory["mysql"]["children"], set())
+        self.assertEqual(ib.select_hosts("site"), set(ib.hosts))
+
+        # A cycle made around the add methods is still caught
+        ib.inventory["rabbitmq"]["children"].add("site")
+        ib._inventory_changed()
+        self.assertRaises(ValueError, ib.select_hosts, "site")
@@ -0,0 +1,68 @@
+
+import os
+
+import fixtures
+
+from eris.utils import journal
+
+from eris.tests import base
+
+
+class JournalTestCase(base.TestCase):
+
+    def setUp(self):
+        super(JournalTestCase, self).setUp()
+        self.path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                 'test.journal')
+
+    def _reload(self, j=None):
+        if j is not None:
+            j.close()
+        j = journal.Journal(self.path)
+        self.addCleanup(j.close)
+        return j, j.load()
+
+    def test_replay(self):
+        j, records = self._reload()
+        self.assertEqual(records, dict())
+
+        j.put('a', dict(x=1, y=2))
+        j.put('b', dict(x=3))
+        j.put('a', dict(y=4))
+        j.delete('b')
+        j.delete('c')
+
+        j, records = self._reload(j)
+        self.assertEqual(records, dict(a=dict(x=1, y=4)))
+        self.assertEqual(j.log_size, 5)
+
+    def test_torn_change(self):
+        j, _ = self._reload()
+        j.put('a', dict(x=1))
+        j.close()
+        with open(self.path, 'a') as fid:
+            fid.write('["b", {"x"')
+
+        # The torn change is dropped and the log is usable again
+        j, records = self._reload()
+        self.assertEqual(records, dict(a=dict(x=1)))
+        j.put('c', dict(x=2))
+        j, records = self._reload(j)
+        self.assertEqual(records, dict(a=dict(x=1), c=dict(x=2)))
+
+    def test_compact(self):
+        j, _ = self._reload()
+        j.compact_every = 10
+        for i in range(20):
+            j.put('a', dict(x=i))
+        self.assertTrue(j.needs_compaction(1))
+        self.assertFalse(j.needs_compaction(100))
+
+        j.compact(dict(a=dict(x=19)))
+        self.assertEqual(j.log_size, 0)
+        self.assertEqual(os.path.getsize(self.path), 0)
+
+        j.put('b', dict(x=1))
+        j, records = self._reload(j)
+        self.assertEqual(records, dict(a=dict(x=19), b=dict(x=1)))
+        self.assertEqual(j.log_size, 1)
@@ -0,0 +1,84 @@
+
+import json
+import StringIO
+
+from eris.utils import jsonstream
+
+from eris.tests import base
+
+
+class JsonStreamTestCase(base.TestCase):
+
+    def _parse(self, data, chunk_size=jsonstream.CHUNK_SIZE):
+        return list(jsonstream.iter_json(StringIO.StringIO(data),
+                                         chunk_size))
+
+    def test_array(self):
+        self.assertEqual(self._parse('[1, {"a": [2, 3]}, "x"]'),
+                         [1, {'a': [2, 3]}, 'x'])
+        self.assertEqual(self._parse(' [ ] '), [])
+
+    def test_values(self):
+        self.assertEqual(self._parse(''), [])
+        self.assertEqual(self._parse('{"a": 1}'), [{'a': 1}])
+        self.assertEqual(self._parse('{"a": 1}\n{"b": 2}\n\n3\n'),
+                         [{'a': 1}, {'b': 2}, 3])
+
+    def test_small_chunks(self):
+        values = [dict(name='node-%d' % i, ids=range(i)) for i in range(50)]
+        data = '[' + ', '.join(['{"name": "node-%d", "ids": %s}' %
+                                (i, range(i)) for i in range(50)]) + ']'
+        for chunk_size in (1, 2, 7, 64):
+            self.assertEqual(self._parse(data, chunk_size), values)
+
+    def test_number_across_chunks(self):
+        # The first chunk ends in the middle of the number
+        self.assertEqual(self._parse('12345 678', 3), [12345, 678])
+        self.assertEqual(self._parse('[12345]', 3), [12345])
+
+    def test_number_one_character_at_a_time(self):
+        # Every read returns one character, so the numbers are split
+        # after every character - after the . and the e and the -
+        class Trickle(object):
+            def __init__(self, data):
+                self.data = StringIO.StringIO(data)
+
+            def read(self, size):
+                return self.data.read(1)
+
+        data = '1.5 1e5 1e-5 -2.25E+3 12 [0.5, 7e2]'
+        values = list(jsonstream.iter_json(Trickle(data), 1))
+        self.assertEqual(values, [1.5, 1e5, 1e-5, -2.25e3, 12, [0.5, 700.0]])
+        self.assertEqual([type(value) for value in values[:5]],
+                         [float, float, float, float, int])
+        self.assertEqual(list(jsonstream.iter_json(Trickle('3'), 1)), [3])
+        self.assertRaises(ValueError, list,
+                          jsonstream.iter_json(Trickle('1e'), 1))
+
+    def test_errors(self):
+        for data in ('[1, 2', '[1 2]', '[1] 2', '{"a": }', '{"a": 1'):
+            self.assertRaises(ValueError, self._parse, data, 2)
+
+    def _embedded(self, data, chunk_size=jsonstream.CHUNK_SIZE):
+        return list(jsonstream.iter_embedded_array(StringIO.StringIO(data),
+                                                   chunk_size))
+
+    def test_embedded_array(self):
+        nodes = [dict(id=i, name='node-%d' % i, roles='compute, cinder')
+                 for i in range(3000)]
+        header = ('[WARNING]: provided hosts list is empty [x]\n'
+                  'fuel_host | SUCCESS | rc=0 >>\n')
+        trailer = '\nShared connection to 10.20.0.2 closed.\n[]\n'
+
+        # Pretty printed, on one line and without any other text
+        for payload in (json.dumps(nodes, indent=4), json.dumps(nodes)):
+            for data in (header + payload + trailer, payload):
+                for chunk_size in (7, 4096, jsonstream.CHUNK_SIZE):
+                    self.assertEqual(self._embedded(data, chunk_size), nodes)
+
+        self.assertEqual(self._embedded(header + '[ ]' + trailer), [])
+
+    def test_embedded_array_errors(self):
+        for data in ('', 'no json here', '[WARNING] [1, 2]',
+                     'ok >>\n[{"a": 1}, {"b": }]'):
+            self.assertRaises(ValueError, self._embedded, data, 3)
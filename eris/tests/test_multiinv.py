@@ -0,0 +1,158 @@
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+import fixtures
+
+from eris.inventory import multiinv
+
+from eris.tests import base
+
+
+FAKE_FUEL = 'eris/tests/datafiles/fake_fuel.py'
+
+
+class ErisMultiInvTest(base.TestCase):
+
+    def setUp(self):
+        super(ErisMultiInvTest, self).setUp()
+        self.tmp_dir = self.useFixture(fixtures.TempDir()).path
+        with open('eris/tests/datafiles/test_config.json', 'r') as fid:
+            self.file_config = json.load(fid)
+        with open('eris/tests/datafiles/test_fuel_config.json', 'r') as fid:
+            self.fuel_config = json.load(fid)
+        self.fuel_config['openstack_deployment']['fuel']['transport'] = (
+            'local')
+
+    def _fuel_source(self, name, delay=0, ip='10.20.0.2', host_prefix=None):
+        source = json.loads(json.dumps(self.fuel_config))
+        source['name'] = name
+        if host_prefix is not None:
+            source['host_prefix'] = host_prefix
+        fuel = source['openstack_deployment']['fuel']
+        fuel['ip'] = ip
+        fuel['fuel_command'] = "sh -c 'sleep %s; %s %s node list --json'" % (
+            delay, sys.executable, FAKE_FUEL)
+        return source
+
+    def _second_map(self):
+        map_file = os.path.join(self.tmp_dir, 'lab.json')
+        with open(map_file, 'w') as fid:
+            json.dump([dict(name='labnode', groups=['compute', 'lab'],
+                            ip='192.168.1.10', mac='52:54:00:00:01:10',
+                            type='vm'),
+                       dict(name='computesre103', groups=['lab'],
+                            ip='172.24.91.103', mac='00:25:b5:40:1b:cf',
+                            type='bare-metal')], fid)
+
+        source = json.loads(json.dumps(self.file_config))
+        source['name'] = 'lab'
+        source['openstack_deployment']['deployment_map'] = map_file
+        source['openstack_deployment']['name'] = 'lab'
+        return source
+
+    def test_merge(self):
+        inv_obj = multiinv.ErisAnsibleInventory(dict(
+            inventory_sources=[self.file_config, self._second_map(),
+                               self._fuel_source('fuel-east',
+                                                 host_prefix='east-')]))
+        inv_obj.create_inventory()
+
+        # The union of the hosts and of the groups with the same name
+        self.assertIn('labnode', inv_obj.hosts)
+        self.assertIn('east-node-1', inv_obj.hosts)
+        compute = inv_obj.inventory['compute']['hosts']
+        self.assertTrue(set(['labnode', 'computesre103',
+                             'east-node-2']).issubset(compute))
+
+        # The same host in two sources is in the groups of both
+        self.assertIn('computesre103', inv_obj.inventory['lab']['hosts'])
+        self.assertEqual(
+            inv_obj.get_host_vars('computesre103')['ansible_host'],
+            '172.24.91.103')
+
+        # Prefixed - the fuel hosts of the file and of the fuel source
+        # are different machines
+        self.assertEqual(inv_obj.get_host_vars('fuel')['ansible_host'],
+                         '130.3.195.21')
+        self.assertEqual(inv_obj.get_host_vars('east-fuel')['ansible_host'],
+                         '10.20.0.2')
+        self.assertIn('localhost', inv_obj.hosts)
+        self.assertNotIn('east-localhost', inv_obj.hosts)
+
+        self.assertEqual([stats['name'] for stats in inv_obj.source_stats],
+                         ['test', 'lab', 'fuel-east'])
+        self.assertEqual(inv_obj.source_stats[2]['plugin'],
+                         'eris.inventory.fuelinv')
+        for stats in inv_obj.source_stats:
+            self.assertTrue(stats['seconds'] >= 0)
+            self.assertTrue(stats['hosts'] > 0)
+
+    def test_merge_is_deterministic(self):
+        # The slow source is merged last all the same
+        sources = [self._fuel_source('slow', 0.3, '10.20.0.100', 'slow-'),
+                   self._fuel_source('fast', 0, '10.20.0.200', 'fast-')]
+        for source in sources:
+            source['site'] = dict(fuel_ip=source['openstack_deployment'][
+                'fuel']['ip'])
+        inv_obj = multiinv.ErisAnsibleInventory(dict(
+            inventory_sources=sources))
+        inv_obj.create_inventory()
+        self.assertEqual(inv_obj.get_group('site')['vars']['fuel_ip'],
+                         '10.20.0.200')
+
+        sources.reverse()
+        inv_obj = multiinv.ErisAnsibleInventory(dict(
+            inventory_sources=sources))
+        inv_obj.create_inventory()
+        self.assertEqual(inv_obj.get_group('site')['vars']['fuel_ip'],
+                         '10.20.0.100')
+
+    def test_fuel_environments(self):
+        # Every fuel environment has a fuel host and node-1, node-2, ...
+        sources = [self._fuel_source('east', ip='10.20.0.100'),
+                   self._fuel_source('west', ip='10.30.0.100')]
+        inv_obj = multiinv.ErisAnsibleInventory(dict(
+            inventory_sources=sources))
+        self.assertRaises(ValueError, inv_obj.create_inventory)
+
+        sources[0]['host_prefix'] = 'east-'
+        sources[1]['host_prefix'] = 'west-'
+        inv_obj = multiinv.ErisAnsibleInventory(dict(
+            inventory_sources=sources))
+        inv_obj.create_inventory()
+        self.assertEqual(inv_obj.get_host_vars('east-fuel')['ansible_host'],
+                         '10.20.0.100')
+        self.assertEqual(inv_obj.get_host_vars('west-fuel')['ansible_host'],
+                         '10.30.0.100')
+        self.assertNotIn('fuel', inv_obj.hosts)
+        self.assertTrue(set(['east-node-2', 'west-node-2']).issubset(
+            inv_obj.inventory['cinder']['hosts']))
+
+    def test_sources_in_parallel(self):
+        sources = [self._fuel_source('fuel-%d' % i, 0.5) for i in range(4)]
+        inv_obj = multiinv.ErisAnsibleInventory(dict(
+            inventory_sources=sources))
+
+        start = time.time()
+        inv_obj.create_inventory()
+        elapsed = time.time() - start
+
+        self.assertTrue(min(stats['seconds']
+                            for stats in inv_obj.source_stats) >= 0.5)
+        self.assertTrue(elapsed < 1.5, elapsed)
+
+    def test_failed_source(self):
+        bad = self._fuel_source('bad')
+        bad['openstack_deployment']['fuel']['fuel_command'] = 'false'
+        inv_obj = multiinv.ErisAnsibleInventory(dict(
+            inventory_sources=[self.file_config, bad]))
+        self.assertRaises(subprocess.CalledProcessError,
+                          inv_obj.create_inventory)
+        self.assertIsNone(inv_obj.source_stats[1]['hosts'])
+
+        inv_obj = multiinv.ErisAnsibleInventory(dict(inventory_sources=[]))
+        self.assertRaises(ValueError, inv_obj.create_inventory)
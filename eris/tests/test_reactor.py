@@ -0,0 +1,60 @@
+
+import os
+import time
+
+from eris.utils import reactor
+
+from eris.tests import base
+
+
+class ReactorTestCase(base.TestCase):
+
+    def setUp(self):
+        super(ReactorTestCase, self).setUp()
+        self.reactor = reactor.Reactor()
+        self.calls = list()
+
+    def _pipe(self):
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        self.addCleanup(os.close, write_fd)
+        return read_fd, write_fd
+
+    def test_reader(self):
+        read_fd, write_fd = self._pipe()
+        self.reactor.add_reader(read_fd,
+                                lambda: self.calls.append(os.read(read_fd,
+                                                                  10)))
+        self.assertEqual(self.reactor.run_once(0), 0)
+
+        os.write(write_fd, 'x')
+        self.assertEqual(self.reactor.run_once(10), 1)
+        self.assertEqual(self.calls, ['x'])
+
+        self.assertTrue(self.reactor.remove_reader(read_fd))
+        self.assertFalse(self.reactor.remove_reader(read_fd))
+        os.write(write_fd, 'y')
+        self.assertEqual(self.reactor.run_once(0), 0)
+
+    def test_timers_run_in_order(self):
+        self.reactor.call_later(0.02, self.calls.append, 2)
+        self.reactor.call_later(0.01, self.calls.append, 1)
+        cancelled = self.reactor.call_later(0.01, self.calls.append, 3)
+        cancelled.cancel()
+
+        deadline = time.time() + 10
+        while len(self.calls) < 2 and time.time() < deadline:
+            self.reactor.run_once(10)
+
+        self.assertEqual(self.calls, [1, 2])
+        self.assertIsNone(self.reactor.next_timer())
+
+    def test_timer_bounds_wait(self):
+        when = time.time() + 0.05
+        self.reactor.call_at(when, self.calls.append, 1)
+        self.assertEqual(self.reactor.next_timer(), when)
+
+        # Without the timer this would block forever
+        self.reactor.run_once(None)
+        self.assertGreaterEqual(time.time(), when)
+        self.assertEqual(self.calls, [1])
@@ -0,0 +1,634 @@
+
+import httplib
+import json
+import os
+import select
+import threading
+import time
+
+import fixtures
+
+from eris.cli import sched_daemon
+from eris.utils import control
+from eris.utils import dirwatch
+from eris.utils import journal
+
+from eris.tests import base
+
+
+def write_job_file(job_dir, name, payload):
+    # Write then rename so the watcher never sees a partial file
+    tmp_path = os.path.join(job_dir, '.' + name + '.tmp')
+    with open(tmp_path, 'w') as fid:
+        json.dump(payload, fid)
+    os.rename(tmp_path, os.path.join(job_dir, name))
+
+
+class DirectoryWatcherTestCase(base.TestCase):
+
+    def setUp(self):
+        super(DirectoryWatcherTestCase, self).setUp()
+        self.job_dir = self.useFixture(fixtures.TempDir()).path
+
+    def test_inotify_wakeup(self):
+        watcher = dirwatch.DirectoryWatcher(self.job_dir)
+        self.addCleanup(watcher.close)
+        if not watcher.using_inotify():
+            self.skipTest('inotify is not available')
+
+        self.assertEqual(watcher.read_events(), [])
+
+        timer = threading.Timer(0.1, write_job_file,
+                                (self.job_dir, 'job.json', {}))
+        timer.start()
+        start = time.time()
+        names = list()
+        while 'job.json' not in names and time.time() - start < 10:
+            select.select([watcher.fileno()], [], [], 10)
+            names.extend(watcher.read_events())
+        timer.join()
+
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(names, ['.job.json.tmp', 'job.json'])
+
+    def test_polling_fallback(self):
+        watcher = dirwatch.DirectoryWatcher(self.job_dir,
+                                            poll_interval=0.01,
+                                            use_inotify=False)
+        self.assertFalse(watcher.using_inotify())
+        self.assertIsNone(watcher.fileno())
+
+        write_job_file(self.job_dir, 'job.json', {})
+        self.assertEqual(watcher.scan(), ['job.json'])
+
+    def test_watch_lost(self):
+        job_dir = os.path.join(self.job_dir, 'jobs')
+        os.mkdir(job_dir)
+        watcher = dirwatch.DirectoryWatcher(job_dir)
+        self.addCleanup(watcher.close)
+        if not watcher.using_inotify():
+            self.skipTest('inotify is not available')
+
+        fd = watcher.fileno()
+        os.rmdir(job_dir)
+        select.select([fd], [], [], 10)
+        self.assertEqual(watcher.read_events(), [])
+
+        # Still open until close - the caller unregisters it first
+        self.assertFalse(watcher.using_inotify())
+        self.assertEqual(watcher.fileno(), fd)
+        watcher.close()
+        self.assertIsNone(watcher.fileno())
+
+
+class SchedulerTestCase(base.TestCase):
+
+    def setUp(self):
+        super(SchedulerTestCase, self).setUp()
+        self.job_dir = self.useFixture(fixtures.TempDir()).path
+        self.out_dir = self.useFixture(fixtures.TempDir()).path
+
+    def test_next_timeout(self):
+        scheduler = sched_daemon.Scheduler(self.job_dir, poll_interval=5)
+        self.assertIsNone(scheduler.next_timeout())
+
+        scheduler.add_job(sched_daemon.Job(self.out_dir, ['true'],
+                                           run_at=2))
+        self.assertLessEqual(scheduler.next_timeout(), 2)
+        self.assertGreater(scheduler.next_timeout(), 1)
+
+        scheduler.add_job(sched_daemon.Job(self.out_dir, ['true'],
+                                           run_at=60))
+        self.assertLessEqual(scheduler.next_timeout(), 2)
+
+    def test_expired_pending_job_dropped(self):
+        scheduler = sched_daemon.Scheduler(self.job_dir)
+        job = sched_daemon.Job(self.out_dir, ['true'], run_at=0,
+                               repeat=1, until=0)
+        scheduler.add_job(job)
+        scheduler.run_jobs()
+        self.assertEqual(scheduler.pending_jobs, set())
+        self.assertIsNone(scheduler.next_timeout())
+
+    def test_only_due_jobs_run(self):
+        scheduler = sched_daemon.Scheduler(self.job_dir)
+        later = sched_daemon.Job(self.out_dir, ['true'], run_at=60)
+        due = sched_daemon.Job(self.out_dir, ['true'], run_at=0)
+        scheduler.add_job(later)
+        scheduler.add_job(due)
+        now = time.time()
+
+        scheduler.run_jobs(now)
+        self.assertEqual(scheduler.running_jobs, set([due]))
+        self.assertEqual(scheduler.pending_jobs, set([later]))
+        self.assertIs(scheduler._peek_pending(), later)
+
+        # Everything is due an hour from now
+        scheduler.run_jobs(now + 3600)
+        self.assertEqual(scheduler.pending_jobs, set())
+        self.assertIsNone(scheduler._peek_pending())
+
+    def test_kill_clears_pending(self):
+        scheduler = sched_daemon.Scheduler(self.job_dir)
+        scheduler.add_job(sched_daemon.Job(self.out_dir, ['true'],
+                                           run_at=0))
+        scheduler.run_cmd('KILL')
+        self.assertIsNone(scheduler._peek_pending())
+        scheduler.run_jobs()
+        self.assertEqual(scheduler.running_jobs, set())
+
+    def test_reap_jobs(self):
+        scheduler = sched_daemon.Scheduler(self.job_dir)
+        job = sched_daemon.Job(self.out_dir, ['sh', '-c', 'exit 3'],
+                               run_at=0)
+        scheduler.add_job(job)
+        scheduler.run_jobs()
+        self.assertEqual(scheduler.running_jobs, set([job]))
+
+        deadline = time.time() + 10
+        while scheduler.running_jobs and time.time() < deadline:
+            time.sleep(0.01)
+            scheduler.reap_jobs()
+
+        self.assertEqual(scheduler.running_jobs, set())
+        self.assertEqual(scheduler.finished_jobs, set([job]))
+        self.assertTrue(job.finished())
+        self.assertEqual(job.returncode(), 3)
+        self.assertGreaterEqual(job.duration(), 0)
+
+        # The next tick hands the finished jobs over
+        scheduler.run_jobs()
+        self.assertEqual(scheduler.finished_jobs, set())
+
+    def test_sigchld_wakeup(self):
+        scheduler = sched_daemon.Scheduler(self.job_dir)
+        restore_signals = scheduler._install_sigchld()
+        self.addCleanup(restore_signals)
+        if scheduler._wakeup_fds is None:
+            self.skipTest('signals need the main thread')
+
+        scheduler.add_job(sched_daemon.Job(self.out_dir, ['true'],
+                                           run_at=0))
+        scheduler.run_jobs()
+
+        # No polling needed for running jobs - SIGCHLD wakes us up
+        self.assertIsNone(scheduler.next_timeout())
+        start = time.time()
+        self.assertEqual(scheduler.reactor.run_once(10), 1)
+        self.assertLess(time.time() - start, 5)
+
+        scheduler.reap_jobs()
+        self.assertEqual(scheduler.running_jobs, set())
+
+    def _sleep_job(self, tag, priority=0):
+        return sched_daemon.Job(self.out_dir, ['sleep', '10'], run_at=0,
+                                tag=tag, priority=priority)
+
+    def _stop_scheduler(self, scheduler):
+        scheduler.stop()
+        for job in scheduler.running_jobs:
+            job.popen.wait()
+
+    def test_max_jobs(self):
+        scheduler = sched_daemon.Scheduler(self.job_dir, max_jobs=2)
+        self.addCleanup(self._stop_scheduler, scheduler)
+        for _ in range(5):
+            scheduler.add_job(self._sleep_job('sleep'))
+
+        scheduler.run_jobs()
+        self.assertEqual(len(scheduler.running_jobs), 2)
+        self.assertEqual(len(scheduler.queued_jobs()), 3)
+        self.assertEqual(scheduler.queue_wait_stats()['count'], 2)
+
+        # Nothing finished - nothing more is started
+        scheduler.run_jobs()
+        self.assertEqual(len(scheduler.running_jobs), 2)
+
+        # A finished job frees up a slot for a queued job
+        job = next(iter(scheduler.running_jobs))
+        job.popen.kill()
+        deadline = time.time() + 10
+        while job in scheduler.running_jobs and time.time() < deadline:
+            time.sleep(0.01)
+            scheduler.reap_jobs()
+        self.assertEqual(job.returncode(), -9)
+
+        scheduler.run_jobs()
+        self.assertEqual(len(scheduler.running_jobs), 2)
+        self.assertEqual(len(scheduler.queued_jobs()), 2)
+        self.assertEqual(scheduler.queue_wait_stats()['count'], 3)
+
+    def test_tag_limits_and_priority(self):
+        scheduler = sched_daemon.Scheduler(self.job_dir, max_jobs=3,
+                                           tag_limits=dict(inject=1))
+        self.addCleanup(self._stop_scheduler, scheduler)
+        inject_jobs = [self._sleep_job('inject') for _ in range(3)]
+        low = self._sleep_job('monitor', priority=0)
+        high = self._sleep_job('monitor', priority=5)
+        map(scheduler.add_job, inject_jobs + [low, high])
+
+        scheduler.run_jobs()
+
+        # One inject job, then the monitor jobs by priority
+        running_tags = sorted(j.tag for j in scheduler.running_jobs)
+        self.assertEqual(running_tags, ['inject', 'monitor', 'monitor'])
+
+        scheduler.run_cmd('KILL')
+        scheduler = sched_daemon.Scheduler(self.job_dir, max_jobs=1)
+        self.addCleanup(self._stop_scheduler, scheduler)
+        low = self._sleep_job('monitor', priority=0)
+        high = self._sleep_job('monitor', priority=5)
+        scheduler.add_job(low)
+        scheduler.add_job(high)
+        scheduler.run_jobs()
+        self.assertEqual(scheduler.running_jobs, set([high]))
+        self.assertEqual(scheduler.queued_jobs(), [low])
+
+    def test_blocked_tag_not_looked_at(self):
+        scheduler = sched_daemon.Scheduler(self.job_dir, max_jobs=10,
+                                           tag_limits=dict(inject=1))
+        self.addCleanup(self._stop_scheduler, scheduler)
+        for _ in range(50):
+            scheduler.add_job(self._sleep_job('inject'))
+        scheduler.run_jobs()
+        self.assertEqual(len(scheduler.running_jobs), 1)
+        self.assertEqual(len(scheduler.queued_jobs()), 49)
+
+        # The inject tag is at its limit - its queued jobs are not
+        # looked at while other jobs are started
+        checked = list()
+        can_start = scheduler._can_start
+
+        def counting_can_start(tag, starting_tags):
+            checked.append(tag)
+            return can_start(tag, starting_tags)
+
+        scheduler._can_start = counting_can_start
+        monitor = self._sleep_job('monitor')
+        scheduler.add_job(monitor)
+        scheduler.run_jobs()
+        scheduler.run_jobs()
+        self.assertIn(monitor, scheduler.running_jobs)
+        self.assertNotIn('inject', checked)
+
+        # A finished inject job lets the next one start
+        job = next(j for j in scheduler.running_jobs if j.tag == 'inject')
+        job.popen.kill()
+        deadline = time.time() + 10
+        while job in scheduler.running_jobs and time.time() < deadline:
+            time.sleep(0.01)
+            scheduler.reap_jobs()
+        scheduler.run_jobs()
+        self.assertEqual(sorted(j.tag for j in scheduler.running_jobs),
+                         ['inject', 'monitor'])
+        self.assertEqual(len(scheduler.queued_jobs()), 48)
+
+    def test_job_timeout(self):
+        scheduler = sched_daemon.Scheduler(self.job_dir)
+        job = sched_daemon.Job(self.out_dir, ['sleep', '10'], run_at=0,
+                               timeout=0.1)
+        scheduler.add_job(job)
+        scheduler.run_jobs()
+
+        deadline = time.time() + 10
+        while scheduler.running_jobs and time.time() < deadline:
+            scheduler.reactor.run_once(0.1)
+            scheduler.reap_jobs()
+
+        self.assertTrue(job.timed_out)
+        self.assertEqual(job.returncode(), -9)
+        self.assertLess(job.duration(), 5)
+        self.assertEqual(scheduler._timeout_timers, dict())
+
+    def test_loop_polling(self):
+        scheduler = sched_daemon.Scheduler(self.job_dir, poll_interval=0.05,
+                                           use_inotify=False)
+        write_job_file(self.job_dir, 'job.json',
+                       dict(type='JOB', outdir=self.out_dir,
+                            cmd=['true'], run_at=0))
+        timer = threading.Timer(0.2, write_job_file,
+                                (self.job_dir, 'stop.json',
+                                 dict(type='CMD', command='STOP')))
+        timer.start()
+        scheduler.loop_forever()
+        timer.join()
+
+        self.assertEqual(len(os.listdir(self.out_dir)), 1)
+        self.assertEqual(os.listdir(self.job_dir), [])
+
+    def test_loop_picks_up_jobs(self):
+        scheduler = sched_daemon.Scheduler(self.job_dir, poll_interval=1)
+        loop = threading.Thread(target=scheduler.loop_forever)
+        loop.start()
+
+        write_job_file(self.job_dir, 'job.json',
+                       dict(type='JOB', outdir=self.out_dir,
+                            cmd=['true'], run_at=0, tag='loop'))
+
+        # The job output file appears once the job is started
+        deadline = time.time() + 10
+        while not os.listdir(self.out_dir) and time.time() < deadline:
+            time.sleep(0.01)
+
+        write_job_file(self.job_dir, 'stop.json',
+                       dict(type='CMD', command='STOP'))
+        loop.join(10)
+
+        self.assertFalse(loop.is_alive())
+        self.assertEqual(len(os.listdir(self.out_dir)), 1)
+        self.assertEqual(os.listdir(self.job_dir), [])
+
+    def test_loop_job_dir_removed(self):
+        # The inotify watch goes with the directory - the loop goes
+        # on polling and picks up the jobs once it is back
+        job_dir = os.path.join(self.job_dir, 'jobs')
+        os.mkdir(job_dir)
+        scheduler = sched_daemon.Scheduler(job_dir, poll_interval=0.05)
+        loop = threading.Thread(target=scheduler.loop_forever)
+        loop.start()
+
+        time.sleep(0.1)
+        os.rmdir(job_dir)
+        time.sleep(0.2)
+        os.mkdir(job_dir)
+        write_job_file(job_dir, 'job.json',
+                       dict(type='JOB', outdir=self.out_dir,
+                            cmd=['true'], run_at=0))
+
+        deadline = time.time() + 10
+        while not os.listdir(self.out_dir) and time.time() < deadline:
+            time.sleep(0.01)
+
+        write_job_file(job_dir, 'stop.json',
+                       dict(type='CMD', command='STOP'))
+        loop.join(10)
+        self.assertFalse(loop.is_alive())
+        self.assertEqual(len(os.listdir(self.out_dir)), 1)
+
+    def _start_loop(self, scheduler):
+        loop = threading.Thread(target=scheduler.loop_forever)
+        loop.start()
+
+        def stop_loop():
+            if loop.is_alive():
+                write_job_file(self.job_dir, 'stop.json',
+                               dict(type='CMD', command='STOP'))
+                loop.join(10)
+
+        self.addCleanup(stop_loop)
+        return loop
+
+    def _wait_for_state(self, socket_path, job_id, state):
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            response = control.send_request(socket_path,
+                                            dict(op='status', id=job_id))
+            if response.get('state') == state:
+                return response
+            time.sleep(0.01)
+        self.fail('job %s never reached %s' % (job_id, state))
+
+    def test_control_socket(self):
+        socket_path = os.path.join(self.job_dir, 'control.sock')
+        scheduler = sched_daemon.Scheduler(self.job_dir, poll_interval=0.1)
+        scheduler.listen(socket_path)
+        loop = self._start_loop(scheduler)
+
+        job = dict(type='JOB', outdir=self.out_dir, run_at=0)
+        response = control.send_request(
+            socket_path,
+            dict(op='submit', jobs=[dict(job, cmd=['sh', '-c', 'exit 4']),
+                                    dict(job, cmd=['sleep', '10'],
+                                         run_at=3600)]))
+        self.assertTrue(response['ok'])
+        done_id, pending_id = response['ids']
+
+        response = self._wait_for_state(socket_path, done_id, 'done')
+        self.assertEqual(response['exit_code'], 4)
+
+        self.assertEqual(response['queue_wait']['count'], 1)
+
+        response = control.send_request(socket_path, dict(op='list'))
+        self.assertEqual(response['pending'], [pending_id])
+        self.assertEqual(response['running'], [])
+        self.assertEqual(response['queue_wait']['count'], 1)
+
+        response = control.send_request(socket_path,
+                                        dict(op='status', id='nosuchjob'))
+        self.assertFalse(response['ok'])
+        response = control.send_request(socket_path, dict(op='bogus'))
+        self.assertFalse(response['ok'])
+        response = control.send_request(socket_path,
+                                        dict(op='submit', job=dict(
+                                            type='JOB', cmd=['true'])))
+        self.assertFalse(response['ok'])
+
+        response = control.send_request(
+            socket_path, dict(op='submit', job=dict(type='CMD',
+                                                    command='STOP')))
+        self.assertTrue(response['ok'])
+        loop.join(10)
+        self.assertFalse(loop.is_alive())
+        self.assertFalse(os.path.exists(socket_path))
+
+    def test_bad_jobs_refused(self):
+        scheduler = sched_daemon.Scheduler(self.job_dir)
+        job = dict(type='JOB', outdir=self.out_dir, cmd=['true'], run_at=0)
+        for bad in (dict(outdir=None), dict(outdir=7), dict(cmd=[]),
+                    dict(cmd='true'), dict(cmd=['true', 1]),
+                    dict(run_at=None), dict(run_at='now'),
+                    dict(run_at=True), dict(tag=['x']),
+                    dict(priority='high'), dict(timeout=0),
+                    dict(repeat=0, until=10), dict(repeat=5, until='x')):
+            response = scheduler.handle_request(dict(op='submit',
+                                                     job=dict(job, **bad)))
+            self.assertFalse(response['ok'], bad)
+            self.assertIn('bad job', response['error'])
+
+        self.assertEqual(len(scheduler.pending_jobs), 0)
+        self.assertTrue(scheduler.handle_request(dict(op='submit',
+                                                      job=job))['ok'])
+
+    def test_handler_errors_answered(self):
+        def handler(request):
+            raise AttributeError('broken')
+
+        server = control.ControlServer(None, handler,
+                                       lambda method, path, payload: {})
+        response = server.dispatch('{"op": "list"}')
+        self.assertFalse(response['ok'])
+        self.assertIn('AttributeError: broken', response['error'])
+        status, response = server.dispatch_http('GET', '/jobs', '')
+        self.assertEqual(status, 400)
+        self.assertFalse(response['ok'])
+
+    def test_control_http(self):
+        scheduler = sched_daemon.Scheduler(self.job_dir, poll_interval=0.1)
+        token_file = os.path.join(self.out_dir, 'token', 'http.token')
+        port = scheduler.listen(http_port=0, http_token_file=token_file)
+        self._start_loop(scheduler)
+        self.assertEqual(os.stat(token_file).st_mode & 0o777, 0o600)
+        with open(token_file, 'r') as fid:
+            token = fid.read().strip()
+
+        def http_request(method, path, body=None, **headers):
+            headers.setdefault('Authorization', 'Bearer ' + token)
+            if body is not None:
+                headers.setdefault('Content-Type', 'application/json')
+            headers = dict((name.replace('_', '-'), value)
+                           for name, value in headers.iteritems()
+                           if value is not None)
+            conn = httplib.HTTPConnection('127.0.0.1', port, timeout=10)
+            conn.request(method, path,
+                         json.dumps(body) if body is not None else None,
+                         headers)
+            response = conn.getresponse()
+            result = response.status, json.loads(response.read())
+            conn.close()
+            return result
+
+        job = dict(type='JOB', cmd=['true'], outdir=self.out_dir,
+                   run_at=3600)
+        status, response = http_request('POST', '/jobs', job)
+        self.assertEqual(status, 200)
+        job_id = response['ids'][0]
+
+        status, response = http_request('GET', '/jobs')
+        self.assertEqual(response['pending'], [job_id])
+
+        status, response = http_request('GET', '/jobs/' + job_id)
+        self.assertEqual(response['state'], 'pending')
+
+        status, response = http_request('GET', '/nothing')
+        self.assertEqual(status, 404)
+
+        # What a web page or a client without the token can send
+        for status, headers in ((401, dict(Authorization=None)),
+                                (401, dict(Authorization='Bearer x')),
+                                (403, dict(Origin='http://evil.example')),
+                                (403, dict(Host='evil.example:%d' % port)),
+                                (415, dict(Content_Type='text/plain'))):
+            self.assertEqual(http_request('POST', '/jobs', job,
+                                          **headers)[0], status)
+        self.assertEqual(len(scheduler.pending_jobs), 1)
+
+    def test_batch_job_file(self):
+        scheduler = sched_daemon.Scheduler(self.job_dir)
+        jobs = [dict(type='JOB', outdir=self.out_dir, cmd=['true'],
+                     run_at=3600, tag='batch%d' % i) for i in range(100)]
+        sched_daemon.write_job_file(self.job_dir, jobs, name='batch.jsonl')
+
+        # An array file is read the same way
+        write_job_file(self.job_dir, 'array.json', jobs[:10])
+
+        stop = scheduler.load_job_files(os.listdir(self.job_dir))
+        self.assertFalse(stop)
+        self.assertEqual(len(scheduler.pending_jobs), 110)
+        self.assertEqual(os.listdir(self.job_dir), [])
+
+    def test_bad_batch_job_file(self):
+        scheduler = sched_daemon.Scheduler(self.job_dir)
+        job = dict(type='JOB', outdir=self.out_dir, cmd=['true'],
+                   run_at=3600)
+        with open(os.path.join(self.job_dir, 'bad.jsonl'), 'w') as fid:
+            fid.write(json.dumps(job) + '\n')
+            fid.write(json.dumps(dict(type='NOPE')) + '\n')
+            fid.write(json.dumps(job) + '\n')
+            fid.write('{"type": \n')
+
+        # The bad job is skipped and the jobs before the bad JSON are kept
+        scheduler.load_job_files(['bad.jsonl'])
+        self.assertEqual(len(scheduler.pending_jobs), 2)
+        self.assertEqual(os.listdir(self.job_dir), [])
+
+    def test_batch_job_file_stop(self):
+        scheduler = sched_daemon.Scheduler(self.job_dir)
+        job = dict(type='JOB', outdir=self.out_dir, cmd=['true'],
+                   run_at=3600)
+        sched_daemon.write_job_file(self.job_dir,
+                                    [job, dict(type='CMD', command='KILL'),
+                                     job, dict(type='CMD', command='STOP'),
+                                     job], name='stop.jsonl')
+
+        # KILL drops the jobs before it, STOP ends the file
+        self.assertTrue(scheduler.load_job_files(['stop.jsonl']))
+        self.assertEqual(len(scheduler.pending_jobs), 1)
+        self.assertEqual(os.listdir(self.job_dir), [])
+
+    def test_journal_recovery(self):
+        journal_path = os.path.join(self.out_dir, 'jobs.journal')
+        scheduler = sched_daemon.Scheduler(self.job_dir)
+        self.assertEqual(scheduler.open_journal(journal_path, False), 0)
+
+        later = sched_daemon.Job(self.out_dir, ['true'], run_at=3600)
+        recurring = sched_daemon.Job(self.out_dir, ['sleep', '10'],
+                                     run_at=0, repeat=60, until=3600)
+        done = sched_daemon.Job(self.out_dir, ['true'], run_at=0)
+        map(scheduler.add_job, (later, recurring, done))
+        now = time.time()
+        scheduler.run_jobs(now)
+        self.assertEqual(scheduler.running_jobs, set([recurring, done]))
+
+        # The onetime job completes and is retired
+        done.popen.wait()
+        scheduler._running_pids.pop(done.popen.pid)
+        done.set_finished(0)
+        scheduler.running_jobs.discard(done)
+        scheduler._retire_job(done)
+        scheduler._sync_journal()
+
+        # The scheduler dies with the recurring job running
+        recurring.popen.kill()
+        recurring.popen.wait()
+        scheduler.journal.close()
+
+        restarted = sched_daemon.Scheduler(self.job_dir)
+        self.assertEqual(restarted.open_journal(journal_path, False), 2)
+        self.assertEqual(restarted.pending_jobs, set([later, recurring]))
+        recovered = restarted.jobs[recurring.id]
+        self.assertEqual(recovered.run_at, now + 60)
+        self.assertEqual(recovered.until, recurring.until)
+        self.assertEqual(recovered.start_time, recurring.start_time)
+        self.assertFalse(recovered.started())
+        self.assertNotIn(done.id, restarted.jobs)
+        restarted.journal.close()
+
+    def test_submit_synced_on_error(self):
+        scheduler = sched_daemon.Scheduler(self.job_dir)
+        synced = list()
+        self.useFixture(fixtures.MonkeyPatch(
+            'eris.cli.sched_daemon.Scheduler._sync_journal',
+            lambda self: synced.append(True)))
+
+        job = dict(type='JOB', outdir=self.out_dir, cmd=['true'],
+                   run_at=3600)
+        response = scheduler.handle_request(dict(op='submit',
+                                                 jobs=[job, dict(job,
+                                                                 cmd=[])]))
+        self.assertFalse(response['ok'])
+        self.assertEqual(len(response['ids']), 1)
+        self.assertEqual(synced, [True])
+
+    def test_journal_drops_finished_jobs(self):
+        journal_path = os.path.join(self.out_dir, 'jobs.journal')
+        scheduler = sched_daemon.Scheduler(self.job_dir)
+        scheduler.open_journal(journal_path, False)
+        job = sched_daemon.Job(self.out_dir, ['true'], run_at=0)
+        scheduler.add_job(job)
+        scheduler.run_jobs(time.time())
+
+        # The scheduler dies after the job ends but before it is retired
+        job.popen.wait()
+        job.set_finished(0)
+        scheduler.journal.put(job.id, dict(end_time=job.end_time,
+                                           exit_code=0))
+        scheduler.journal.close()
+
+        restarted = sched_daemon.Scheduler(self.job_dir)
+        self.assertEqual(restarted.open_journal(journal_path, False), 0)
+        restarted.journal.close()
+
+        # The replay retired it, so it is gone from the journal
+        reopened = journal.Journal(journal_path, False)
+        self.assertEqual(reopened.load(), dict())
+        reopened.close()
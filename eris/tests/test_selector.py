@@ -0,0 +1,97 @@
+import fixtures
+
+from eris.inventory import selector
+
+from eris.tests import base
+
+
+class SelectorTestCase(base.TestCase):
+
+    def test_parse_pattern(self):
+        self.assertEqual(selector.parse_pattern('all'),
+                         (['all'], [], []))
+        self.assertEqual(selector.parse_pattern('mysql:&controller,!db1'),
+                         (['mysql'], ['controller'], ['db1']))
+        self.assertEqual(selector.parse_pattern(' a : & b :! c'),
+                         (['a'], ['b'], ['c']))
+        for pattern in ('', 'mysql:', 'mysql:&', 'a::b'):
+            self.assertRaises(ValueError, selector.parse_pattern, pattern)
+
+    def test_is_glob(self):
+        self.assertTrue(selector.is_glob('rack_*'))
+        self.assertTrue(selector.is_glob('node-[12]'))
+        self.assertFalse(selector.is_glob('rack_1'))
+
+    def test_sample_hosts(self):
+        hosts = set('host%d' % i for i in range(100))
+        picked = selector.sample_hosts(hosts, 10, seed='chaos')
+        self.assertEqual(len(set(picked)), 10)
+        self.assertEqual(selector.sample_hosts(hosts, 10, seed='chaos'),
+                         picked)
+
+        # One host per key, the hosts without a key are never picked
+        def key(host):
+            return (int(host[4:]) % 3) or None
+
+        picked = selector.sample_hosts(hosts, 2, seed=1, key=key)
+        self.assertEqual(sorted(key(host) for host in picked), [1, 2])
+        self.assertRaises(ValueError, selector.sample_hosts, hosts, 3,
+                          key=key)
+        self.assertRaises(ValueError, selector.sample_hosts, hosts, 101)
+
+    def test_sample_hosts_apart(self):
+        # Every host is in a rack and a row. Hosts in the same rack
+        # but different rows still have the rack in common.
+        hosts = set('host%d' % i for i in range(12))
+
+        def groups(host):
+            index = int(host[4:])
+            return ('rack_%d' % (index / 3), 'row_%d' % (index % 3))
+
+        for seed in range(20):
+            picked = selector.sample_hosts(hosts, 3, seed=seed,
+                                           groups=groups)
+            self.assertEqual(len(picked), 3)
+            self.assertEqual(selector.sample_hosts(hosts, 3, seed=seed,
+                                                   groups=groups), picked)
+            picked_groups = [group for host in picked
+                             for group in groups(host)]
+            self.assertEqual(len(set(picked_groups)), 6)
+
+        # Only 3 rows - a 4th host would share one
+        self.assertRaises(ValueError, selector.sample_hosts, hosts, 4,
+                          groups=groups)
+
+        # Nothing to pick
+        self.assertEqual(selector.sample_hosts(hosts, 0, groups=groups), [])
+        self.assertEqual(selector.sample_hosts(hosts, 0, key=lambda h: h),
+                         [])
+        self.assertEqual(selector.sample_hosts(hosts, 0), [])
+
+        # The hosts in no group are never picked
+        def rack5_groups(host):
+            return ('rack_1',) if host == 'host5' else ()
+
+        self.assertEqual(selector.sample_hosts(hosts, 1, seed=1,
+                                               groups=rack5_groups),
+                         ['host5'])
+
+    def test_sample_hosts_apart_greedy(self):
+        # host1 and host2 are apart but both share a group with host0.
+        # An order that tries host0 first picks it and can't go on.
+        hosts = set(['host0', 'host1', 'host2'])
+        host_groups = dict(host0=('rack_1', 'row_1'), host1=('rack_1',),
+                           host2=('row_1',))
+        self.useFixture(fixtures.MonkeyPatch(
+            'eris.inventory.selector._APART_TRIES', 1))
+
+        missed = 0
+        for seed in range(20):
+            try:
+                picked = selector.sample_hosts(hosts, 2, seed=seed,
+                                               groups=host_groups.get)
+            except ValueError:
+                missed += 1
+            else:
+                self.assertEqual(sorted(picked), ['host1', 'host2'])
+        self.assertTrue(0 < missed < 20)
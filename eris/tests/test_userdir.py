@@ -0,0 +1,51 @@
+import os
+
+import fixtures
+
+from eris.utils import userdir
+
+from eris.tests import base
+
+
+class UserDirTestCase(base.TestCase):
+
+    def setUp(self):
+        super(UserDirTestCase, self).setUp()
+        self.tmp_dir = self.useFixture(fixtures.TempDir()).path
+
+    def test_user_cache_dir(self):
+        self.useFixture(fixtures.EnvironmentVariable('XDG_CACHE_HOME',
+                                                     self.tmp_dir))
+        self.assertEqual(userdir.user_cache_dir('inventory'),
+                         os.path.join(self.tmp_dir, 'eris', 'inventory'))
+
+        self.useFixture(fixtures.EnvironmentVariable('XDG_CACHE_HOME'))
+        self.useFixture(fixtures.EnvironmentVariable('HOME', self.tmp_dir))
+        self.assertEqual(userdir.user_cache_dir(),
+                         os.path.join(self.tmp_dir, '.cache', 'eris'))
+
+    def test_make_private_dir(self):
+        path = os.path.join(self.tmp_dir, 'a', 'b')
+        userdir.make_private_dir(path)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o700)
+
+        # An existing private directory is fine
+        userdir.make_private_dir(path)
+
+    def test_refused(self):
+        path = os.path.join(self.tmp_dir, 'shared')
+        os.mkdir(path)
+        os.chmod(path, 0o755)
+        self.assertRaises(OSError, userdir.make_private_dir, path)
+
+        os.chmod(path, 0o700)
+        link = os.path.join(self.tmp_dir, 'link')
+        os.symlink(path, link)
+        self.assertRaises(OSError, userdir.check_private_dir, link)
+
+        with open(os.path.join(self.tmp_dir, 'file'), 'w'):
+            pass
+        self.assertRaises(OSError, userdir.check_private_dir,
+                          os.path.join(self.tmp_dir, 'file'))
+        self.assertRaises(OSError, userdir.check_private_dir,
+                          os.path.join(self.tmp_dir, 'missing'))
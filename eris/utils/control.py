@@ -0,0 +1,444 @@
+
+"""
+A local control channel for long running eris daemons. Requests and
+responses are JSON objects. The server runs on a reactor and hands
+every request to a handler function that returns the response.
+
+Two transports are supported
+1. A unix domain socket with one JSON object per line in both
+   directions. A connection can carry any number of requests.
+   The socket has mode 0600 - only the user can connect.
+2. HTTP on 127.0.0.1 where the request is mapped from the method
+   and path by a route function and the response is the body.
+   Every request has to carry the token of the server
+       Authorization: Bearer <token>
+   and the token is kept in a file only the user can read (see
+   write_token_file). Requests a web browser could be made to send
+   are refused - any with an Origin header, with a Host other than
+   127.0.0.1 or localhost (DNS rebinding) or with a body that is not
+   Content-Type: application/json.
+
+A handler that raises answers with an error rather than taking the
+server (and the daemon loop it runs on) down.
+"""
+
+# System imports
+import errno
+import hmac
+import json
+import os
+import socket
+import tempfile
+
+from eris.utils import userdir
+
+
+MAX_REQUEST_SIZE = 16 * 1024 * 1024
+_RECV_SIZE = 64 * 1024
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 401: 'Unauthorized',
+                403: 'Forbidden', 404: 'Not Found',
+                405: 'Method Not Allowed', 415: 'Unsupported Media Type'}
+
+# The Host header values of a local HTTP listener - %d is the port
+_HTTP_HOSTS = ('127.0.0.1', '127.0.0.1:%d', 'localhost', 'localhost:%d')
+
+
+class _Connection(object):
+    """
+    Private class
+    DO NOT USE EXTERNALLY
+
+    A client connection with its input and output buffers. For
+    HTTP connections http has the token and the Host header values
+    of the listener, and is None for the unix socket.
+    """
+
+    def __init__(self, server, sock, http):
+        self.server = server
+        self.sock = sock
+        self.http = http
+        self.in_buf = ''
+        self.out_buf = ''
+        self.closing = False
+
+    def on_readable(self):
+        try:
+            data = self.sock.recv(_RECV_SIZE)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            self.close()
+            return
+
+        if not data:
+            # The client is done sending - finish writing the responses
+            self.server.reactor.remove_reader(self.sock)
+            self.closing = True
+            self.flush()
+            return
+
+        self.in_buf += data
+        if len(self.in_buf) > MAX_REQUEST_SIZE:
+            self.close()
+            return
+
+        if self.http:
+            self._process_http()
+        else:
+            self._process_lines()
+
+    def _process_lines(self):
+        while True:
+            line, sep, rest = self.in_buf.partition('\n')
+            if not sep:
+                break
+
+            self.in_buf = rest
+            if line.strip():
+                response = self.server.dispatch(line)
+                self.send(json.dumps(response) + '\n')
+
+    def _process_http(self):
+        header, sep, body = self.in_buf.partition('\r\n\r\n')
+        if not sep:
+            return
+
+        lines = header.split('\r\n')
+        request_line = lines[0].split()
+        headers = dict()
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            content_length = int(headers.get('content-length', 0))
+        except ValueError:
+            content_length = -1
+
+        if len(request_line) < 2 or content_length < 0:
+            self._send_http(400, dict(ok=False, error='bad request'))
+            return
+
+        refused = self._refuse_http(headers, content_length)
+        if refused is not None:
+            self._send_http(*refused)
+            return
+
+        if len(body) < content_length:
+            return
+
+        self.server.reactor.remove_reader(self.sock)
+        method, path = request_line[0], request_line[1]
+        status, response = self.server.dispatch_http(method, path,
+                                                     body[:content_length])
+        self._send_http(status, response)
+
+    def _refuse_http(self, headers, content_length):
+        """
+        The status and the response to refuse a request with, or
+        None if the request can go on
+        """
+
+        if 'origin' in headers:
+            # Only browsers send it - a web page is trying its luck
+            return 403, dict(ok=False, error='cross origin request')
+        if headers.get('host') not in self.http['hosts']:
+            return 403, dict(ok=False, error='bad host %s' %
+                             headers.get('host'))
+
+        scheme, _, token = headers.get('authorization', '').partition(' ')
+        if (scheme.lower() != 'bearer' or
+                not hmac.compare_digest(token.strip(), self.http['token'])):
+            return 401, dict(ok=False, error='bad or missing token')
+
+        content_type = headers.get('content-type', '')
+        if (content_length and
+                content_type.split(';')[0].strip().lower() !=
+                'application/json'):
+            return 415, dict(ok=False, error='the body is not '
+                             'application/json')
+
+        return None
+
+    def _send_http(self, status, response):
+        body = json.dumps(response)
+        self.closing = True
+        self.send('HTTP/1.0 %d %s\r\n'
+                  'Content-Type: application/json\r\n'
+                  'Content-Length: %d\r\n'
+                  'Connection: close\r\n'
+                  '\r\n%s' % (status, HTTP_REASONS.get(status, ''),
+                              len(body), body))
+
+    def send(self, data):
+        self.out_buf += data
+        self.flush()
+
+    def flush(self):
+        while self.out_buf:
+            try:
+                sent = self.sock.send(self.out_buf)
+            except socket.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                if e.args[0] == errno.EAGAIN:
+                    self.server.reactor.add_writer(self.sock, self.flush)
+                    return
+                self.close()
+                return
+            self.out_buf = self.out_buf[sent:]
+
+        self.server.reactor.remove_writer(self.sock)
+        if self.closing:
+            self.close()
+
+    def close(self):
+        self.server.reactor.remove_reader(self.sock)
+        self.server.reactor.remove_writer(self.sock)
+        self.server.connections.discard(self)
+        self.sock.close()
+
+
+class ControlServer(object):
+
+    def __init__(self, reactor, handler, http_route=None):
+        """
+        Create a control server
+
+        :param reactor: The event loop the server runs on
+        :param handler: Called with the request dict and \
+                returns the response dict
+        :param http_route: Called with the HTTP method, path and the \
+                body parsed as JSON (or None). Returns the request dict \
+                for the handler or None if there is no such route.
+        :type reactor: eris.utils.reactor.Reactor
+        :type handler: function
+        :type http_route: function
+        """
+
+        self.reactor = reactor
+        self.handler = handler
+        self.http_route = http_route
+        self.listeners = list()
+        self.connections = set()
+        self._unix_paths = list()
+
+    def listen_unix(self, path):
+        """
+        Accept line delimited JSON requests on a unix domain socket.
+        A stale socket file at the path is replaced.
+
+        :param path: The socket path
+        :type path: str
+        :returns: None
+        :raises socket.error: if the socket cannot be created
+        """
+
+        if os.path.exists(path):
+            os.remove(path)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        os.chmod(path, 0o600)
+        self._unix_paths.append(path)
+        self._listen(sock, None)
+
+    def listen_http(self, port, token):
+        """
+        Accept HTTP requests on 127.0.0.1. Only the requests with
+        the token are answered.
+
+        :param port: The TCP port. 0 picks a free port.
+        :param token: The token the requests have to carry
+        :type port: int
+        :type token: str
+        :returns: The port the server is listening on
+        :rtype: int
+        :raises socket.error: if the socket cannot be created
+        :raises ValueError: if the token is empty
+        """
+
+        if not token:
+            raise ValueError('HTTP needs a token')
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('127.0.0.1', port))
+        port = sock.getsockname()[1]
+        self._listen(sock, dict(token=token,
+                                hosts=frozenset(host % port if '%' in host
+                                                else host
+                                                for host in _HTTP_HOSTS)))
+        return port
+
+    def _listen(self, sock, http):
+        sock.setblocking(0)
+        sock.listen(128)
+        self.listeners.append(sock)
+        self.reactor.add_reader(sock, self._accept, sock, http)
+
+    def _accept(self, listener, http):
+        while True:
+            try:
+                sock, _ = listener.accept()
+            except socket.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                return
+
+            sock.setblocking(0)
+            conn = _Connection(self, sock, http)
+            self.connections.add(conn)
+            self.reactor.add_reader(sock, conn.on_readable)
+
+    def dispatch(self, data):
+        """
+        Parse a request and run the handler
+
+        :param data: The JSON request
+        :type data: str
+        :returns: The response
+        :rtype: dict
+        """
+
+        try:
+            request = json.loads(data)
+        except ValueError as e:
+            return dict(ok=False, error='bad json: %s' % e)
+
+        if not isinstance(request, dict):
+            return dict(ok=False, error='request is not an object')
+
+        return self._handle(request)
+
+    def _handle(self, request):
+        """
+        Private method
+        DO NOT CALL EXTERNALLY
+
+        Run the handler - whatever it raises is the error response
+        """
+
+        try:
+            return self.handler(request)
+        except Exception as e:
+            return dict(ok=False, error='request failed: %s: %s' %
+                        (e.__class__.__name__, e))
+
+    def dispatch_http(self, method, path, body):
+        """
+        Route an HTTP request and run the handler
+
+        :param method: The HTTP method
+        :param path: The request path
+        :param body: The request body
+        :type method: str
+        :type path: str
+        :type body: str
+        :returns: The HTTP status and the response
+        :rtype: tuple
+        """
+
+        payload = None
+        if body:
+            try:
+                payload = json.loads(body)
+            except ValueError as e:
+                return 400, dict(ok=False, error='bad json: %s' % e)
+
+        request = None
+        if self.http_route is not None:
+            request = self.http_route(method, path, payload)
+        if request is None:
+            return 404, dict(ok=False, error='no route for %s %s' %
+                             (method, path))
+
+        response = self._handle(request)
+        return (200 if response.get('ok') else 400), response
+
+    def close(self):
+        """
+        Close all the connections and listening sockets
+
+        :returns: None
+        """
+
+        for conn in list(self.connections):
+            conn.close()
+
+        for sock in self.listeners:
+            self.reactor.remove_reader(sock)
+            sock.close()
+        self.listeners = list()
+
+        for path in self._unix_paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._unix_paths = list()
+
+
+def write_token_file(path):
+    """
+    Write a new random HTTP token to a file only the user can read.
+    The directory of the file is created with mode 0700 and refused
+    if it is not private.
+
+    :param path: The token file
+    :type path: str
+    :returns: The token
+    :rtype: str
+    :raises OSError: if the directory is not private or the file \
+            cannot be written
+    """
+
+    token = os.urandom(32).encode('hex')
+    token_dir = os.path.dirname(os.path.abspath(path))
+    userdir.make_private_dir(token_dir)
+
+    # mkstemp creates the file with mode 0600
+    fd, tmp_path = tempfile.mkstemp(dir=token_dir, prefix='.token')
+    try:
+        with os.fdopen(fd, 'w') as fid:
+            fid.write(token + '\n')
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        os.remove(tmp_path)
+        raise
+    return token
+
+
+def send_request(path, request, timeout=10):
+    """
+    Send one request to a control server unix socket
+
+    :param path: The socket path
+    :param request: The request
+    :param timeout: The socket timeout in seconds
+    :type path: str
+    :type request: dict
+    :type timeout: float
+    :returns: The response
+    :rtype: dict
+    :raises socket.error: if the server cannot be reached
+    :raises ValueError: if the response cannot be parsed
+    """
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(json.dumps(request) + '\n')
+
+        data = ''
+        while not data.endswith('\n'):
+            chunk = sock.recv(_RECV_SIZE)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        sock.close()
+
+    return json.loads(data)
@@ -0,0 +1,190 @@
+
+"""
+Watch a directory for new files. On Linux the watch is driven by
+inotify so that the caller is woken up as soon as a file has been
+written (closed after write) or moved into the directory. Everywhere
+else, or when inotify is not available, the directory is polled.
+"""
+
+# System imports
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+
+
+# From sys/inotify.h
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+_EVENT_HEADER = struct.Struct('iIII')
+_READ_SIZE = 64 * 1024
+
+
+def _load_libc():
+    """
+    Load the C library and check for the inotify calls
+
+    :returns: The libc handle or None if inotify is not supported
+    :rtype: ctypes.CDLL
+    """
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+
+    return libc
+
+
+class DirectoryWatcher(object):
+    """
+    Report the files that appear in a directory. With inotify the
+    caller waits for fileno() to become readable (in its event loop)
+    and calls read_events for the names of the files written into the
+    directory since the last call. Without inotify the caller calls
+    scan every poll_interval. Whenever inotify events are lost
+    read_events returns the complete directory listing, so the caller
+    has to cope with seeing the same (still present) file more than once.
+
+    When the watch goes away (the directory was removed or moved)
+    using_inotify turns False. The caller stops waiting on fileno(),
+    calls close and polls from then on.
+    """
+
+    def __init__(self, path, poll_interval=5, use_inotify=True):
+        """
+        Create a directory watcher
+
+        :param path: The directory to watch
+        :param poll_interval: The longest time between directory scans \
+                when inotify is not available
+        :param use_inotify: Use inotify if it is available
+        :type path: str
+        :type poll_interval: int
+        :type use_inotify: boolean
+        :raises OSError: if the directory cannot be listed
+        """
+
+        self.path = path
+        self.poll_interval = poll_interval
+        self._fd = None
+        self._watch_lost = False
+
+        if use_inotify:
+            self._fd = self._init_inotify()
+
+    def _init_inotify(self):
+        libc = _load_libc()
+        if libc is None:
+            return None
+
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return None
+
+        wd = libc.inotify_add_watch(fd, self.path,
+                                    IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd < 0:
+            os.close(fd)
+            return None
+
+        return fd
+
+    def using_inotify(self):
+        """
+        Is the watcher driven by inotify
+
+        :returns: True for inotify and False for polling
+        :rtype: boolean
+        """
+
+        return self._fd is not None and not self._watch_lost
+
+    def fileno(self):
+        """
+        The file descriptor that becomes readable when files
+        are added to the directory
+
+        :returns: The inotify file descriptor or None when polling
+        :rtype: int
+        """
+
+        return self._fd
+
+    def scan(self):
+        """
+        List the entire directory
+
+        :returns: The names of all the files in the directory
+        :rtype: list
+        """
+
+        return os.listdir(self.path)
+
+    def read_events(self):
+        """
+        Read all the queued inotify events without blocking
+
+        :returns: The names of the files that were added
+        :rtype: list
+        """
+
+        names = list()
+        overflow = False
+        while True:
+            try:
+                data = os.read(self._fd, _READ_SIZE)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+
+            if not data:
+                break
+
+            offset = 0
+            while offset + _EVENT_HEADER.size <= len(data):
+                _, mask, _, name_len = _EVENT_HEADER.unpack_from(data,
+                                                                 offset)
+                offset += _EVENT_HEADER.size
+                name = data[offset:offset + name_len].rstrip('\0')
+                offset += name_len
+
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                elif mask & IN_IGNORED:
+                    # The watched directory is gone. The descriptor is
+                    # left open until close so the caller can stop
+                    # waiting on it first - polling takes over and
+                    # reports the error.
+                    self._watch_lost = True
+                    return list()
+                elif name:
+                    names.append(name)
+
+        # Events were dropped - the only safe thing is a full rescan
+        if overflow:
+            return self.scan()
+
+        return names
+
+    def close(self):
+        """
+        Release the inotify file descriptor
+
+        :returns: None
+        """
+
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            self._watch_lost = False
@@ -0,0 +1,203 @@
+
+"""
+A crash safe record store. The records are kept by the caller in
+memory and every change is appended to a write ahead log on disk, so
+the records can be rebuilt after a crash or a restart
+    journal = Journal('/var/lib/eris/jobs.journal')
+    records = journal.load()
+    journal.put('job-1', dict(run_at=10))
+    journal.delete('job-2')
+    journal.sync()
+A change either sets fields in a record (creating the record if
+needed) or deletes it. Both are idempotent - replaying a change that
+is already in the snapshot does no harm.
+
+To keep restarts fast the log is compacted from time to time. The
+caller passes the complete set of records, they are written to a
+snapshot file and the log is started over. Loading reads the
+snapshot and replays only the changes made since it was written.
+A change that was only partly written when the process died is
+dropped when the log is loaded.
+"""
+
+# System imports
+import json
+import os
+
+
+SNAPSHOT_SUFFIX = '.snapshot'
+
+
+def _encode(value):
+    return json.dumps(value, separators=(',', ':')) + '\n'
+
+
+def _fsync_dir(path):
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Journal(object):
+
+    def __init__(self, path, fsync=True, compact_every=10000):
+        """
+        Create a journal. Nothing is read or written until load.
+
+        :param path: The log file. The snapshot is kept next to it.
+        :param fsync: Sync the changes to disk and not just to the OS. \
+                Without it the changes only survive a process crash.
+        :param compact_every: Compact once the log has this many changes \
+                and more changes than there are records
+        :type path: str
+        :type fsync: boolean
+        :type compact_every: int
+        """
+
+        self.path = path
+        self.snapshot_path = path + SNAPSHOT_SUFFIX
+        self.fsync = fsync
+        self.compact_every = compact_every
+        self.log_size = 0
+        self._fid = None
+        self._dirty = False
+
+    def load(self):
+        """
+        Rebuild the records from the snapshot and the log and open
+        the log for new changes
+
+        :returns: The records by key
+        :rtype: dict
+        :raises IOError: if the files cannot be read or written
+        :raises ValueError: if the snapshot is corrupt
+        """
+
+        records = dict()
+        if os.path.exists(self.snapshot_path):
+            # One document so it is parsed in one go
+            with open(self.snapshot_path, 'r') as fid:
+                records = json.load(fid)
+
+        self.log_size = 0
+        good_size = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as fid:
+                for line in fid:
+                    try:
+                        key, fields = json.loads(line)
+                    except ValueError:
+                        # A change torn by a crash - everything after
+                        # it is suspect
+                        break
+
+                    if fields is None:
+                        records.pop(key, None)
+                    else:
+                        records.setdefault(key, dict()).update(fields)
+                    good_size += len(line)
+                    self.log_size += 1
+
+        # Start over from the last good change
+        self._fid = open(self.path, 'a')
+        self._fid.truncate(good_size)
+        return records
+
+    def put(self, key, fields):
+        """
+        Set fields in a record. The record is created if needed.
+
+        :param key: The record key
+        :param fields: The fields to set
+        :type key: str
+        :type fields: dict
+        :returns: None
+        """
+
+        self._fid.write(_encode([key, fields]))
+        self.log_size += 1
+        self._dirty = True
+
+    def delete(self, key):
+        """
+        Delete a record
+
+        :param key: The record key
+        :type key: str
+        :returns: None
+        """
+
+        self._fid.write(_encode([key, None]))
+        self.log_size += 1
+        self._dirty = True
+
+    def sync(self):
+        """
+        Make the changes durable. Changes are buffered until
+        this is called, so call it once for a batch of changes.
+
+        :returns: None
+        """
+
+        if not self._dirty:
+            return
+
+        self._fid.flush()
+        if self.fsync:
+            os.fsync(self._fid.fileno())
+        self._dirty = False
+
+    def needs_compaction(self, record_count):
+        """
+        Is the log large enough to be worth compacting
+
+        :param record_count: The number of records
+        :type record_count: int
+        :returns: True if compact should be called
+        :rtype: boolean
+        """
+
+        return (self.log_size >= self.compact_every and
+                self.log_size > record_count)
+
+    def compact(self, records):
+        """
+        Write the records to a new snapshot and start the log over.
+        The old snapshot is replaced atomically, and a crash before
+        the log is truncated only means some changes are replayed twice.
+
+        :param records: All the records by key
+        :type records: dict
+        :returns: None
+        :raises IOError: if the snapshot cannot be written
+        """
+
+        self.sync()
+
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as fid:
+            fid.write(json.dumps(records, separators=(',', ':')))
+            fid.flush()
+            if self.fsync:
+                os.fsync(fid.fileno())
+
+        os.rename(tmp_path, self.snapshot_path)
+        if self.fsync:
+            _fsync_dir(self.snapshot_path)
+
+        self._fid.truncate(0)
+        self.log_size = 0
+
+    def close(self):
+        """
+        Sync the changes and close the log
+
+        :returns: None
+        """
+
+        if self._fid is not None:
+            self.sync()
+            self._fid.close()
+            self._fid = None
@@ -0,0 +1,239 @@
+
+"""
+Incremental JSON parsing. The values are parsed out of a file or
+stream a chunk at a time and handed to the caller one at a time, so
+a large document never has to be held in memory as a whole - only
+the value being parsed is. The supported layouts are
+1. A JSON array - each element is a value
+2. One or more JSON values separated by whitespace. This covers
+   a single JSON object as well as JSON lines (one value per line).
+3. A JSON array of objects somewhere in other text, like the output
+   of a command run through ansible (see iter_embedded_array)
+"""
+
+# System imports
+import json
+
+
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = ' \t\n\r'
+
+# The characters a JSON number can have - a number followed by only
+# these at the end of the data read so far may not be complete
+NUMBER_CHARS = '-+.eE0123456789'
+
+
+class _Buffer(object):
+    """
+    Private class
+    DO NOT USE EXTERNALLY
+
+    A read buffer over a file like object
+    """
+
+    def __init__(self, fid, chunk_size):
+        self.fid = fid
+        self.chunk_size = chunk_size
+        self.data = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, min_size=None):
+        """
+        Read more data. Consumed data is dropped from the buffer.
+
+        :param min_size: Read at least this many bytes (unless at eof)
+        :returns: True if data was read, False at end of file
+        """
+
+        if self.eof:
+            return False
+
+        if self.pos:
+            self.data = self.data[self.pos:]
+            self.pos = 0
+
+        wanted = max(min_size or 0, self.chunk_size)
+        chunks = list()
+        got = 0
+        while got < wanted:
+            chunk = self.fid.read(wanted - got)
+            if not chunk:
+                self.eof = True
+                break
+            chunks.append(chunk)
+            got += len(chunk)
+
+        self.data += ''.join(chunks)
+        return got > 0
+
+    def skip_whitespace(self):
+        """
+        Skip whitespace reading more data as needed
+
+        :returns: The next character or None at end of file
+        """
+
+        while True:
+            data = self.data
+            pos = self.pos
+            while pos < len(data) and data[pos] in WHITESPACE:
+                pos += 1
+            self.pos = pos
+            if pos < len(data):
+                return data[pos]
+            if not self.fill():
+                return None
+
+    def decode(self, decoder):
+        """
+        Decode the value at the current position reading more data
+        until the value is complete.
+
+        :raises ValueError: if the data is not valid JSON
+        """
+
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.data, self.pos)
+            except ValueError:
+                # Incomplete value or bad JSON - only more data tells.
+                # Grow the reads so huge values don't cost quadratic time.
+                if not self.fill(len(self.data) - self.pos):
+                    raise
+                continue
+
+            # A number that runs into the end of the buffer could
+            # continue in the next chunk - like 1 or 1. or 1e- (the
+            # decoder stops at the 1 and leaves the rest)
+            if (not self.eof and
+                    isinstance(value, (int, long, float)) and
+                    not isinstance(value, bool)):
+                data = self.data
+                rest = end
+                while rest < len(data) and data[rest] in NUMBER_CHARS:
+                    rest += 1
+                if rest == len(data):
+                    self.fill(len(data) - self.pos)
+                    continue
+
+            self.pos = end
+            return value
+
+
+def iter_json(fid, chunk_size=CHUNK_SIZE):
+    """
+    Parse the JSON values in a file one at a time. The elements of
+    a top level array are returned one at a time, as are the values
+    of a whitespace separated sequence of values (JSON lines).
+
+    :param fid: A file like object opened for reading
+    :param chunk_size: How much to read at a time
+    :type fid: file
+    :type chunk_size: int
+    :returns: A generator of the parsed values
+    :rtype: generator
+    :raises ValueError: if the data is not valid JSON
+    """
+
+    decoder = json.JSONDecoder()
+    buf = _Buffer(fid, chunk_size)
+
+    first = buf.skip_whitespace()
+    if first is None:
+        return
+
+    if first != '[':
+        # A sequence of values
+        while buf.skip_whitespace() is not None:
+            yield buf.decode(decoder)
+        return
+
+    # An array - yield the elements
+    buf.pos += 1
+    for value in _iter_array(buf, decoder):
+        yield value
+
+    if buf.skip_whitespace() is not None:
+        raise ValueError('Extra data after JSON array')
+
+
+def _iter_array(buf, decoder):
+    """
+    Private function
+    DO NOT USE EXTERNALLY
+
+    Yield the elements of the array that starts just before the
+    buffer position. The position is left after the closing ].
+    """
+
+    if buf.skip_whitespace() == ']':
+        buf.pos += 1
+        return
+
+    while True:
+        if buf.skip_whitespace() is None:
+            raise ValueError('Unterminated JSON array')
+        yield buf.decode(decoder)
+
+        sep = buf.skip_whitespace()
+        buf.pos += 1
+        if sep == ']':
+            break
+        elif sep != ',':
+            raise ValueError('Expecting , or ] in JSON array')
+
+
+def iter_embedded_array(fid, chunk_size=CHUNK_SIZE):
+    """
+    Find the first JSON array of objects in a file of text and parse
+    its elements one at a time. The array starts at the first [ that
+    is followed by a { or by the ] of an empty array, so brackets in
+    the text before it (like [WARNING]) are skipped. The text after
+    the array is not read. The text is scanned and parsed in one pass.
+
+    :param fid: A file like object opened for reading
+    :param chunk_size: How much to read at a time
+    :type fid: file
+    :type chunk_size: int
+    :returns: A generator of the parsed elements
+    :rtype: generator
+    :raises ValueError: if there is no array or it is not valid JSON
+    """
+
+    decoder = json.JSONDecoder()
+    buf = _Buffer(fid, chunk_size)
+
+    while True:
+        start = buf.data.find('[', buf.pos)
+        if start < 0:
+            buf.pos = len(buf.data)
+            if not buf.fill():
+                raise ValueError('No JSON array found')
+            continue
+
+        buf.pos = start + 1
+        if buf.skip_whitespace() in ('{', ']'):
+            break
+
+    for value in _iter_array(buf, decoder):
+        yield value
+
+
+def iter_json_file(path, chunk_size=CHUNK_SIZE):
+    """
+    Parse the JSON values in a file one at a time. See iter_json.
+
+    :param path: The file to parse
+    :param chunk_size: How much to read at a time
+    :type path: str
+    :type chunk_size: int
+    :returns: A generator of the parsed values
+    :rtype: generator
+    :raises IOError: if the file cannot be read
+    :raises ValueError: if the data is not valid JSON
+    """
+
+    with open(path, 'r') as fid:
+        for value in iter_json(fid, chunk_size):
+            yield value
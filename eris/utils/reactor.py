@@ -0,0 +1,268 @@
+
+"""
+A minimal single threaded event loop. File descriptors are watched
+with poll and callbacks are run when they become readable or
+writable. Timers run callbacks at a given time. The loop is driven
+by the caller, one iteration at a time, so that the caller can do
+its own work (like scheduling jobs) between the events.
+    reactor = Reactor()
+    reactor.add_reader(fd, on_readable)
+    reactor.call_later(10, on_timer)
+    while not done:
+        reactor.run_once(timeout)
+"""
+
+# System imports
+import errno
+import heapq
+import itertools
+import select
+import time
+
+
+class Timer(object):
+    """
+    A callback scheduled to run at a specific time.
+    Returned by the Reactor call_at and call_later methods.
+    """
+
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Do not run the callback. Cancelling a timer
+        that already ran has no effect.
+
+        :returns: None
+        """
+
+        self.cancelled = True
+
+
+class Reactor(object):
+
+    def __init__(self):
+        """
+        Create an event loop with no readers and no timers
+        """
+
+        self._poller = select.poll()
+        self._readers = dict()
+        self._writers = dict()
+        self._timers = list()
+        self._timer_seq = itertools.count()
+
+    def add_reader(self, fd, callback, *args):
+        """
+        Run callback(*args) whenever fd is readable. A file descriptor
+        has at most one reader - adding another replaces the first.
+
+        :param fd: The file descriptor or an object with fileno()
+        :param callback: The function to call
+        :type fd: int
+        :type callback: function
+        :returns: None
+        """
+
+        fd = self._fileno(fd)
+        self._readers[fd] = (callback, args)
+        self._update(fd)
+
+    def remove_reader(self, fd):
+        """
+        Stop watching a file descriptor
+
+        :param fd: The file descriptor or an object with fileno()
+        :type fd: int
+        :returns: True if the file descriptor was being watched
+        :rtype: boolean
+        """
+
+        fd = self._fileno(fd)
+        if self._readers.pop(fd, None) is None:
+            return False
+
+        self._update(fd)
+        return True
+
+    def add_writer(self, fd, callback, *args):
+        """
+        Run callback(*args) whenever fd is writable. A file descriptor
+        has at most one writer - adding another replaces the first.
+
+        :param fd: The file descriptor or an object with fileno()
+        :param callback: The function to call
+        :type fd: int
+        :type callback: function
+        :returns: None
+        """
+
+        fd = self._fileno(fd)
+        self._writers[fd] = (callback, args)
+        self._update(fd)
+
+    def remove_writer(self, fd):
+        """
+        Stop waiting for a file descriptor to be writable
+
+        :param fd: The file descriptor or an object with fileno()
+        :type fd: int
+        :returns: True if the file descriptor had a writer
+        :rtype: boolean
+        """
+
+        fd = self._fileno(fd)
+        if self._writers.pop(fd, None) is None:
+            return False
+
+        self._update(fd)
+        return True
+
+    @staticmethod
+    def _fileno(fd):
+        if not isinstance(fd, (int, long)):
+            fd = fd.fileno()
+        return fd
+
+    def _update(self, fd):
+        """
+        Register the events for a file descriptor with the poller
+        """
+
+        mask = 0
+        if fd in self._readers:
+            mask |= select.POLLIN | select.POLLPRI
+        if fd in self._writers:
+            mask |= select.POLLOUT
+
+        if mask:
+            self._poller.register(fd, mask)
+        else:
+            try:
+                self._poller.unregister(fd)
+            except KeyError:
+                pass
+
+    def call_at(self, when, callback, *args):
+        """
+        Run callback(*args) at a specific time
+
+        :param when: The time as returned by time.time()
+        :param callback: The function to call
+        :type when: float
+        :type callback: function
+        :returns: The timer which can be cancelled
+        :rtype: Timer
+        """
+
+        timer = Timer(when, callback, args)
+        heapq.heappush(self._timers, (when, next(self._timer_seq), timer))
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        """
+        Run callback(*args) after delay seconds
+
+        :param delay: Seconds from now
+        :param callback: The function to call
+        :type delay: float
+        :type callback: function
+        :returns: The timer which can be cancelled
+        :rtype: Timer
+        """
+
+        return self.call_at(time.time() + delay, callback, *args)
+
+    def next_timer(self):
+        """
+        When does the next timer run
+
+        :returns: The time of the next timer or None if there are none
+        :rtype: float
+        """
+
+        timers = self._timers
+        while timers and timers[0][2].cancelled:
+            heapq.heappop(timers)
+
+        return timers[0][0] if timers else None
+
+    def _poll_nowait(self):
+        try:
+            return self._poller.poll(0)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return list()
+
+    def run_once(self, timeout=None):
+        """
+        Wait for file descriptors to be readable or timers to be due
+        and run their callbacks. Returns after one round of callbacks
+        or when the timeout expires.
+
+        :param timeout: The longest time to wait in seconds. \
+                None waits until there is an event.
+        :type timeout: float
+        :returns: The number of callbacks that were run
+        :rtype: int
+        """
+
+        next_timer = self.next_timer()
+        if next_timer is not None:
+            timer_timeout = max(next_timer - time.time(), 0)
+            if timeout is None or timer_timeout < timeout:
+                timeout = timer_timeout
+
+        if timeout is None:
+            poll_timeout = -1
+        else:
+            # poll takes milliseconds - round up so we don't wake up
+            # just before a timer and spin until it is due
+            poll_timeout = int(max(timeout, 0) * 1000 + 0.999)
+
+        try:
+            events = self._poller.poll(poll_timeout)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            # A signal handler ran - pick up whatever it made readable
+            events = self._poll_nowait()
+
+        ran = 0
+        for fd, event in events:
+            # Errors and hang ups are reported to both the reader and
+            # the writer - reading or writing will fail for them.
+            # A callback can remove the readers and writers that follow
+            if event & (select.POLLIN | select.POLLPRI |
+                        select.POLLERR | select.POLLHUP | select.POLLNVAL):
+                reader = self._readers.get(fd)
+                if reader is not None:
+                    callback, args = reader
+                    callback(*args)
+                    ran += 1
+
+            if event & (select.POLLOUT |
+                        select.POLLERR | select.POLLHUP | select.POLLNVAL):
+                writer = self._writers.get(fd)
+                if writer is not None:
+                    callback, args = writer
+                    callback(*args)
+                    ran += 1
+
+        current_time = time.time()
+        timers = self._timers
+        while timers and timers[0][0] <= current_time:
+            _, _, timer = heapq.heappop(timers)
+            if not timer.cancelled:
+                timer.cancelled = True
+                timer.callback(*timer.args)
+                ran += 1
+
+        return ran
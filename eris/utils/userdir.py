@@ -0,0 +1,73 @@
+
+"""
+Directories only the current user can use. The inventory cache, the
+inventory snapshot and the sockets hold files other users must not
+plant or read - an inventory with host variables like
+ansible_ssh_common_args runs commands for whoever uses it. So they
+default to a directory of the user
+    $XDG_CACHE_HOME/eris or ~/.cache/eris
+and any directory they use is created with mode 0700 and refused
+unless it belongs to the user and has mode 0700.
+"""
+
+# System imports
+import errno
+import os
+import stat
+
+
+def user_cache_dir(*names):
+    """
+    A directory in the cache directory of the current user
+
+    :param names: The path of the directory in the eris cache directory
+    :type names: str
+    :returns: The directory path - it may not exist yet
+    :rtype: str
+    """
+
+    cache_home = (os.environ.get('XDG_CACHE_HOME') or
+                  os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'eris', *names)
+
+
+def check_private_dir(path):
+    """
+    Check that only the current user can use a directory
+
+    :param path: The directory
+    :type path: str
+    :returns: None
+    :raises OSError: if the directory is missing, is not a directory \
+            (a symlink is not), is not owned by the current user or \
+            other users have access to it
+    """
+
+    dir_stat = os.lstat(path)
+    if not stat.S_ISDIR(dir_stat.st_mode):
+        raise OSError(errno.ENOTDIR, 'Not a directory', path)
+    if dir_stat.st_uid != os.getuid():
+        raise OSError(errno.EPERM, 'Owned by another user', path)
+    if dir_stat.st_mode & 0o077:
+        raise OSError(errno.EPERM, 'Open to other users (mode %o)' %
+                      stat.S_IMODE(dir_stat.st_mode), path)
+
+
+def make_private_dir(path):
+    """
+    Create a directory only the current user can use, or check an
+    existing one
+
+    :param path: The directory
+    :type path: str
+    :returns: None
+    :raises OSError: if the directory cannot be created or is not \
+            private (see check_private_dir)
+    """
+
+    try:
+        os.makedirs(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    check_private_dir(path)
@@ -0,0 +1,332 @@
+#! /usr/bin/env python
+
+"""
+Benchmark building a file inventory from a large deployment map.
+The peak memory of a fresh process building the inventory is
+measured for the streaming loader and for loading the whole map with
+json.load as the loader used to.
+
+The time to build the group hierarchy is measured as the number of
+hosts and groups grows. It should grow linearly with the hosts.
+
+The inventory is serialized pretty printed, compact and streamed.
+
+An inventory with a saved state is refreshed after one node changed
+in a map with a node on every line and in a map on a single line, and
+with the map unchanged. They are compared to a build from scratch.
+
+A host and a group are looked up in the indexed inventory snapshot
+used for --host and --group.
+
+A deployment map of racks, bare metal nodes and VMs is built with and
+without the rack and bare metal groups.
+
+python tools/bench_fileinv.py [--nodes N]
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from eris.inventory import fileinv
+from eris.inventory import inv_snapshot
+
+
+HIERARCHY_HOSTS = [1000, 10000, 100000]
+HIERARCHY_GROUPS = [100, 500]
+
+GROUPS = ['compute', 'controller', 'swift-storage', 'ceph-osd',
+          'rabbitmq', 'mysql', 'network', 'monitoring']
+
+
+SSH_VARIABLES = [
+    dict(ansible_user='root', ansible_become='false',
+         ansible_ssh_common_args='-o StrictHostKeyChecking=no '
+                                 '-o UserKnownHostsFile=/dev/null'),
+    dict(ansible_user='tuser', ansible_become='true',
+         ansible_ssh_private_key_file='/etc/eris/test_pkey.pem')]
+
+
+class WholeMapInventory(fileinv.ErisAnsibleInventory):
+    """
+    The inventory with the deployment map loaded in one go
+    """
+
+    def _load_deployment_map(self):
+        map_loc = self.eris_config['openstack_deployment']['deployment_map']
+        with open(map_loc, 'r') as fid:
+            return json.load(fid)
+
+
+def write_deployment_map(path, node_count):
+    with open(path, 'w') as fid:
+        fid.write('[\n')
+        for i in xrange(node_count):
+            node = dict(name='node-%d' % i,
+                        groups=[GROUPS[i % len(GROUPS)],
+                                GROUPS[(i * 7) % len(GROUPS)]],
+                        ip='10.%d.%d.%d' % (i >> 16, (i >> 8) & 255, i & 255),
+                        mac='52:54:00:%02x:%02x:%02x' % (i >> 16,
+                                                         (i >> 8) & 255,
+                                                         i & 255),
+                        type='vm',
+                        ansible_ssh_variables=SSH_VARIABLES[i % 2])
+            fid.write(json.dumps(node))
+            fid.write(',\n' if i < node_count - 1 else '\n')
+        fid.write(']\n')
+
+
+def write_topology_map(path, node_count, topology=True):
+    # 20 VMs on every bare metal node and 40 bare metal nodes in a rack
+    with open(path, 'w') as fid:
+        for i in xrange(node_count):
+            bare_metal = i / 21
+            node = dict(groups=[GROUPS[i % len(GROUPS)]],
+                        ip='10.%d.%d.%d' % (i >> 16, (i >> 8) & 255, i & 255),
+                        mac='52:54:00:%02x:%02x:%02x' % (i >> 16,
+                                                         (i >> 8) & 255,
+                                                         i & 255))
+            if i % 21 == 0:
+                node.update(name='bm-%d' % bare_metal, type='bare-metal')
+                if topology:
+                    node['rack'] = 'r%d' % (bare_metal / 40)
+            else:
+                node.update(name='vm-%d' % i, type='vm')
+                if topology:
+                    node['bare-metal'] = 'bm-%d' % bare_metal
+            fid.write(json.dumps(node) + '\n')
+
+
+def eris_config(map_path):
+    return dict(openstack_deployment=dict(deployment_map=map_path,
+                                          deployment_ssh=dict(),
+                                          groups=dict(),
+                                          name='bench'))
+
+
+def bench_hierarchy(host_count, group_count):
+    inv_obj = fileinv.ErisAnsibleInventory(eris_config(None))
+    inv_obj.add_group('bench')
+
+    # Every host is in two groups. Every group expands to an
+    # aggregate group and every aggregate group to a rack group.
+    groups_and_hosts = dict()
+    for i in xrange(host_count):
+        host = 'node-%d' % i
+        inv_obj.add_host(host)
+        for group in ('group-%d' % (i % group_count),
+                      'group-%d' % ((i * 7 + 1) % group_count)):
+            groups_and_hosts.setdefault(group, list()).append(host)
+
+    group_expansion = dict()
+    for i in xrange(group_count):
+        group_expansion['group-%d' % i] = ['aggregate-%d' % (i % 50)]
+        group_expansion['aggregate-%d' % (i % 50)] = ['rack-%d' % (i % 5)]
+
+    start = time.time()
+    inv_obj._create_group_hierarchy('bench', group_expansion,
+                                    groups_and_hosts)
+    return time.time() - start
+
+
+def bench_serialize(map_path):
+    inv_obj = fileinv.ErisAnsibleInventory(eris_config(map_path))
+    inv_obj.create_inventory()
+
+    results = list()
+    for name, serialize in (
+            ('pretty', lambda: inv_obj.serialize_to_json(pretty=True)),
+            ('compact', inv_obj.serialize_to_json)):
+        start = time.time()
+        size = len(serialize())
+        results.append((name, time.time() - start, size))
+
+    with open(os.devnull, 'w') as fid:
+        start = time.time()
+        inv_obj.serialize_to_stream(fid)
+        results.append(('stream', time.time() - start, None))
+
+    return results
+
+
+def bench_incremental(map_path, tmp_dir):
+    config = eris_config(map_path)
+    state_dir = tempfile.mkdtemp(dir=tmp_dir)
+    config['openstack_deployment']['inventory_state'] = os.path.join(
+        state_dir, 'inventory.state')
+
+    def create_inventory(inv_config):
+        start = time.time()
+        inv_obj = fileinv.ErisAnsibleInventory(inv_config)
+        inv_obj.create_inventory()
+        return inv_obj, time.time() - start
+
+    def change_node(ip, one_per_line=True):
+        # Change the address of the middle node. The other nodes are
+        # left as they are when the map has a node on every line.
+        with open(map_path, 'r') as fid:
+            lines = fid.read().splitlines()
+        if one_per_line:
+            idx = len(lines) / 2
+            node = json.loads(lines[idx].rstrip(','))
+            node['ip'] = ip
+            lines[idx] = json.dumps(node) + ','
+            with open(map_path, 'w') as fid:
+                fid.write('\n'.join(lines) + '\n')
+        else:
+            nodes = json.loads(''.join(lines))
+            node = nodes[len(nodes) / 2]
+            node['ip'] = ip
+            with open(map_path, 'w') as fid:
+                json.dump(nodes, fid)
+        return node['name']
+
+    _, plain = create_inventory(eris_config(map_path))
+    _, first = create_inventory(config)
+
+    results = [('plain build', plain), ('first build with state', first)]
+    for one_per_line, row in ((True, 'one node changed'),
+                              (False, 'one node changed, map on a line')):
+        name = change_node('192.168.0.%d' % len(results), one_per_line)
+        inv_obj, patched = create_inventory(config)
+        assert inv_obj.get_host_vars(name)['ansible_host'] == \
+            '192.168.0.%d' % len(results)
+        results.append((row, patched))
+
+    # The map is only stat'ed once it is older than RACY_SECONDS
+    stale = time.time() - 10
+    os.utime(map_path, (stale, stale))
+    create_inventory(config)
+    _, unchanged = create_inventory(config)
+    results.append(('map unchanged', unchanged))
+
+    return results
+
+
+def bench_topology(tmp_dir, node_count):
+    results = list()
+    for topology in (False, True):
+        map_path = os.path.join(tmp_dir, 'topology.json')
+        write_topology_map(map_path, node_count, topology)
+        inv_obj = fileinv.ErisAnsibleInventory(eris_config(map_path))
+        start = time.time()
+        inv_obj.create_inventory()
+        results.append((time.time() - start, len(inv_obj.inventory)))
+    return results
+
+
+def bench_snapshot(map_path, tmp_dir, lookups=100):
+    inv_obj = fileinv.ErisAnsibleInventory(eris_config(map_path))
+    inv_obj.create_inventory()
+    snapshot = inv_snapshot.InventorySnapshot(os.path.join(tmp_dir,
+                                                           'inventory.db'))
+
+    start = time.time()
+    snapshot.put('bench', inv_obj)
+    written = time.time() - start
+
+    results = list()
+    for kind, name in (('host', 'node-%d' % (len(inv_obj.hosts) / 2)),
+                       ('group', GROUPS[0])):
+        start = time.time()
+        for _ in xrange(lookups):
+            assert snapshot.lookup('bench', kind, name) != '{}'
+        results.append((kind, (time.time() - start) / lookups))
+
+    return written, results
+
+
+def max_rss():
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_child(loader, map_path):
+    inv_class = fileinv.ErisAnsibleInventory
+    if loader == 'whole':
+        inv_class = WholeMapInventory
+
+    base_rss = max_rss()
+    start = time.time()
+    inv_obj = inv_class(eris_config(map_path))
+    inv_obj.create_inventory()
+    elapsed = time.time() - start
+    print json.dumps(dict(rss=max_rss() - base_rss, elapsed=elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='File inventory benchmark')
+    parser.add_argument('--nodes', type=int, default=50000,
+                        help='Number of nodes in the deployment map')
+    parser.add_argument('--child', nargs=2, metavar=('LOADER', 'MAP'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        run_child(*args.child)
+        return
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        map_path = os.path.join(tmp_dir, 'deployment.json')
+        write_deployment_map(map_path, args.nodes)
+        map_size = os.path.getsize(map_path)
+
+        results = list()
+        for loader in ('whole', 'stream'):
+            output = subprocess.check_output([sys.executable,
+                                              os.path.abspath(__file__),
+                                              '--child', loader, map_path])
+            results.append((loader, json.loads(output)))
+        incremental = bench_incremental(map_path, tmp_dir)
+        snapshot = bench_snapshot(map_path, tmp_dir)
+        topology = bench_topology(tmp_dir, args.nodes)
+        serialized = bench_serialize(map_path)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    print '%d nodes, %.1f MB deployment map' % (args.nodes,
+                                                map_size / 1048576.0)
+    print '%10s %15s %10s' % ('loader', 'peak MB', 'sec')
+    for loader, result in results:
+        print '%10s %15.1f %10.2f' % (loader, result['rss'] / 1024.0,
+                                      result['elapsed'])
+
+    print
+    print '%10s %10s %10s' % ('output', 'sec', 'MB')
+    for name, elapsed, size in serialized:
+        print '%10s %10.2f %10s' % (name, elapsed,
+                                    '%.1f' % (size / 1048576.0)
+                                    if size is not None else '-')
+
+    print
+    print '%35s %10s' % ('saved state', 'sec')
+    for row, elapsed in incremental:
+        print '%35s %10.3f' % (row, elapsed)
+
+    written, lookups = snapshot
+    print 'snapshot: written in %.2f sec, %s' % (
+        written, ', '.join('%s lookup %.2f msec' % (kind, elapsed * 1e3)
+                           for kind, elapsed in lookups))
+
+    print 'topology: %.2f sec (%d groups) without, %.2f sec (%d groups) ' \
+        'with the rack and bare metal groups' % (topology[0] + topology[1])
+
+    print
+    print '%10s %10s %10s %15s' % ('hosts', 'groups', 'msec', 'usec/host')
+    for host_count in HIERARCHY_HOSTS:
+        for group_count in HIERARCHY_GROUPS:
+            elapsed = bench_hierarchy(host_count, group_count)
+            print '%10d %10d %10.2f %15.2f' % (host_count, group_count,
+                                               elapsed * 1e3,
+                                               elapsed * 1e6 / host_count)
+
+
+if __name__ == '__main__':
+    main()
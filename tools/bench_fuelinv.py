@@ -0,0 +1,83 @@
+#! /usr/bin/env python
+
+"""
+Benchmark getting the fuel node list out of the output of the fuel
+command run through ansible. The streaming extractor is compared to
+trimming the output line by line as the fuel inventory used to, for
+pretty printed fuel output and for fuel output on one line (which the
+line trimming cannot handle).
+
+python tools/bench_fuelinv.py [--nodes N [N ...]]
+"""
+
+import argparse
+import json
+import os
+import StringIO
+import sys
+import time
+
+from eris.utils import jsonstream
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'eris', 'tests', 'datafiles'))
+import fake_fuel  # noqa
+
+
+HEADER = 'fuel_host | SUCCESS | rc=0 >>\n'
+TRAILER = '\nShared connection to 10.20.0.2 closed.\n\n'
+
+
+def trim_lines(command_output):
+    """
+    The node list extraction the fuel inventory used to do
+    """
+
+    output_lines = command_output.split('\n')
+    while len(output_lines) > 1 and output_lines[0].strip() != '[':
+        output_lines.pop(0)
+    while len(output_lines) > 1 and output_lines[-1].strip() != ']':
+        output_lines.pop(len(output_lines) - 1)
+    return json.loads('\n'.join(output_lines))
+
+
+def stream(command_output):
+    return list(jsonstream.iter_embedded_array(
+        StringIO.StringIO(command_output)))
+
+
+def bench(extract, command_output, node_count):
+    start = time.time()
+    try:
+        nodes = extract(command_output)
+    except ValueError:
+        return None
+    elapsed = time.time() - start
+    assert len(nodes) == node_count
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fuel output benchmark')
+    parser.add_argument('--nodes', type=int, nargs='+',
+                        default=[1000, 10000, 50000],
+                        help='Numbers of fuel nodes')
+    args = parser.parse_args()
+
+    print '%10s %10s %12s %12s' % ('nodes', 'layout', 'lines sec',
+                                   'stream sec')
+    for node_count in args.nodes:
+        nodes = [fake_fuel.fuel_node(node_id)
+                 for node_id in xrange(1, node_count + 1)]
+        for layout, indent in (('pretty', 4), ('one line', None)):
+            command_output = (HEADER + json.dumps(nodes, indent=indent) +
+                              TRAILER)
+            results = [bench(extract, command_output, node_count)
+                       for extract in (trim_lines, stream)]
+            print '%10d %10s %12s %12s' % ((node_count, layout) + tuple(
+                '%.2f' % elapsed if elapsed is not None else 'fails'
+                for elapsed in results))
+
+
+if __name__ == '__main__':
+    main()
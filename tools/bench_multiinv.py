@@ -0,0 +1,69 @@
+#! /usr/bin/env python
+
+"""
+Benchmark a multi source inventory of several fuel environments.
+Every fuel source runs the stand-in fuel command after a delay that
+plays the part of the ssh round trips to the fuel master. The
+sources are built one at a time (one worker) and all at once.
+
+python tools/bench_multiinv.py [--sources N] [--nodes N] [--delay SEC]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from eris.inventory import multiinv
+
+
+DATAFILES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         '..', 'eris', 'tests', 'datafiles')
+
+
+def fuel_source(idx, delay):
+    with open(os.path.join(DATAFILES, 'test_fuel_config.json'), 'r') as fid:
+        source = json.load(fid)
+    source['inventory_plugin'] = 'eris.inventory.fuelinv'
+    source['name'] = 'fuel-%d' % idx
+    source['host_prefix'] = 'fuel-%d-' % idx
+
+    fuel = source['openstack_deployment']['fuel']
+    fuel['transport'] = 'local'
+    fuel['fuel_command'] = "sh -c 'sleep %s; %s %s node list --json'" % (
+        delay, sys.executable, os.path.join(DATAFILES, 'fake_fuel.py'))
+    return source
+
+
+def bench(sources, workers):
+    inv_obj = multiinv.ErisAnsibleInventory(dict(inventory_sources=sources,
+                                                 inventory_workers=workers))
+    start = time.time()
+    inv_obj.create_inventory()
+    return time.time() - start, inv_obj.source_stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Multi source benchmark')
+    parser.add_argument('--sources', type=int, default=4,
+                        help='Number of fuel sources')
+    parser.add_argument('--nodes', type=int, default=5000,
+                        help='Number of nodes in every fuel environment')
+    parser.add_argument('--delay', type=float, default=1.0,
+                        help='Seconds every fuel master takes to answer')
+    args = parser.parse_args()
+
+    os.environ['FAKE_FUEL_NODES'] = str(args.nodes)
+    sources = [fuel_source(idx, args.delay) for idx in xrange(args.sources)]
+
+    for workers in (1, args.sources):
+        elapsed, source_stats = bench(sources, workers)
+        print '%d workers: %.2f sec (%s)' % (
+            workers, elapsed, ', '.join('%s %.2f' % (stats['name'],
+                                                     stats['seconds'])
+                                        for stats in source_stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+#! /usr/bin/env python
+
+"""
+Benchmark the cost of a scheduler tick as the number of pending
+jobs grows. None of the pending jobs are due, so a tick should cost
+the same whether there are a thousand or a hundred thousand of them.
+
+The same for due jobs queued behind a tag at its limit - they should
+not be looked at until a job with the tag finishes.
+
+Also compare the cost of picking up jobs from one file per job
+against a single batch file, and time a restart from the job journal.
+
+python tools/bench_scheduler.py [--ticks N] [--intake-jobs N]
+                                [--journal-jobs N]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from eris.cli import sched_daemon
+
+
+PENDING_COUNTS = [1000, 10000, 100000]
+
+
+def bench_ticks(pending_count, ticks, out_dir):
+    scheduler = sched_daemon.Scheduler(out_dir)
+    for _ in xrange(pending_count):
+        scheduler.add_job(sched_daemon.Job(out_dir, ['true'],
+                                           run_at=3600,
+                                           tag='bench'))
+
+    start = time.time()
+    for _ in xrange(ticks):
+        scheduler.run_jobs()
+    return (time.time() - start) / ticks
+
+
+def bench_blocked(queued_count, ticks, out_dir):
+    # A limit of 0 keeps the jobs queued without running anything
+    scheduler = sched_daemon.Scheduler(out_dir,
+                                       tag_limits=dict(blocked=0))
+    for _ in xrange(queued_count):
+        scheduler.add_job(sched_daemon.Job(out_dir, ['true'], run_at=0,
+                                           tag='blocked'))
+    scheduler.run_jobs()
+    assert len(scheduler.queued_jobs()) == queued_count
+
+    start = time.time()
+    for _ in xrange(ticks):
+        scheduler.run_jobs()
+    return (time.time() - start) / ticks
+
+
+def bench_intake(job_count, out_dir, batch):
+    job_dir = tempfile.mkdtemp()
+    try:
+        jobs = [dict(type='JOB', outdir=out_dir, cmd=['true'],
+                     run_at=3600, tag='bench%d' % i)
+                for i in xrange(job_count)]
+
+        start = time.time()
+        if batch:
+            sched_daemon.write_job_file(job_dir, jobs)
+        else:
+            for i, job in enumerate(jobs):
+                tmp_path = os.path.join(job_dir, '.%d.tmp' % i)
+                with open(tmp_path, 'w') as fid:
+                    json.dump(job, fid)
+                os.rename(tmp_path, os.path.join(job_dir, '%d.json' % i))
+
+        scheduler = sched_daemon.Scheduler(job_dir)
+        scheduler.load_job_files(os.listdir(job_dir))
+        assert len(scheduler.pending_jobs) == job_count
+        return time.time() - start
+    finally:
+        shutil.rmtree(job_dir)
+
+
+def bench_recovery(job_count, out_dir):
+    journal_dir = tempfile.mkdtemp()
+    try:
+        journal_path = os.path.join(journal_dir, 'jobs.journal')
+        scheduler = sched_daemon.Scheduler(out_dir)
+        scheduler.open_journal(journal_path, fsync=False)
+        for _ in xrange(job_count):
+            scheduler.add_job(sched_daemon.Job(out_dir, ['true'],
+                                               run_at=3600, repeat=60,
+                                               until=7200, tag='bench'))
+
+        # A snapshot and a log of the changes since
+        scheduler.journal.compact(dict((job.id, job.record())
+                                       for job in scheduler.jobs.values()))
+        for job in scheduler.jobs.values()[:job_count / 10]:
+            scheduler.journal.put(job.id, dict(run_at=job.run_at + 60))
+        scheduler.journal.close()
+
+        start = time.time()
+        scheduler = sched_daemon.Scheduler(out_dir)
+        assert scheduler.open_journal(journal_path) == job_count
+        scheduler.journal.close()
+        return time.time() - start
+    finally:
+        shutil.rmtree(journal_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scheduler tick benchmark')
+    parser.add_argument('--ticks', type=int, default=1000,
+                        help='Number of ticks to average over')
+    parser.add_argument('--intake-jobs', type=int, default=2000,
+                        help='Number of jobs to submit for the intake test')
+    parser.add_argument('--journal-jobs', type=int, default=50000,
+                        help='Number of jobs in the journal to recover')
+    args = parser.parse_args()
+
+    out_dir = tempfile.mkdtemp()
+    results = list()
+    blocked = list()
+    intake = list()
+
+    # The scheduler prints on every tick - keep that out of the way
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        for pending_count in PENDING_COUNTS:
+            results.append((pending_count,
+                            bench_ticks(pending_count, args.ticks, out_dir)))
+            blocked.append((pending_count,
+                            bench_blocked(pending_count, args.ticks,
+                                          out_dir)))
+        for batch in (False, True):
+            intake.append((batch, bench_intake(args.intake_jobs, out_dir,
+                                               batch)))
+        recovery = bench_recovery(args.journal_jobs, out_dir)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        os.rmdir(out_dir)
+
+    print '%10s %15s' % ('pending', 'usec/tick')
+    for pending_count, tick_cost in results:
+        print '%10d %15.2f' % (pending_count, tick_cost * 1e6)
+
+    print
+    print '%10s %15s' % ('blocked', 'usec/tick')
+    for queued_count, tick_cost in blocked:
+        print '%10d %15.2f' % (queued_count, tick_cost * 1e6)
+
+    print
+    print '%10s %15s' % ('intake', 'msec/%d jobs' % args.intake_jobs)
+    for batch, intake_cost in intake:
+        print '%10s %15.2f' % ('batch' if batch else 'files',
+                               intake_cost * 1e3)
+
+    print
+    print 'restart with %d jobs in the journal: %.2f msec' % (
+        args.journal_jobs, recovery * 1e3)
+
+
+if __name__ == '__main__':
+    main()
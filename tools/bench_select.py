@@ -0,0 +1,112 @@
+#! /usr/bin/env python
+
+"""
+Benchmark selecting hosts from a large inventory. Every selection is
+timed the first time (building the indexes it needs) and after that,
+and compared to serializing the inventory and picking the hosts out of
+the JSON as the fault injection playbooks used to.
+
+python tools/bench_select.py [--hosts N]
+"""
+
+import argparse
+import json
+import random
+import time
+
+from eris.inventory import inventory_base
+
+
+GROUPS = ['compute', 'controller', 'swift-storage', 'ceph-osd',
+          'rabbitmq', 'mysql', 'network', 'monitoring']
+
+SELECTIONS = [
+    ('controller:&monitoring', dict()),
+    ('all:!compute', dict()),
+    ('rack_1*', dict()),
+    ('compute', dict(where=dict(eris_rack='r7'))),
+    ('rabbitmq', dict(count=3, seed=1, distinct_groups='rack_*')),
+    ('rabbitmq', dict(count=3, seed=1, distinct_var='eris_rack')),
+]
+
+
+def build_inventory(host_count):
+    # 20 hosts on every bare metal node, 40 bare metal nodes in a rack.
+    # The group of every host is in the group of its bare metal node,
+    # in the group of its rack, in the root group.
+    inv_obj = inventory_base.ErisInventoryBase(dict())
+    inv_obj.add_hosts(('node-%d' % i,
+                       dict(ansible_host='10.%d.%d.%d' % (i >> 16,
+                                                          (i >> 8) & 255,
+                                                          i & 255),
+                            eris_rack='r%d' % (i / 800)),
+                       dict(ansible_user='root'))
+                      for i in xrange(host_count))
+
+    inv_obj.add_group('root')
+    groups_and_hosts = dict()
+    for i in xrange(host_count):
+        host = 'node-%d' % i
+        for group in (GROUPS[i % len(GROUPS)], GROUPS[(i * 7) % len(GROUPS)],
+                      'baremetal_%d' % (i / 20)):
+            groups_and_hosts.setdefault(group, list()).append(host)
+    for group, hosts in groups_and_hosts.iteritems():
+        inv_obj.add_group(group)
+        inv_obj.add_hosts_to_group(group, hosts)
+    for bare_metal in xrange((host_count + 19) / 20):
+        rack = 'rack_%d' % (bare_metal / 40)
+        inv_obj.add_group(rack)
+        inv_obj.add_child_to_group(rack, 'baremetal_%d' % bare_metal)
+        inv_obj.add_child_to_group('root', rack)
+    inv_obj.add_children_to_group('root', GROUPS)
+    return inv_obj
+
+
+def from_json(inv_obj):
+    # 3 random rabbitmq hosts in different racks out of the JSON
+    inventory = json.loads(inv_obj.serialize_to_json())
+    hostvars = inventory['_meta']['hostvars']
+    by_rack = dict()
+    for host in sorted(inventory['rabbitmq']['hosts']):
+        by_rack.setdefault(hostvars[host]['eris_rack'], list()).append(host)
+    rng = random.Random(1)
+    return [rng.choice(by_rack[rack])
+            for rack in rng.sample(sorted(by_rack), 3)]
+
+
+def timed(func):
+    start = time.time()
+    result = func()
+    return time.time() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Host selection benchmark')
+    parser.add_argument('--hosts', type=int, default=100000,
+                        help='Number of hosts in the inventory')
+    args = parser.parse_args()
+
+    elapsed, inv_obj = timed(lambda: build_inventory(args.hosts))
+    print '%d hosts, %d groups built in %.2f sec' % (
+        len(inv_obj.hosts), len(inv_obj.inventory), elapsed)
+
+    print '%50s %10s %10s %10s' % ('selection', 'hosts', 'first ms',
+                                   'next ms')
+    for pattern, kwargs in SELECTIONS:
+        def select():
+            return inv_obj.select_hosts(pattern, **kwargs)
+
+        first, hosts = timed(select)
+        again = min(timed(select)[0] for _ in xrange(5))
+        print '%50s %10d %10.2f %10.2f' % (
+            ' '.join([pattern] + ['%s=%s' % item
+                                  for item in sorted(kwargs.items())])[:50],
+            len(hosts), first * 1e3, again * 1e3)
+
+    elapsed, _ = timed(lambda: from_json(inv_obj))
+    print '%50s %10d %10.2f' % ('from the JSON (rabbitmq distinct racks)',
+                                3, elapsed * 1e3)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+#! /usr/bin/env python
+
+"""
+Benchmark the startup of the erisinv script. Ansible runs it as a
+new process every time it needs the inventory, so the hot path -
+returning the cached inventory or a host from the snapshot - is
+timed end to end in a fresh interpreter and compared to a target.
+The modules the hot path imports are listed so an expensive import
+that creeps in shows up. The script is also timed as a client of a
+running inventory server.
+
+The exit status is 1 if a hot path takes longer than the target.
+
+python tools/bench_startup.py [--runs N] [--target-ms MS]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+ERISINV = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', 'eris', 'cli', 'erisinv.py')
+TEST_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           '..', 'eris', 'tests', 'datafiles',
+                           'test_config.json')
+
+
+def write_config(tmp_dir):
+    with open(TEST_CONFIG, 'r') as fid:
+        eris_config = json.load(fid)
+
+    deployment = eris_config['openstack_deployment']
+    deployment['deployment_map'] = os.path.abspath(
+        os.path.join(os.path.dirname(TEST_CONFIG), '..', '..', '..',
+                     deployment['deployment_map']))
+    eris_config['inventory_cache'] = dict(
+        cache_dir=os.path.join(tmp_dir, 'cache'), ttl=3600)
+    eris_config['inventory_snapshot'] = dict(
+        path=os.path.join(tmp_dir, 'inventory.db'))
+
+    config_file = os.path.join(tmp_dir, 'config.json')
+    with open(config_file, 'w') as fid:
+        json.dump(eris_config, fid)
+    return config_file
+
+
+def time_command(cmd, env, runs):
+    timings = list()
+    with open(os.devnull, 'w') as devnull:
+        for _ in xrange(runs):
+            start = time.time()
+            subprocess.check_call(cmd, env=env, stdout=devnull)
+            timings.append(time.time() - start)
+
+    timings.sort()
+    return timings[len(timings) / 2]
+
+
+def start_server(env, tmp_dir):
+    socket_path = os.path.join(tmp_dir, 'erisinv.sock')
+    server = subprocess.Popen([sys.executable, '-m', 'eris.cli.inv_daemon',
+                               '--socket', socket_path,
+                               '--refresh-interval', '0'],
+                              env=env, stdout=open(os.devnull, 'w'))
+
+    deadline = time.time() + 30
+    while not os.path.exists(socket_path) and time.time() < deadline:
+        time.sleep(0.01)
+    return server, socket_path
+
+
+def hot_path_imports(env):
+    code = ('import sys\n'
+            'before = set(sys.modules)\n'
+            'sys.argv = ["erisinv", "--list"]\n'
+            'sys.stdout = open("/dev/null", "w")\n'
+            'execfile(%r, dict(__name__="__main__"))\n'
+            'sys.stdout = sys.__stdout__\n'
+            'print "\\n".join(sorted(name for name in sys.modules\n'
+            '                        if name not in before and\n'
+            '                        sys.modules[name] is not None))\n'
+            % os.path.abspath(ERISINV))
+    return subprocess.check_output([sys.executable, '-c', code],
+                                   env=env).split()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='erisinv startup benchmark')
+    parser.add_argument('--runs', type=int, default=21,
+                        help='Number of runs to take the median of')
+    parser.add_argument('--target-ms', type=float, default=50.0,
+                        help='Target for the hot paths in milliseconds')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        env = dict(os.environ)
+        env['ERIS_CONFIG_FILE'] = write_config(tmp_dir)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [os.path.abspath(os.path.join(os.path.dirname(ERISINV),
+                                          '..', '..'))] +
+            filter(None, [env.get('PYTHONPATH')]))
+        env.pop('ERIS_INVENTORY_REFRESH', None)
+
+        erisinv = [sys.executable, ERISINV]
+        # Fill the cache and the snapshot
+        subprocess.check_call(erisinv + ['--list'], env=env,
+                              stdout=open(os.devnull, 'w'))
+
+        results = [
+            ('interpreter', time_command([sys.executable, '-c', 'pass'],
+                                         env, args.runs), False),
+            ('--list cached', time_command(erisinv + ['--list'],
+                                           env, args.runs), True),
+            ('--host snapshot', time_command(erisinv + ['--host', 'fuel'],
+                                             env, args.runs), True)]
+
+        env['ERIS_INVENTORY_REFRESH'] = '1'
+        results.append(('--list built', time_command(erisinv + ['--list'],
+                                                     env, args.runs), False))
+        env.pop('ERIS_INVENTORY_REFRESH')
+        imports = hot_path_imports(env)
+
+        server, socket_path = start_server(env, tmp_dir)
+        try:
+            env['ERIS_INVENTORY_SOCKET'] = socket_path
+            results.append(('--list server', time_command(
+                erisinv + ['--list'], env, args.runs), True))
+        finally:
+            server.terminate()
+            server.wait()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    print '%20s %10s' % ('run', 'msec')
+    over_target = False
+    for name, elapsed, hot in results:
+        flag = ''
+        if hot and elapsed * 1e3 > args.target_ms:
+            flag = 'over %.0f msec target' % args.target_ms
+            over_target = True
+        print '%20s %10.1f %s' % (name, elapsed * 1e3, flag)
+
+    print
+    print '%d modules imported by a cache hit:' % len(imports)
+    print ' '.join(imports)
+
+    if over_target:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()